@@ -1,14 +1,21 @@
 """
 ホテルコンシェルジュ向け旅行プラン作成補助APIアプリケーション
 メインFlaskアプリケーションファイル
+単体では起動しない（main.py の FastAPI に /api としてマウントされる。起動は start_server.py）
 """
 
 from flask import Flask
 from flask_cors import CORS
 from routes.api_routes import api_bp
+from services.hotel_service import hotel_service
 
-def create_app():
-    """Flaskアプリケーションファクトリ"""
+def create_app(url_prefix='/api'):
+    """
+    Flaskアプリケーションファクトリ
+    
+    Args:
+        url_prefix: APIルートの接頭辞（FastAPI の /api にマウントする場合は ''）
+    """
     app = Flask(__name__)
     
     # 設定
@@ -17,17 +24,16 @@ def create_app():
     # 開発中は LAN 上のスマホアクセスも許可
     CORS(
         app,
-        resources={r"/api/*": {"origins": "*"}},
+        resources={f"{url_prefix}/*": {"origins": "*"}},
         supports_credentials=True,
         allow_headers=["Content-Type", "Authorization", "X-Requested-With"],
         methods=["GET", "POST", "OPTIONS"],
     )
     
     # APIルートを登録
-    app.register_blueprint(api_bp, url_prefix='/api')
+    app.register_blueprint(api_bp, url_prefix=url_prefix or None)
+    
+    # ホテル⇔観光地の所要時間テーブルを起動時に事前計算
+    hotel_service.warm_async()
     
     return app
-
-if __name__ == '__main__':
-    app = create_app()
-    app.run(debug=True, host='0.0.0.0', port=5001)
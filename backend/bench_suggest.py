@@ -0,0 +1,164 @@
+"""
+/api/plan/suggest の負荷試験ハーネス（標準ライブラリのみ）
+指定の同時実行数でリクエストを送り、スループット・レイテンシ（p50/p90/p99）・フォールバック率・キャッシュヒット率を表示する
+
+使い方（backend ディレクトリで）:
+    # LLM 代替サーバーとアプリを起動しておく
+    python llm_stub_server.py --port 5900 --latency-ms 800 --error-rate 0.05 &
+    OPENAI_API_KEY=stub OPENAI_BASE_URL=http://127.0.0.1:5900/v1 python start_server.py &
+    python bench_suggest.py --url http://127.0.0.1:8000/api/plan/suggest --concurrency 8 --requests 200
+
+    # サーバーを起動せずにアプリをプロセス内で呼ぶ場合
+    OPENAI_API_KEY=stub OPENAI_BASE_URL=http://127.0.0.1:5900/v1 python bench_suggest.py --in-process
+
+--distinct で顧客の種類数（= キャッシュに載る件数）を、--unique で毎回異なるプロンプト（キャッシュ無効）を指定できる
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """q パーセンタイル（最近傍順位法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+class HttpTarget:
+    """HTTP で suggest を呼ぶ"""
+
+    def __init__(self, url: str, timeout: float):
+        self.url = url
+        self.timeout = timeout
+
+    def post(self, payload: Dict):
+        req = urllib.request.Request(self.url, data=json.dumps(payload).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return resp.status, json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            return e.code, None
+        except (urllib.error.URLError, TimeoutError, ValueError):
+            return 0, None
+
+
+class InProcessTarget:
+    """Flask アプリをプロセス内で呼ぶ（スレッドごとにテストクライアントを持つ）"""
+
+    def __init__(self):
+        from app import create_app
+        self.app = create_app()
+        self._local = threading.local()
+
+    def post(self, payload: Dict):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        resp = client.post('/api/plan/suggest', json=payload)
+        return resp.status_code, resp.get_json(silent=True)
+
+
+def run(target, customers: List[str], total: int, concurrency: int, top_k: int, model_profile: str,
+        deadline_ms: Optional[float], unique: bool, constraints: Dict) -> Dict:
+    """負荷をかけて結果を集計"""
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    sources: Counter = Counter()
+    reasons: Counter = Counter()
+    profiles: Counter = Counter()
+    cache_hits = 0
+    lock = threading.Lock()
+
+    def one(i: int) -> None:
+        nonlocal cache_hits
+        payload = {
+            'customer_id': customers[i % len(customers)],
+            'constraints': dict(constraints, bench_nonce=uuid.uuid4().hex[:8]) if unique else constraints,
+            'top_k': top_k,
+            'model_profile': model_profile,
+        }
+        if deadline_ms is not None:
+            payload['deadline_ms'] = deadline_ms
+        t0 = time.perf_counter()
+        status, body = target.post(payload)
+        ms = (time.perf_counter() - t0) * 1000
+        meta = ((body or {}).get('suggest') or {}).get('meta') or {}
+        with lock:
+            latencies.append(ms)
+            statuses[status] += 1
+            if status == 200:
+                sources[meta.get('source', 'llm')] += 1
+                if meta.get('fallback_reason'):
+                    reasons[meta['fallback_reason']] += 1
+                if meta.get('profile'):
+                    profiles[meta['profile']] += 1
+                if meta.get('cache') == 'hit':
+                    cache_hits += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        list(ex.map(one, range(total)))
+    elapsed = time.perf_counter() - t0
+    ok = statuses.get(200, 0)
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'elapsed_s': round(elapsed, 2),
+        'throughput_rps': round(total / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 1),
+            'p90': round(percentile(latencies, 90), 1),
+            'p99': round(percentile(latencies, 99), 1),
+            'max': round(max(latencies), 1),
+            'mean': round(statistics.fmean(latencies), 1),
+        },
+        'status': dict(statuses),
+        'fallback_rate': round(sources.get('fallback', 0) / ok, 3) if ok else None,
+        'fallback_reasons': dict(reasons),
+        'cache_hit_rate': round(cache_hits / ok, 3) if ok else None,
+        'profiles': dict(profiles),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='/api/plan/suggest の負荷試験')
+    parser.add_argument('--url', default='http://127.0.0.1:8000/api/plan/suggest')
+    parser.add_argument('--in-process', action='store_true', help='サーバーを使わずアプリをプロセス内で呼ぶ')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--customers', default='C001,C002,C003,C005,C006,C007,C008,C009,C010',
+                        help='顧客IDのカンマ区切り')
+    parser.add_argument('--distinct', type=int, help='使う顧客の種類数（--customers の先頭から）')
+    parser.add_argument('--unique', action='store_true', help='毎回異なるプロンプトにしてキャッシュを効かせない')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--model-profile', default='balanced')
+    parser.add_argument('--deadline-ms', type=float)
+    parser.add_argument('--weather', default='sunny')
+    parser.add_argument('--season', default='spring')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args(argv)
+
+    customers = [c.strip() for c in args.customers.split(',') if c.strip()]
+    if args.distinct:
+        customers = customers[:args.distinct]
+    target = InProcessTarget() if args.in_process else HttpTarget(args.url, args.timeout)
+    report = run(target, customers, args.requests, args.concurrency, args.top_k, args.model_profile,
+                 args.deadline_ms, args.unique, {'weather': args.weather, 'season': args.season})
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
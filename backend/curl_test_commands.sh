@@ -10,10 +10,10 @@ echo "=============================================="
 echo ""
 
 # APIサーバーのベースURL
-BASE_URL="http://localhost:5001/api"
+BASE_URL="http://localhost:8000/api"
 
 echo "事前準備: 別ターミナルで以下のコマンドを実行してサーバーを起動してください"
-echo "cd backend && python app.py"
+echo "cd backend && python start_server.py"
 echo ""
 echo "サーバー起動後、以下のコマンドを実行してください"
 echo ""
@@ -4,8 +4,13 @@ CSVデータ読み込みユーティリティ
 """
 
 import csv
+import logging
 import os
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from utils.geo import distances_from_km
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('data')
 
 class DataLoader:
     """CSVデータローダー（キャッシュ機能付き）"""
@@ -13,7 +18,12 @@ class DataLoader:
     def __init__(self):
         self._destinations_cache = None
         self._customers_cache = None
+        self._destination_coords_cache = None
+        self._catalog_cache = None
+        self._reservations_cache = None
         self._data_dir = os.path.dirname(os.path.abspath(__file__))
+        # キャッシュをクリアするたびに増える（応答キャッシュのキーに使う）
+        self.version = 1
     
     def load_destinations(self) -> List[Dict]:
         """沖縄県観光地データを読み込み"""
@@ -46,6 +56,8 @@ class DataLoader:
                     dest['barrier_free'] = to_bool(dest.get('barrier_free'))
                 if 'stroller_friendly' in dest:
                     dest['stroller_friendly'] = to_bool(dest.get('stroller_friendly'))
+                # 雨天時の屋内代替地（空欄は None）
+                dest['rain_alt_id'] = dest.get('rain_alt_id') or None
         
         return self._destinations_cache
     
@@ -65,6 +77,76 @@ class DataLoader:
         
         return self._customers_cache
     
+    def load_catalog_items(self) -> List[Dict]:
+        """カタログ（飲食店・アクティビティ）データを読み込み（FastAPI 側 catalog_items の初期データと共通）"""
+        if self._catalog_cache is None:
+            def to_int(v):
+                try:
+                    return int(v)
+                except Exception:
+                    return None
+            def to_float(v):
+                try:
+                    return float(v)
+                except Exception:
+                    return None
+            self._catalog_cache = []
+            for item in self._load_csv('catalog_items.csv'):
+                self._catalog_cache.append({
+                    'id': item.get('id'),
+                    'name': item.get('name'),
+                    'type': item.get('type'),
+                    'duration_min': to_int(item.get('duration_min')) or 0,
+                    'price_min': to_int(item.get('price_min')) or 0,
+                    'age_limit': to_int(item.get('age_limit')),
+                    'booking_required': to_int(item.get('booking_required')) or 0,
+                    'rain_alt_id': item.get('rain_alt_id') or None,
+                    'lat': to_float(item.get('lat')),
+                    'lng': to_float(item.get('lng')),
+                    'category': item.get('category') or None,
+                    'staff_pick': to_int(item.get('staff_pick')) or 0,
+                    'indoor': to_int(item.get('indoor')) or 0,
+                })
+        return self._catalog_cache
+
+    def get_catalog_restaurants(self) -> List[Dict]:
+        """座標付きの飲食店カタログ"""
+        return [
+            item for item in self.load_catalog_items()
+            if item['type'] == 'restaurant' and item['lat'] is not None and item['lng'] is not None
+        ]
+
+    def load_reservations(self) -> List[Dict]:
+        """予約データを読み込み（英語キーに正規化した項目を追加）"""
+        if self._reservations_cache is None:
+            self._reservations_cache = self._load_csv('reservation_dummy_data.csv')
+            for r in self._reservations_cache:
+                r['reservation_id'] = r.get('予約ID')
+                r['customer_id'] = r.get('顧客ID')
+                r['status'] = r.get('予約ステータス')
+                r['check_in'] = r.get('チェックイン日時')
+                r['check_out'] = r.get('チェックアウト日時')
+                try:
+                    r['nights'] = int(r.get('滞在予定日数'))
+                except Exception:
+                    r['nights'] = None
+        return self._reservations_cache
+
+    def get_reservation_by_id(self, reservation_id: str) -> Optional[Dict]:
+        """予約IDから予約を取得"""
+        for r in self.load_reservations():
+            if r['reservation_id'] == reservation_id:
+                return r
+        return None
+
+    def get_reservation_for_customer(self, customer_id: str) -> Optional[Dict]:
+        """顧客の有効な（キャンセル以外の）予約のうちチェックインが最も新しいもの"""
+        active = [
+            r for r in self.load_reservations()
+            if r['customer_id'] == customer_id and r['status'] != 'キャンセル'
+        ]
+        return max(active, key=lambda r: r['check_in'] or '') if active else None
+
     def get_customer_by_id(self, customer_id: str) -> Optional[Dict]:
         """顧客IDから顧客情報を取得"""
         customers = self.load_customers()
@@ -101,6 +183,26 @@ class DataLoader:
                 return dest
         return None
     
+    def get_destination_coordinates(self) -> List[Tuple[float, float]]:
+        """全観光地の (longitude, latitude) 一覧（load_destinations と同順、キャッシュ付き）"""
+        if self._destination_coords_cache is None:
+            self._destination_coords_cache = [
+                (float(d.get('longitude') or 0), float(d.get('latitude') or 0))
+                for d in self.load_destinations()
+            ]
+        return self._destination_coords_cache
+
+    def find_destinations_near(self, longitude: float, latitude: float,
+                               radius_km: float) -> List[Tuple[Dict, float]]:
+        """指定地点から radius_km 以内の観光地を (観光地, 距離km) の近い順で返す"""
+        destinations = self.load_destinations()
+        if not destinations:
+            return []
+        distances = distances_from_km((longitude, latitude), self.get_destination_coordinates())
+        nearby = [(destinations[i], float(d)) for i, d in enumerate(distances) if d <= radius_km]
+        nearby.sort(key=lambda x: x[1])
+        return nearby
+
     def _load_csv(self, filename: str) -> List[Dict]:
         """CSVファイルを読み込み（data/ディレクトリ内）"""
         filepath = os.path.join(self._data_dir, filename)
@@ -120,10 +222,10 @@ class DataLoader:
                         cleaned_row[cleaned_key] = value.strip() if value else value
                     data.append(cleaned_row)
         except FileNotFoundError:
-            print(f"警告: ファイルが見つかりません: {filepath}")
+            log_event(logger, logging.WARNING, 'data.file_not_found', path=filepath)
             return []
         except Exception as e:
-            print(f"エラー: ファイル読み込み失敗: {filepath}, {e}")
+            log_event(logger, logging.ERROR, 'data.load_failed', path=filepath, error=str(e))
             return []
         
         return data
@@ -132,6 +234,10 @@ class DataLoader:
         """キャッシュをクリア"""
         self._destinations_cache = None
         self._customers_cache = None
+        self._destination_coords_cache = None
+        self._catalog_cache = None
+        self._reservations_cache = None
+        self.version += 1
 
 # シングルトンインスタンス
 data_loader = DataLoader()
@@ -0,0 +1,208 @@
+"""
+OpenAI 互換 Chat Completions のローカル代替サーバー（LLM 再ランキングの検証・負荷試験用）
+実際の API を使わずに、応答時間のばらつき・エラー・壊れた JSON・存在しない ID を再現する
+
+使い方（backend ディレクトリで）:
+    python llm_stub_server.py --port 5900 --latency-ms 800 --jitter 0.4 --model-latency gpt-4o=1600 \
+        --error-rate 0.05 --malformed-rate 0.02 --unknown-id-rate 0.02
+    OPENAI_API_KEY=stub OPENAI_BASE_URL=http://127.0.0.1:5900/v1 python start_server.py
+
+- 応答時間: 対数正規分布（中央値 --latency-ms、ばらつき --jitter）。モデルごとに中央値を変更可能
+- stream=true（SSE）と、一括再ランキングの requests[] 形式にも対応
+- GET /stats で受けたリクエスト数などを返す
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+
+class StubConfig:
+    """応答の振る舞いの設定"""
+
+    def __init__(self, latency_ms: float = 800.0, jitter: float = 0.4,
+                 model_latency: Optional[Dict[str, float]] = None, error_rate: float = 0.0,
+                 malformed_rate: float = 0.0, unknown_id_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.model_latency = model_latency or {}
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.unknown_id_rate = unknown_id_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'streams': 0, 'errors': 0, 'malformed': 0, 'unknown_ids': 0}
+
+    def draw(self, model: str) -> Dict:
+        """1リクエスト分の応答時間と異常の有無を決める"""
+        with self.lock:
+            median = self.model_latency.get(model, self.latency_ms)
+            return {
+                'latency_s': median * self.random.lognormvariate(0.0, self.jitter) / 1000 if self.jitter else median / 1000,
+                'error': self.random.random() < self.error_rate,
+                'malformed': self.random.random() < self.malformed_rate,
+                'unknown_id': self.random.random() < self.unknown_id_rate,
+            }
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.stats[name] += 1
+
+
+def rank_request(req: Dict, unknown_id: bool) -> Dict:
+    """候補を受け取った順（ルールベースのスコア順）のまま top_k 件を ranked にする"""
+    ids = [c.get('i') or c.get('id') for c in req.get('candidates', [])]
+    top_k = int(req.get('top_k') or 10)
+    ranked = [
+        {'id': cid, 'score': round(1.0 - i * 0.05, 3), 'reasons': ['stub']}
+        for i, cid in enumerate(ids[:top_k])
+    ]
+    if unknown_id and ranked:
+        ranked[0]['id'] = 'UNKNOWN-ID'
+    return {'ranked': ranked, 'rejected': [{'id': cid, 'reasons': ['below_top_k']} for cid in ids[top_k:]]}
+
+
+def build_content(body: Dict, draw: Dict) -> str:
+    """応答メッセージの本文（JSON 文字列）"""
+    try:
+        user = json.loads(body['messages'][-1]['content'])
+    except (KeyError, IndexError, TypeError, ValueError):
+        user = {}
+    if 'requests' in user:
+        out = {'results': [{'key': req.get('key'), **rank_request(req, draw['unknown_id'] and i == 0)}
+                           for i, req in enumerate(user['requests'])]}
+    else:
+        out = {**rank_request(user, draw['unknown_id']), 'meta': {'model': body.get('model')}}
+    content = json.dumps(out, ensure_ascii=False)
+    if draw['malformed']:
+        # 途中で切れた JSON
+        content = content[:max(1, len(content) // 2)]
+    return content
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config: StubConfig = StubConfig()
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            with self.config.lock:
+                self._send_json(200, dict(self.config.stats))
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'not found'}})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': {'message': 'invalid JSON body'}})
+            return
+        config = self.config
+        config.count('requests')
+        draw = config.draw(body.get('model', ''))
+        if draw['error']:
+            config.count('errors')
+            time.sleep(draw['latency_s'] / 4)
+            self._send_json(500, {'error': {'message': 'stub: injected server error'}})
+            return
+        if draw['malformed']:
+            config.count('malformed')
+        if draw['unknown_id']:
+            config.count('unknown_ids')
+        content = build_content(body, draw)
+
+        if body.get('stream'):
+            config.count('streams')
+            self._stream(content, draw['latency_s'])
+            return
+        time.sleep(draw['latency_s'])
+        self._send_json(200, {
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        })
+
+    def _stream(self, content: str, latency_s: float) -> None:
+        """SSE で本文を少しずつ返す（最初の断片まで応答時間の3割、残りを均等に）"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        pieces: List[str] = [content[i:i + 24] for i in range(0, len(content), 24)] or ['']
+        time.sleep(latency_s * 0.3)
+        step = latency_s * 0.7 / len(pieces)
+        try:
+            for piece in pieces:
+                event = {'choices': [{'index': 0, 'delta': {'content': piece}}]}
+                self._chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+                time.sleep(step)
+            self._chunk('data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _chunk(self, text: str) -> None:
+        data = text.encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send_json(self, status: int, payload: Dict) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_model_latency(values: List[str]) -> Dict[str, float]:
+    out = {}
+    for value in values:
+        model, _, ms = value.partition('=')
+        out[model] = float(ms)
+    return out
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='OpenAI 互換 Chat Completions のローカル代替サーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5900)
+    parser.add_argument('--latency-ms', type=float, default=800.0, help='応答時間の中央値[ms]')
+    parser.add_argument('--jitter', type=float, default=0.4, help='対数正規分布の sigma（0 で固定）')
+    parser.add_argument('--model-latency', action='append', default=[], metavar='MODEL=MS',
+                        help='モデルごとの応答時間の中央値（複数指定可）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='HTTP 500 を返す割合')
+    parser.add_argument('--malformed-rate', type=float, default=0.0, help='途中で切れた JSON を返す割合')
+    parser.add_argument('--unknown-id-rate', type=float, default=0.0, help='候補に無い ID を混ぜる割合')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    StubHandler.config = StubConfig(
+        latency_ms=args.latency_ms, jitter=args.jitter, model_latency=parse_model_latency(args.model_latency),
+        error_rate=args.error_rate, malformed_rate=args.malformed_rate,
+        unknown_id_rate=args.unknown_id_rate, seed=args.seed,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    print(f"LLM stub: http://{args.host}:{args.port}/v1 (OPENAI_BASE_URL に指定)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
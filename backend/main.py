@@ -1,41 +1,81 @@
 import os
 import random
 import sqlite3
-import csv
 import json
+import logging
+import time
 from typing import List, Optional
-from urllib.request import urlopen
-from urllib.parse import urlencode
 
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from typing import Optional
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse
+
+from app import create_app
+from data.data_loader import data_loader
+from services.photo_service import photo_service
+from utils.async_http import http_pool
+from utils.http_cache import PreparedBody, etag_matches, negotiate, response_cache
+from utils.migrations import migrate
+from utils.sqlite_pool import SQLitePool
+from utils.telemetry import REQUEST_ID_HEADER, begin_request, end_request, get_logger, log_event, server_timing
+from utils.weather_cache import weather_cache
+from utils.wsgi_bridge import WSGIBridge
 
 APP_DIR = os.path.dirname(__file__)
-ROOT_DIR = os.path.dirname(APP_DIR)
 # Store SQLite DB under instance/ so it's outside source control and suitable for local envs
 INSTANCE_DIR = os.path.join(APP_DIR, "instance")
 os.makedirs(INSTANCE_DIR, exist_ok=True)
 DB_PATH = os.path.join(INSTANCE_DIR, "app.db")
+# Pooled WAL connections; queries run on the pool's threads so handlers never block the event loop
+db = SQLitePool(DB_PATH)
+# Bumped whenever init_db (the only writer) migrates the database; part of the response cache key
+catalog_version = 0
 
 app = FastAPI(title="Itinerary Demo API")
-def _lookup_display_name(customer_id: str) -> Optional[str]:
-    """Lookup display name from CSV (姓+名)。"""
-    try:
-        csv_path = os.path.join(ROOT_DIR, "data", "customer.csv")
-        if os.path.exists(csv_path):
-            with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
-                reader = csv.DictReader(f)
-                for r in reader:
-                    if (r.get("顧客ID") or "").strip() == customer_id:
-                        last = (r.get("姓") or "").strip()
-                        first = (r.get("名") or "").strip()
-                        if last and first:
-                            return f"{last}{first}"
-                        return last or first or None
-    except Exception:
-        return None
-    return None
+# Flask API served from this process at /api, sharing data_loader, caches and pools with the routes below.
+# Built on startup rather than at import, so importing this module doesn't start the OSRM warm-up.
+flask_api = WSGIBridge(lambda: create_app(url_prefix=""))
+logger = get_logger("fastapi")
+
+def _display_name(row: dict) -> Optional[str]:
+    """Display name (姓+名) of a customer.csv row."""
+    last = (row.get("姓") or "").strip()
+    first = (row.get("名") or "").strip()
+    if last and first:
+        return f"{last}{first}"
+    return last or first or None
+
+
+def _customer_rows() -> List[tuple]:
+    """Rows for the customers table: (id, adults, children, seniors, stroller, wheelchair, display_name).
+    Built from the data loader's parsed customer.csv, the same records the /api routes serve."""
+    rows = []
+    for row in data_loader.load_customers():
+        cid = row.get("顧客ID") or row.get("GUEST_ID")
+        if not cid:
+            continue
+        age = int(row.get("年齢") or 0)
+        seniors = 1 if age >= 65 else 0
+        # parse 同行者情報 JSON string
+        children = 0
+        try:
+            comp = row.get("同行者情報") or ""
+            if comp:
+                data = json.loads(comp)
+                children = sum(1 for c in data if (c.get("relationship") == "child"))
+                # partner counts as adult
+                adults = 1 + sum(1 for c in data if (c.get("relationship") == "partner"))
+            else:
+                adults = 1
+        except Exception:
+            adults = 1
+        # stroller/wheelchair flags (heuristic)
+        notes = row.get("特記事項") or ""
+        stroller = 1 if ("ベビーカー" in notes) else 0
+        wheelchair = 1 if ("車椅子" in notes or "車いす" in notes) else 0
+        rows.append((cid.strip(), adults, children, seniors, stroller, wheelchair, _display_name(row)))
+    return rows
 
 
 app.add_middleware(
@@ -47,6 +87,27 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """Assign a request id (propagated via X-Request-ID) and emit spans like the Flask blueprint."""
+    if request.url.path.startswith("/api/"):
+        # served by the mounted Flask app, which assigns the request id and logs on its own
+        return await call_next(request)
+    request_id = begin_request(request.headers.get(REQUEST_ID_HEADER))
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        spans = end_request()
+    response.headers[REQUEST_ID_HEADER] = request_id
+    if spans:
+        response.headers["Server-Timing"] = server_timing(spans)
+    log_event(logger, logging.INFO, "http.request", request_id=request_id,
+              method=request.method, path=request.url.path, status=response.status_code,
+              ms=round((time.perf_counter() - started) * 1000, 2), spans=spans)
+    return response
+
+
 def ensure_catalog_columns(conn: sqlite3.Connection) -> None:
     cols = {row[1] for row in conn.execute("PRAGMA table_info(catalog_items)")}
     def add(col: str, ddl: str):
@@ -59,96 +120,112 @@ def ensure_catalog_columns(conn: sqlite3.Connection) -> None:
     add("indoor", "indoor INTEGER NOT NULL DEFAULT 0")
 
 
-def init_db() -> None:
-    os.makedirs(APP_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS catalog_items (
-              id TEXT PRIMARY KEY,
-              name TEXT NOT NULL,
-              type TEXT NOT NULL,
-              duration_min INTEGER NOT NULL,
-              price_min INTEGER NOT NULL,
-              age_limit INTEGER,
-              booking_required INTEGER NOT NULL DEFAULT 0,
-              rain_alt_id TEXT
-            );
-            """
+# Schema migrations, applied in order and recorded in PRAGMA user_version (see utils/migrations.py).
+# Append new steps; never edit or reorder applied ones. The first two also bring databases created
+# before versioning (user_version 0, tables already present) up to date, hence IF NOT EXISTS.
+
+def migrate_001_catalog_items(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS catalog_items (
+          id TEXT PRIMARY KEY,
+          name TEXT NOT NULL,
+          type TEXT NOT NULL,
+          duration_min INTEGER NOT NULL,
+          price_min INTEGER NOT NULL,
+          age_limit INTEGER,
+          booking_required INTEGER NOT NULL DEFAULT 0,
+          rain_alt_id TEXT
+        );
+        """
+    )
+    ensure_catalog_columns(conn)
+    # seed if empty
+    (count,) = conn.execute("SELECT COUNT(*) FROM catalog_items").fetchone()
+    if count == 0:
+        conn.executemany(
+            "INSERT INTO catalog_items (id,name,type,duration_min,price_min,age_limit,booking_required,rain_alt_id,lat,lng,category,staff_pick,indoor) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            [
+                (i["id"], i["name"], i["type"], i["duration_min"], i["price_min"], i["age_limit"], i["booking_required"],
+                 i["rain_alt_id"], i["lat"], i["lng"], i["category"], i["staff_pick"], i["indoor"])
+                for i in data_loader.load_catalog_items()
+            ],
         )
-        ensure_catalog_columns(conn)
-        # seed if empty
-        cur = conn.execute("SELECT COUNT(*) FROM catalog_items")
-        (count,) = cur.fetchone()
-        if count == 0:
-            items = [
-                ("r001", "沖縄そば処", "restaurant", 60, 1200, None, 0, None, 26.212, 127.679, "restaurant", 0, 1),
-                ("a001", "首里城散策", "activity", 90, 0, None, 0, None, 26.217, 127.719, "sightseeing", 0, 0),
-                ("a002", "美ら海水族館", "activity", 120, 2180, None, 1, None, 26.694, 127.877, "aquarium", 1, 1),
-                ("r002", "海辺のカフェ", "restaurant", 45, 900, None, 0, None, 26.300, 127.800, "cafe", 0, 1),
-            ]
-            conn.executemany(
-                "INSERT INTO catalog_items (id,name,type,duration_min,price_min,age_limit,booking_required,rain_alt_id,lat,lng,category,staff_pick,indoor) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                items,
-            )
-            conn.commit()
-
-        # customers
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS customers (
-              id TEXT PRIMARY KEY,
-              adults INTEGER,
-              children INTEGER,
-              seniors INTEGER,
-              stroller INTEGER,
-              wheelchair INTEGER
-            )
-            """
+
+
+def migrate_002_customers(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS customers (
+          id TEXT PRIMARY KEY,
+          adults INTEGER,
+          children INTEGER,
+          seniors INTEGER,
+          stroller INTEGER,
+          wheelchair INTEGER,
+          display_name TEXT
         )
-        # try seed from data/customer.csv if empty
-        (ccount,) = conn.execute("SELECT COUNT(*) FROM customers").fetchone()
-        if ccount == 0:
-            csv_path = os.path.join(ROOT_DIR, "data", "customer.csv")
-            if os.path.exists(csv_path):
-                with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
-                    reader = csv.DictReader(f)
-                    rows = []
-                    for row in reader:
-                        cid = row.get("顧客ID") or row.get("GUEST_ID")
-                        if not cid:
-                            continue
-                        age = int(row.get("年齢") or 0)
-                        seniors = 1 if age >= 65 else 0
-                        # parse 同行者情報 JSON string
-                        children = 0
-                        try:
-                            comp = row.get("同行者情報") or ""
-                            if comp:
-                                data = json.loads(comp)
-                                children = sum(1 for c in data if (c.get("relationship") == "child"))
-                                # partner counts as adult
-                                adults = 1 + sum(1 for c in data if (c.get("relationship") == "partner"))
-                            else:
-                                adults = 1
-                        except Exception:
-                            adults = 1
-                        # stroller/wheelchair flags (heuristic)
-                        notes = row.get("特記事項") or ""
-                        stroller = 1 if ("ベビーカー" in notes) else 0
-                        wheelchair = 1 if ("車椅子" in notes or "車いす" in notes) else 0
-                        rows.append((cid, adults, children, seniors, stroller, wheelchair))
-                    if rows:
-                        conn.executemany("INSERT OR REPLACE INTO customers (id,adults,children,seniors,stroller,wheelchair) VALUES (?,?,?,?,?,?)", rows)
-                        conn.commit()
-    finally:
-        conn.close()
+        """
+    )
+    if "display_name" not in {row[1] for row in conn.execute("PRAGMA table_info(customers)")}:
+        conn.execute("ALTER TABLE customers ADD COLUMN display_name TEXT")
+    # seed from data/customer.csv if empty; fill in display names missing from older databases
+    (ccount,) = conn.execute("SELECT COUNT(*) FROM customers").fetchone()
+    rows = _customer_rows()
+    if ccount == 0:
+        conn.executemany("INSERT OR REPLACE INTO customers (id,adults,children,seniors,stroller,wheelchair,display_name) VALUES (?,?,?,?,?,?,?)", rows)
+    else:
+        conn.executemany("UPDATE customers SET display_name = ? WHERE id = ? AND display_name IS NULL",
+                         [(r[6], r[0]) for r in rows if r[6]])
+
+
+MIGRATIONS = [
+    migrate_001_catalog_items,
+    migrate_002_customers,
+]
+
+
+def init_db() -> None:
+    """Apply pending migrations; when the schema is current this is a single user_version read."""
+    global catalog_version
+    with db.connection() as conn:
+        before, after = migrate(conn, MIGRATIONS)
+    if after != before:
+        catalog_version += 1
+
+
+def load_customer(customer_id: str) -> dict:
+    """Customer profile from DB (defaults when missing), one primary-key lookup. Blocking; call via db.run."""
+    row = db.fetchone("SELECT * FROM customers WHERE id = ?", (customer_id,))
+    if not row:
+        return {"id": customer_id, "adults": 2, "children": 0, "seniors": 0, "stroller": False, "wheelchair": False, "displayName": None}
+    return {
+        "id": row["id"],
+        "adults": row["adults"],
+        "children": row["children"],
+        "seniors": row["seniors"],
+        "stroller": bool(row["stroller"]),
+        "wheelchair": bool(row["wheelchair"]),
+        "displayName": row["display_name"],
+    }
+
+
+def prepared_response(request: Request, prepared: PreparedBody) -> Response:
+    """Serialized JSON with a strong ETag: 304 on If-None-Match, compressed when large."""
+    result = negotiate(prepared, request.headers.get("if-none-match"), request.headers.get("accept-encoding"))
+    return Response(content=result["body"], status_code=result["status"], headers=result["headers"],
+                    media_type="application/json")
 
 
 @app.on_event("startup")
 async def on_startup():
-    init_db()
+    await db.run(init_db)
+    flask_api.load()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    db.close()
 
 
 @app.get("/healthz")
@@ -158,105 +235,66 @@ async def healthz():
 
 @app.get("/catalog/items")
 async def get_catalog_items(
+    request: Request,
     type: Optional[str] = Query(None, description="restaurant|activity|hotel"),
     q: Optional[str] = Query(None, description="keyword"),
 ):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        sql = "SELECT * FROM catalog_items"
-        params: List[object] = []
-        conds: List[str] = []
-        if type:
-            conds.append("type = ?")
-            params.append(type)
-        if q:
-            conds.append("(name LIKE ?)")
-            params.append(f"%{q}%")
-        if conds:
-            sql += " WHERE " + " AND ".join(conds)
-        sql += " ORDER BY id"
-        rows = conn.execute(sql, params).fetchall()
-        def to_camel(r: sqlite3.Row):
-            return {
-                "id": r["id"],
-                "name": r["name"],
-                "type": r["type"],
-                "durationMin": r["duration_min"],
-                "priceMin": r["price_min"],
-                "ageLimit": r["age_limit"],
-                "bookingRequired": bool(r["booking_required"]),
-                "rainAltId": r["rain_alt_id"],
-                "lat": r["lat"],
-                "lng": r["lng"],
-                "category": r["category"],
-                "staffPick": bool(r["staff_pick"]),
-                "indoor": bool(r["indoor"]),
-            }
-        return [to_camel(r) for r in rows]
-    finally:
-        conn.close()
+    # Catalog only changes at startup, so the serialized list is reused until init_db runs again
+    key = ("catalog", catalog_version, type, q)
+    prepared = response_cache.get(key)
+    if prepared is not None:
+        return prepared_response(request, prepared)
+    sql = "SELECT * FROM catalog_items"
+    params: List[object] = []
+    conds: List[str] = []
+    if type:
+        conds.append("type = ?")
+        params.append(type)
+    if q:
+        conds.append("(name LIKE ?)")
+        params.append(f"%{q}%")
+    if conds:
+        sql += " WHERE " + " AND ".join(conds)
+    sql += " ORDER BY id"
+    rows = await db.afetchall(sql, params)
+    def to_camel(r: sqlite3.Row):
+        return {
+            "id": r["id"],
+            "name": r["name"],
+            "type": r["type"],
+            "durationMin": r["duration_min"],
+            "priceMin": r["price_min"],
+            "ageLimit": r["age_limit"],
+            "bookingRequired": bool(r["booking_required"]),
+            "rainAltId": r["rain_alt_id"],
+            "lat": r["lat"],
+            "lng": r["lng"],
+            "category": r["category"],
+            "staffPick": bool(r["staff_pick"]),
+            "indoor": bool(r["indoor"]),
+        }
+    return prepared_response(request, response_cache.put(key, [to_camel(r) for r in rows]))
 
 
 @app.get("/customers/{customer_id}")
 async def get_customer(customer_id: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        row = conn.execute("SELECT * FROM customers WHERE id = ?", (customer_id,)).fetchone()
-
-        display_name: Optional[str] = _lookup_display_name(customer_id)
-
-        if not row:
-            return {"id": customer_id, "adults": 2, "children": 0, "seniors": 0, "stroller": False, "wheelchair": False, "displayName": display_name}
-        return {
-            "id": row["id"],
-            "adults": row["adults"],
-            "children": row["children"],
-            "seniors": row["seniors"],
-            "stroller": bool(row["stroller"]),
-            "wheelchair": bool(row["wheelchair"]),
-            "displayName": display_name,
-        }
-    finally:
-        conn.close()
+    return await db.run(load_customer, customer_id)
 
 
 @app.get("/customers/random")
 async def get_random_customer():
     """Return a random customer id C001..C100 (no CSV dependency) and enrich from DB/CSV."""
     chosen = f"C{random.randint(1,100):03d}"
-    # 2) reuse get_customer logic
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        row = conn.execute("SELECT * FROM customers WHERE id = ?", (chosen,)).fetchone()
-        display_name: Optional[str] = _lookup_display_name(chosen)
-        if not row:
-            return {"id": chosen, "adults": 2, "children": 0, "seniors": 0, "stroller": False, "wheelchair": False, "displayName": display_name}
-        return {
-            "id": row["id"],
-            "adults": row["adults"],
-            "children": row["children"],
-            "seniors": row["seniors"],
-            "stroller": bool(row["stroller"]),
-            "wheelchair": bool(row["wheelchair"]),
-            "displayName": display_name,
-        }
-    finally:
-        conn.close()
+    return await db.run(load_customer, chosen)
 
 
-@app.get("/weather/current")
-async def weather_current(lat: float = 26.212, lon: float = 127.679):
+async def _fetch_weather(lat: float, lon: float) -> dict:
     params = {
         "latitude": lat,
         "longitude": lon,
         "current": "temperature_2m,relative_humidity_2m,precipitation"
     }
-    url = "https://api.open-meteo.com/v1/forecast?" + urlencode(params)
-    with urlopen(url) as resp:
-        data = json.loads(resp.read().decode("utf-8"))
+    data = await http_pool.get_json("https://api.open-meteo.com/v1/forecast", params)
     cur = data.get("current", {})
     temp = cur.get("temperature_2m")
     humidity = cur.get("relative_humidity_2m")
@@ -270,46 +308,55 @@ async def weather_current(lat: float = 26.212, lon: float = 127.679):
     return {"temperatureC": temp, "humidity": humidity, "raining": raining, "feelsIcon": feel}
 
 
-@app.get("/media/photo")
-async def media_photo(query: str):
-    # 1) Try Openverse (no key)
+@app.get("/weather/current")
+async def weather_current(response: Response, lat: float = 26.212, lon: float = 127.679):
+    # Cached per rounded lat/lon bucket; stale entries are served while a refresh runs in the background
     try:
-        oparams = {"q": query, "page_size": 1}
-        ourl = "https://api.openverse.engineering/v1/images/?" + urlencode(oparams)
-        with urlopen(ourl) as resp:
-            odata = json.loads(resp.read().decode("utf-8"))
-        results = odata.get("results") or []
-        if results:
-            first = results[0]
-            url = first.get("thumbnail") or first.get("url")
-            if url:
-                return {"url": url}
-    except Exception:
-        pass
-
-    # 2) Fallback to Wikipedia (ja -> en)
-    def search(lang: str) -> Optional[str]:
-        api = f"https://{lang}.wikipedia.org/w/api.php"
-        q = {
-            "action": "query",
-            "generator": "search",
-            "gsrsearch": query,
-            "gsrlimit": 1,
-            "prop": "pageimages",
-            "piprop": "thumbnail",
-            "pithumbsize": 160,
-            "format": "json",
-            "origin": "*",
-        }
-        url = api + "?" + urlencode(q)
-        with urlopen(url) as resp:
-            data = json.loads(resp.read().decode("utf-8"))
-        pages = (data.get("query", {}) or {}).get("pages", {})
-        for _, p in pages.items():
-            thumb = (p.get("thumbnail") or {}).get("source")
-            if thumb:
-                return thumb
-        return None
-
-    wurl = search("ja") or search("en")
-    return {"url": wurl}
+        payload, state = await weather_cache.get(lat, lon, _fetch_weather)
+    except Exception as e:
+        log_event(logger, logging.WARNING, "weather.upstream_failed", error=repr(e))
+        raise HTTPException(status_code=502, detail="weather upstream unavailable")
+    response.headers["X-Cache"] = state
+    return payload
+
+
+@app.get("/weather/cache")
+async def weather_cache_stats():
+    return weather_cache.stats()
+
+
+@app.get("/media/photo")
+async def media_photo(query: str, request: Request):
+    # Cached query -> URL (misses included); on a cache miss all sources are searched at once
+    found = await photo_service.lookup(query)
+    url = found["url"]
+    if url and photo_service.proxy_enabled:
+        key = await photo_service.register_thumb(url)
+        return {"url": str(request.url_for("media_thumb", key=key)), "sourceUrl": url}
+    return {"url": url}
+
+
+@app.get("/media/thumb/{key}", name="media_thumb")
+async def media_thumb(key: str, request: Request):
+    """Locally stored copy of a registered photo, cached by browsers until the next upstream revalidation."""
+    thumb = await photo_service.thumbnail(key)
+    if thumb is None:
+        raise HTTPException(status_code=404, detail="thumbnail not found")
+    # The stored copy can change when it is revalidated upstream, so browsers recheck on the same schedule
+    headers = {
+        "Cache-Control": f"public, max-age={int(photo_service.revalidate_seconds)}",
+        "ETag": f'"{thumb["digest"]}"',
+    }
+    if thumb["last_modified"]:
+        headers["Last-Modified"] = thumb["last_modified"]
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(thumb["path"], media_type=thumb["content_type"], headers=headers)
+
+
+@app.get("/media/cache")
+async def media_cache_stats():
+    return photo_service.stats()
+
+
+app.mount("/api", flask_api)
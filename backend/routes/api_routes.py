@@ -3,14 +3,26 @@ APIルーティング定義
 実際の処理はservicesパッケージに分離
 """
 
-from flask import Blueprint, request, jsonify
+import json
+import logging
+import time
+from flask import Blueprint, Response, request, jsonify, g, stream_with_context
 from services.destination_service import DestinationService
 from services.route_service import RouteService
 from services.itinerary_service import ItineraryService
 from services.llm_reranker import LLMReranker, SUGGEST_SCHEMA
+from services.hotel_service import hotel_service
+from services.trip_planner import trip_planner
+from services.plan_pipeline import plan_pipeline
+from services.rain_plan_service import rain_plan_service
 from data.data_loader import data_loader
+from utils.http_cache import PreparedBody, negotiate, response_cache
+from utils.telemetry import (
+    REQUEST_ID_HEADER, begin_request, end_request, get_logger, log_event, server_timing, span,
+)
 
 api_bp = Blueprint('api', __name__)
+logger = get_logger('api')
 
 # サービスインスタンス
 destination_service = DestinationService()
@@ -18,6 +30,44 @@ route_service = RouteService()
 itinerary_service = ItineraryService()
 llm_reranker = LLMReranker()
 
+@api_bp.before_request
+def _begin_request_context():
+    """リクエストIDを採番（上流から X-Request-ID があれば引き継ぐ）"""
+    g.request_id = begin_request(request.headers.get(REQUEST_ID_HEADER))
+    g.request_started = time.perf_counter()
+
+def _apply_http_cache(response):
+    """GET の JSON 応答に ETag を付け、If-None-Match なら 304、大きければ圧縮"""
+    if (request.method != 'GET' or response.status_code != 200 or response.mimetype != 'application/json'
+            or response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    prepared = g.get('prepared_body') or PreparedBody(response.get_data())
+    result = negotiate(prepared, request.headers.get('If-None-Match'), request.headers.get('Accept-Encoding'))
+    response.status_code = result['status']
+    response.set_data(result['body'])
+    response.headers.update(result['headers'])
+    return response
+
+def _prepared_json(key, build):
+    """変わらない応答をシリアライズ済みのまま返す（ETag・圧縮は after_request で付与）"""
+    prepared = response_cache.get_or_build(key, build)
+    g.prepared_body = prepared
+    return Response(prepared.body, mimetype='application/json')
+
+@api_bp.after_request
+def _end_request_context(response):
+    """スパンを Server-Timing ヘッダとアクセスログに出力"""
+    response = _apply_http_cache(response)
+    spans = end_request()
+    response.headers[REQUEST_ID_HEADER] = g.get('request_id', '')
+    if spans:
+        response.headers['Server-Timing'] = server_timing(spans)
+    log_event(logger, logging.INFO, 'http.request', request_id=g.get('request_id'),
+              method=request.method, path=request.script_root + request.path, status=response.status_code,
+              ms=round((time.perf_counter() - g.get('request_started', time.perf_counter())) * 1000, 2),
+              spans=spans)
+    return response
+
 @api_bp.route('/destinations', methods=['GET'])
 def get_destinations():
     """候補地取得API"""
@@ -31,6 +81,10 @@ def get_destinations():
             budget_yen = int(budget_yen) if budget_yen is not None else None
         except Exception:
             budget_yen = None
+        try:
+            origin = (float(request.args['origin_lon']), float(request.args['origin_lat']))
+        except (KeyError, ValueError):
+            origin = None
         
         if not customer_id:
             return jsonify({
@@ -43,7 +97,8 @@ def get_destinations():
             weather=weather,
             season=season,
             budget_yen=budget_yen,
-            crowd_avoid=crowd_avoid
+            crowd_avoid=crowd_avoid,
+            origin=origin
         )
         
         return jsonify(result)
@@ -54,6 +109,28 @@ def get_destinations():
             'message': f'エラーが発生しました: {str(e)}'
         }), 500
 
+@api_bp.route('/destinations/nearby', methods=['GET'])
+def get_nearby_destinations():
+    """周辺観光地検索API（直線距離）"""
+    try:
+        try:
+            lat = float(request.args['lat'])
+            lon = float(request.args['lon'])
+            radius_km = float(request.args.get('radius_km', 10))
+        except (KeyError, ValueError):
+            return jsonify({
+                'status': 'error',
+                'message': 'lat と lon が必要です'
+            }), 400
+        
+        return jsonify(destination_service.get_nearby_destinations(lat, lon, radius_km))
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
 @api_bp.route('/route', methods=['POST'])
 def get_route():
     """ルート取得API"""
@@ -69,7 +146,89 @@ def get_route():
         optimize = bool(data.get('optimize'))
         result = route_service.get_optimized_route(data['destinations']) if optimize else route_service.calculate_route(data['destinations'])
         
-        return jsonify(result)
+        with span('serialize'):
+            return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+@api_bp.route('/route/batch', methods=['POST'])
+def get_route_batch():
+    """複数プランのルート一括取得API
+    入力例:
+    {
+      "plans": [[{"destination_id":"START","latitude":26.3105,"longitude":127.7723}, {...}], [...]],
+      "include_geometry": false,
+      "stream": false
+    }
+    stream=true の場合は完了したプランから NDJSON で1行ずつ返す
+    """
+    try:
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('plans'), list):
+            return jsonify({
+                'status': 'error',
+                'message': 'plansが必要です'
+            }), 400
+        
+        plans = data['plans']
+        include_geometry = bool(data.get('include_geometry'))
+        
+        if data.get('stream'):
+            def generate():
+                for item in route_service.iter_routes_batch(plans, include_geometry=include_geometry):
+                    yield json.dumps(item, ensure_ascii=False) + '\n'
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+        result = route_service.calculate_routes_batch(plans, include_geometry=include_geometry)
+        with span('serialize'):
+            return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+@api_bp.route('/hotel', methods=['GET'])
+def get_hotel():
+    """ホテル設定と事前計算テーブルの状態API"""
+    return jsonify(hotel_service.get_hotel_info())
+
+@api_bp.route('/hotel/precompute', methods=['POST'])
+def precompute_hotel_table():
+    """ホテル⇔観光地の所要時間テーブルを再計算"""
+    try:
+        hotel_service.precompute(force=True)
+        return jsonify(hotel_service.get_hotel_info())
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+@api_bp.route('/reachable', methods=['GET'])
+def get_reachable_destinations():
+    """到達可能な観光地API
+    minutes: ホテルから片道 N 分以内
+    budget_minutes: 往路＋滞在＋復路が N 分以内（例: 半日=240）
+    """
+    try:
+        try:
+            minutes = float(request.args['minutes']) if 'minutes' in request.args else None
+            budget_minutes = float(request.args['budget_minutes']) if 'budget_minutes' in request.args else None
+        except ValueError:
+            return jsonify({
+                'status': 'error',
+                'message': 'minutes / budget_minutes は数値で指定してください'
+            }), 400
+        
+        result = hotel_service.find_reachable(minutes=minutes, budget_minutes=budget_minutes)
+        return jsonify(result), (200 if result['status'] == 'success' else 400)
     
     except Exception as e:
         return jsonify({
@@ -91,7 +250,8 @@ def test_osrm_connection():
             'message': 'OSRM接続テスト完了',
             'current_server': osrm_client.base_url,
             'available_servers': osrm_client.base_urls,
-            'connection_success': success
+            'connection_success': success,
+            'leg_cache': osrm_client.leg_cache.stats()
         })
     
     except Exception as e:
@@ -104,8 +264,10 @@ def test_osrm_connection():
 def list_customers():
     """顧客一覧API（CSV/DB由来）"""
     try:
-        customers = data_loader.load_customers()
-        return jsonify({ 'status': 'success', 'customers': customers })
+        return _prepared_json(
+            ('customers', data_loader.version),
+            lambda: { 'status': 'success', 'customers': data_loader.load_customers() },
+        )
     except Exception as e:
         return jsonify({ 'status': 'error', 'message': str(e) }), 500
 
@@ -135,13 +297,245 @@ def create_itinerary():
         start_time = data.get('start_time', '09:00')
         travel_date = data.get('travel_date', '2024-03-15')
         
-        result = itinerary_service.create_itinerary(
-            route=data['route'],
-            start_time=start_time,
-            travel_date=travel_date
+        if data.get('detailed'):
+            # 営業時間・食事枠を考慮した詳細旅程
+            result = itinerary_service.create_detailed_schedule(
+                route=data['route'],
+                preferences={
+                    'start_time': start_time,
+                    'travel_date': travel_date,
+                    'end_time': data.get('end_time'),
+                    'meals': bool(data.get('meals', True)),
+                    'repair': bool(data.get('repair', False)),
+                }
+            )
+        else:
+            result = itinerary_service.create_itinerary(
+                route=data['route'],
+                start_time=start_time,
+                travel_date=travel_date
+            )
+        
+        with span('serialize'):
+            return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+
+@api_bp.route('/itinerary/<plan_id>', methods=['GET'])
+def get_itinerary_plan(plan_id: str):
+    """保存済み旅程（detailed=true で作成したもの）の取得API"""
+    try:
+        result = itinerary_service.get_plan(plan_id)
+        if result['status'] != 'success':
+            return jsonify(result), 404
+        with span('serialize'):
+            return jsonify(result)
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+
+@api_bp.route('/itinerary/<plan_id>/rain', methods=['GET'])
+def get_rain_itinerary_plan(plan_id: str):
+    """
+    保存済み旅程の雨天版の取得API
+    屋外の観光地を屋内の代替地に差し替えた旅程（通常はバックグラウンドで作成済み。precomputed=false はこの場で作成したもの）
+    """
+    try:
+        result = rain_plan_service.get_rain_plan(plan_id)
+        if result['status'] != 'success':
+            return jsonify(result), 404 if result.get('error_code') == 'not_found' else 500
+        with span('serialize'):
+            return jsonify(result)
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+
+@api_bp.route('/itinerary/rain/switch', methods=['POST'])
+def switch_rain_itinerary_plans():
+    """
+    複数の旅程をまとめて雨天版に切り替えるAPI（雨が降り出したときの一斉切り替え用）
+    body: { "plan_ids": ["...", "..."] }
+    """
+    try:
+        data = request.get_json() or {}
+        plan_ids = data.get('plan_ids')
+        if not isinstance(plan_ids, list) or not plan_ids:
+            return jsonify({
+                'status': 'error',
+                'message': 'plan_idsが必要です'
+            }), 400
+        
+        result = rain_plan_service.switch_plans([str(p) for p in plan_ids])
+        with span('serialize'):
+            return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+
+@api_bp.route('/itinerary/<plan_id>/edit', methods=['POST'])
+def edit_itinerary_plan(plan_id: str):
+    """
+    旅程の単発編集API（影響のある後続部分だけ再計算し、イベント列への差分を返す）
+    body: { "version": 3, "edit": { "op": "shift", "index": 2, "minutes": 15 } }
+    op: shift（滞在/出発時刻の増減） | swap（index と with を入れ替え） | insert（destination_id を index に挿入） | delete
+    応答の patch は schedule[start:start+delete_count] を events で置き換える差分
+    """
+    try:
+        data = request.get_json() or {}
+        edit = data.get('edit')
+        if not isinstance(edit, dict):
+            return jsonify({
+                'status': 'error',
+                'message': 'editが必要です'
+            }), 400
+        
+        result = itinerary_service.edit_plan(plan_id, edit, version=data.get('version'))
+        if result['status'] != 'success':
+            code = {'not_found': 404, 'version_conflict': 409}.get(result.get('error_code'), 400)
+            return jsonify(result), code
+        
+        with span('serialize'):
+            return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+
+@api_bp.route('/itinerary/validate', methods=['POST'])
+def validate_itineraries():
+    """
+    旅程案の一括検証API
+    body: { "plans": [route, ...], "start_time": "09:00", "end_time": "18:00",
+            "meals": true, "repair": false }
+    各 route は /api/route の route（waypoints を含む）
+    """
+    try:
+        data = request.get_json() or {}
+        plans = data.get('plans')
+        if not isinstance(plans, list) or not plans:
+            return jsonify({
+                'status': 'error',
+                'message': 'plansが必要です'
+            }), 400
+        
+        result = itinerary_service.validate_plans(
+            plans,
+            start_time=data.get('start_time', '09:00'),
+            end_time=data.get('end_time'),
+            meals=bool(data.get('meals', True)),
+            repair=bool(data.get('repair', False))
         )
+        if result['status'] != 'success':
+            return jsonify(result), 400
         
-        return jsonify(result)
+        with span('serialize'):
+            return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+
+@api_bp.route('/trip/plan', methods=['POST'])
+def plan_trip():
+    """
+    複数日旅程API（予約のチェックイン〜チェックアウト全体を1回で作成）
+    body: { "reservation_id": "R005" | "customer_id": "C001",
+            "destination_ids": ["D001", ...]（省略時は推薦から選択）,
+            "day_start": "09:00", "day_end": "19:00", "include_geometry": false }
+    """
+    try:
+        data = request.get_json() or {}
+        if not data.get('reservation_id') and not data.get('customer_id'):
+            return jsonify({
+                'status': 'error',
+                'message': 'reservation_id または customer_id が必要です'
+            }), 400
+        destination_ids = data.get('destination_ids')
+        if destination_ids is not None and not isinstance(destination_ids, list):
+            return jsonify({
+                'status': 'error',
+                'message': 'destination_ids は配列で指定してください'
+            }), 400
+        
+        result = trip_planner.plan_trip(
+            reservation_id=data.get('reservation_id'),
+            customer_id=data.get('customer_id'),
+            destination_ids=destination_ids,
+            day_start=data.get('day_start', '09:00'),
+            day_end=data.get('day_end', '19:00'),
+            include_geometry=bool(data.get('include_geometry', False))
+        )
+        if result['status'] != 'success':
+            return jsonify(result), 400
+        
+        with span('serialize'):
+            return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+
+
+@api_bp.route('/plan', methods=['POST'])
+def build_plan():
+    """
+    プラン一括作成API（推薦 → 選定 → ルート → 旅程 をサーバー内で実行）
+    body: { "customer_id": "C001", "weather": "sunny", "season": "spring", "budget_yen": 3000,
+            "crowd_avoid": "mid", "limit": 10, "select": 3, "destination_ids": [...]（任意）,
+            "optimize": true, "start_time": "09:00", "end_time": "18:00", "travel_date": "2024-03-15",
+            "detailed": true, "stream": false }
+    stream=true の場合は段階ごとの結果を NDJSON で1行ずつ返す
+    """
+    try:
+        data = request.get_json() or {}
+        if data.get('destination_ids') is not None and not isinstance(data['destination_ids'], list):
+            return jsonify({
+                'status': 'error',
+                'message': 'destination_ids は配列で指定してください'
+            }), 400
+        # ストリームは最初の行を返した時点で 200 が確定するため、入力の誤りは先に 400 で返す
+        error = plan_pipeline.validate(data)
+        if error:
+            return jsonify({
+                'status': 'error',
+                'message': error
+            }), 400
+        
+        if data.get('stream'):
+            def generate():
+                for item in plan_pipeline.iter_stages(data):
+                    yield json.dumps(item, ensure_ascii=False) + '\n'
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+        result = plan_pipeline.run(data)
+        if result['status'] != 'success':
+            return jsonify(result), 400
+        
+        with span('serialize'):
+            return jsonify(result)
     
     except Exception as e:
         return jsonify({
@@ -200,8 +594,13 @@ def plan_suggest():
       "constraints": {"weather":"sunny","season":"summer","budget_yen":5000,"crowd_avoid":"mid"},
       "candidates": [ {"destination_id":"a001", ...}, ... ],
       "top_k": 10,
-      "model_profile": "cheap|balanced|quality"
+      "model_profile": "cheap|balanced|quality",
+      "deadline_ms": 3000,
+      "hedge": true,
+      "stream": false
     }
+    deadline_ms 以内に LLM の結果が得られなければルールベースの結果を返す（meta.fallback_reason に理由）
+    stream=true の場合は NDJSON で、ルールベースの結果を即座に返し、検証済みの LLM 結果が揃ったら続けて返す
     """
     try:
         data = request.get_json() or {}
@@ -215,22 +614,35 @@ def plan_suggest():
             return jsonify({ 'status': 'error', 'message': 'customer_id が必要です' }), 400
         if not candidates:
             # サーバ側で推薦TopNを補う: 既存エンジンからTop50を取得
-            base = destination_service.get_recommended_destinations(customer_id=customer_id, limit=50,
-                weather=constraints.get('weather') or 'sunny',
-                season=constraints.get('season') or 'spring',
-                budget_yen=constraints.get('budget_yen'),
-                crowd_avoid=constraints.get('crowd_avoid'))
+            base = destination_service.get_rerank_candidates(customer_id, constraints)
             if base.get('status') != 'success':
                 return jsonify(base), 400
-            candidates = base.get('destinations', []) + base.get('others', [])
+            candidates = base['candidates']
 
         customer = data_loader.get_customer_by_id(customer_id) or { '顧客ID': customer_id }
-        result = llm_reranker.rerank(customer, constraints, candidates, top_k=top_k, model_profile=model_profile)
+        if data.get('stream'):
+            def generate():
+                for item in llm_reranker.iter_rerank(customer, constraints, candidates, top_k=top_k,
+                                                     model_profile=model_profile):
+                    yield json.dumps(item, ensure_ascii=False) + '\n'
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        result = llm_reranker.rerank(customer, constraints, candidates, top_k=top_k, model_profile=model_profile,
+                                     deadline_ms=data.get('deadline_ms'), hedge=data.get('hedge'))
 
         return jsonify({ 'status': 'success', 'suggest': result })
     except Exception as e:
         return jsonify({ 'status': 'error', 'message': str(e) }), 500
 
+@api_bp.route('/plan/suggest/cache', methods=['GET'])
+def plan_suggest_cache_stats():
+    """LLM 再ランキングのキャッシュ統計（ヒット率・件数）と LLM 呼び出しの統計（まとめた数・待ち行列）"""
+    return jsonify({
+        'status': 'success',
+        'cache': llm_reranker.cache.stats(),
+        'client': llm_reranker.client.stats(),
+    })
+
 @api_bp.route('/health', methods=['GET'])
 def health_check():
     """ヘルスチェックエンドポイント"""
@@ -0,0 +1,119 @@
+"""
+翌日到着客の一括再ランキング
+指定日にチェックインする予約（キャンセル以外）の顧客について、/api/plan/suggest と同じ候補・条件で
+LLM 再ランキングをまとめて実行し、結果を再ランキングキャッシュに入れておく
+（フロントが開く前に実行しておけば、当日の suggest はキャッシュから即答になる）
+
+使い方（backend ディレクトリで）:
+    python -m services.bulk_rerank --date 2024-02-01 --weather sunny --season winter --top-k 10
+
+当日の suggest と constraints / top_k / model_profile が一致したときだけキャッシュが使われる
+"""
+
+import argparse
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from data.data_loader import data_loader
+from services.destination_service import DestinationService
+from services.llm_reranker import LLMReranker
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('bulk_rerank')
+
+
+def season_for(day: date) -> str:
+    """月から季節（推薦の season と同じ値）"""
+    return {12: 'winter', 1: 'winter', 2: 'winter', 3: 'spring', 4: 'spring', 5: 'spring',
+            6: 'summer', 7: 'summer', 8: 'summer'}.get(day.month, 'autumn')
+
+
+def arrivals_on(day: date) -> List[Dict]:
+    """指定日にチェックインする有効な予約"""
+    prefix = day.strftime('%Y-%m-%d')
+    return [
+        r for r in data_loader.load_reservations()
+        if r['status'] != 'キャンセル' and (r['check_in'] or '').startswith(prefix)
+    ]
+
+
+def run(day: date, constraints: Optional[Dict] = None, top_k: int = 10,
+        model_profile: str = 'balanced', batch_size: Optional[int] = None) -> Dict:
+    """
+    一括再ランキングを実行
+
+    Returns:
+        {'status', 'date', 'customers': [{customer_id, reservation_id, source, batch}], 'meta': {...}}
+    """
+    t0 = time.perf_counter()
+    constraints = constraints or {'weather': 'sunny', 'season': season_for(day)}
+    destination_service = DestinationService()
+    reranker = LLMReranker()
+
+    items = []
+    customers = []
+    skipped = []
+    seen = set()
+    for reservation in arrivals_on(day):
+        customer_id = reservation['customer_id']
+        if customer_id in seen:
+            continue
+        seen.add(customer_id)
+        base = destination_service.get_rerank_candidates(customer_id, constraints)
+        if base['status'] != 'success':
+            skipped.append({'customer_id': customer_id, 'message': base.get('message')})
+            continue
+        customer = data_loader.get_customer_by_id(customer_id) or {'顧客ID': customer_id}
+        items.append({'customer': customer, 'constraints': constraints, 'candidates': base['candidates']})
+        customers.append({'customer_id': customer_id, 'reservation_id': reservation['reservation_id']})
+
+    results = reranker.rerank_batch(items, top_k=top_k, model_profile=model_profile, batch_size=batch_size)
+    for info, result in zip(customers, results):
+        info['source'] = result['meta']['source']
+        info['batch'] = result['meta'].get('batch')
+
+    meta = {
+        'arrivals': len(seen),
+        'reranked': sum(1 for c in customers if c['source'] == 'llm'),
+        'fallback': sum(1 for c in customers if c['source'] == 'fallback'),
+        'skipped': skipped,
+        'constraints': constraints,
+        'elapsed_ms': round((time.perf_counter() - t0) * 1000, 1),
+        'cache': reranker.cache.stats(),
+    }
+    log_event(logger, logging.INFO, 'bulk_rerank.completed', date=day.isoformat(),
+              arrivals=meta['arrivals'], reranked=meta['reranked'], fallback=meta['fallback'],
+              ms=meta['elapsed_ms'])
+    return {'status': 'success', 'date': day.isoformat(), 'customers': customers, 'meta': meta}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='翌日到着客の LLM 再ランキングを一括実行してキャッシュに入れる')
+    parser.add_argument('--date', help='チェックイン日 YYYY-MM-DD（既定: 明日）')
+    parser.add_argument('--weather', default='sunny')
+    parser.add_argument('--season', help='既定: 日付の月から判定')
+    parser.add_argument('--budget-yen', type=int)
+    parser.add_argument('--crowd-avoid', choices=['off', 'mid', 'high'])
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--model-profile', default='balanced', choices=['cheap', 'balanced', 'quality'])
+    parser.add_argument('--batch-size', type=int)
+    args = parser.parse_args(argv)
+
+    day = datetime.strptime(args.date, '%Y-%m-%d').date() if args.date else date.today() + timedelta(days=1)
+    # suggest の constraints と同じ形（未指定の項目は含めない）
+    constraints = {'weather': args.weather, 'season': args.season or season_for(day)}
+    if args.budget_yen is not None:
+        constraints['budget_yen'] = args.budget_yen
+    if args.crowd_avoid:
+        constraints['crowd_avoid'] = args.crowd_avoid
+
+    result = run(day, constraints, top_k=args.top_k, model_profile=args.model_profile,
+                 batch_size=args.batch_size)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@
 顧客属性に基づく観光地推薦機能
 """
 
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from data.data_loader import data_loader
 from utils.recommendation import recommendation_engine
 
@@ -16,7 +16,8 @@ class DestinationService:
     
     def get_recommended_destinations(self, customer_id: str, weather: str = 'sunny', 
                                    season: str = 'spring', limit: int = 10,
-                                   budget_yen: Optional[int] = None, crowd_avoid: Optional[str] = None) -> Dict:
+                                   budget_yen: Optional[int] = None, crowd_avoid: Optional[str] = None,
+                                   origin: Optional[Tuple[float, float]] = None) -> Dict:
         """
         顧客に対する推薦観光地を取得
         
@@ -25,6 +26,7 @@ class DestinationService:
             weather: 天気 (future use)
             season: 季節 (future use) 
             limit: 返却する候補地数の上限
+            origin: 出発地 (longitude, latitude)。指定時は距離をスコアに反映
             
         Returns:
             推薦結果とメタデータを含む辞書
@@ -59,6 +61,8 @@ class DestinationService:
             # 天気・季節も注入（推薦スコアで使用）
             customer['weather'] = weather  # 'sunny' | 'rainy' | 'cloudy'
             customer['season'] = season    # 'spring' | 'summer' | 'autumn' | 'winter'
+            if origin is not None:
+                customer['origin'] = origin
 
             # 推薦スコア計算とソート
             recommended_destinations = self.recommendation_engine.sort_destinations_by_score(
@@ -105,6 +109,24 @@ class DestinationService:
                 'message': f'推薦処理中にエラーが発生しました: {str(e)}'
             }
     
+    def get_rerank_candidates(self, customer_id: str, constraints: Dict, limit: int = 50) -> Dict:
+        """
+        LLM 再ランキングに渡す候補（推薦 TopN と残り）
+        /api/plan/suggest の候補補完と一括再ランキングで同じ候補になるよう共通化
+
+        Returns:
+            {'status': 'success', 'candidates': [...]} または get_recommended_destinations のエラー
+        """
+        base = self.get_recommended_destinations(
+            customer_id=customer_id, limit=limit,
+            weather=constraints.get('weather') or 'sunny',
+            season=constraints.get('season') or 'spring',
+            budget_yen=constraints.get('budget_yen'),
+            crowd_avoid=constraints.get('crowd_avoid'))
+        if base.get('status') != 'success':
+            return base
+        return {'status': 'success', 'candidates': base.get('destinations', []) + base.get('others', [])}
+
     def get_destination_details(self, destination_id: str) -> Optional[Dict]:
         """指定された観光地の詳細情報を取得"""
         destination = self.data_loader.get_destination_by_id(destination_id)
@@ -112,6 +134,22 @@ class DestinationService:
             return self._format_destination_response(destination)
         return None
     
+    def get_nearby_destinations(self, latitude: float, longitude: float, radius_km: float = 10.0) -> Dict:
+        """指定地点から radius_km 以内の観光地を近い順に取得"""
+        nearby = self.data_loader.find_destinations_near(longitude, latitude, radius_km)
+        return {
+            'status': 'success',
+            'search_params': {
+                'latitude': latitude,
+                'longitude': longitude,
+                'radius_km': radius_km
+            },
+            'destinations': [
+                {**self._format_destination_response(dest), 'distance_km': round(distance, 2)}
+                for dest, distance in nearby
+            ]
+        }
+
     def _filter_by_weather_season(self, destinations: List[Dict], 
                                  weather: str, season: str) -> List[Dict]:
         """
@@ -135,5 +173,7 @@ class DestinationService:
             'description': destination.get('description'),
             'estimated_duration': int(destination.get('estimated_duration_minutes', 60)),
             'tags': destination.get('tags', []),
-            'recommendation_score': destination.get('recommendation_score', 0)
+            'recommendation_score': destination.get('recommendation_score', 0),
+            **({'distance_km': destination['distance_from_origin_km']}
+               if destination.get('distance_from_origin_km') is not None else {})
         }
@@ -0,0 +1,214 @@
+"""
+ホテル（出発地）サービス
+ホテル設定と、ホテル⇔各観光地の所要時間の事前計算テーブルを提供
+「N分以内に行ける場所」「往復＋滞在で予算時間内に収まる場所」を事前計算から即答する
+
+環境変数:
+- HOTEL_NAME: ホテル名（既定: ホテル）
+- HOTEL_LAT / HOTEL_LON: ホテル座標（既定: プランナーの START と同じ 26.3105, 127.7723）
+"""
+
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from data.data_loader import data_loader
+from utils.osrm_client import osrm_client
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('hotel')
+
+
+def load_hotel_config() -> Dict:
+    """環境変数からホテル設定を読み込み"""
+    return {
+        'name': os.getenv('HOTEL_NAME', 'ホテル'),
+        'latitude': float(os.getenv('HOTEL_LAT', '26.3105')),
+        'longitude': float(os.getenv('HOTEL_LON', '127.7723')),
+    }
+
+
+class HotelService:
+    """ホテル設定と出発地からの所要時間テーブル"""
+
+    # 直線近似で作ったテーブルを OSRM で作り直すまでの秒数
+    fallback_ttl_seconds = 600
+
+    def __init__(self):
+        self.osrm_client = osrm_client
+        self.data_loader = data_loader
+        self.hotel = load_hotel_config()
+        self._table: Optional[Dict] = None
+        self._lock = threading.Lock()
+        self._warm_thread: Optional[threading.Thread] = None
+        self._warm_lock = threading.Lock()
+
+    def start_point(self) -> Dict:
+        """ルートAPIに渡す出発地（START）"""
+        return {
+            'destination_id': 'START',
+            'latitude': self.hotel['latitude'],
+            'longitude': self.hotel['longitude'],
+        }
+
+    def precompute(self, force: bool = False) -> Dict:
+        """
+        ホテル⇔全観光地の所要時間テーブルを作成（OSRM table リクエスト1回）
+
+        Returns:
+            テーブル（作成済みで有効ならそれを返す）
+        """
+        # 作成済みならロックを取らずに返す（問い合わせの高速経路）
+        if not force and self._table_is_fresh(self._table):
+            return self._table
+        with self._lock:
+            if not force and self._table_is_fresh(self._table):
+                return self._table
+
+            destinations = self.data_loader.load_destinations()
+            hotel = (self.hotel['longitude'], self.hotel['latitude'])
+            coords = [hotel] + self.data_loader.get_destination_coordinates()
+            t0 = time.perf_counter()
+            matrix = self.osrm_client.get_distance_matrix(coords, profile='driving', allow_fallback=True)
+            source = 'osrm' if matrix['meta'].get('osrm_base') else 'fallback'
+
+            entries = []
+            for i, dest in enumerate(destinations, start=1):
+                out_s = matrix['durations'][0][i]
+                back_s = matrix['durations'][i][0]
+                if out_s is None or back_s is None:
+                    continue
+                out_m = matrix['distances'][0][i] or 0.0
+                back_m = matrix['distances'][i][0] or 0.0
+                out_min = round(out_s / 60, 1)
+                back_min = round(back_s / 60, 1)
+                stay_min = int(dest.get('estimated_duration_minutes') or 60)
+                entries.append({
+                    'destination_id': dest.get('destination_id'),
+                    'name': dest.get('name'),
+                    'latitude': float(dest.get('latitude', 0)),
+                    'longitude': float(dest.get('longitude', 0)),
+                    'category': dest.get('category'),
+                    'indoor': dest.get('indoor'),
+                    'estimated_stay_minutes': stay_min,
+                    'outbound_minutes': out_min,
+                    'return_minutes': back_min,
+                    'distance_km': round(out_m / 1000, 2),
+                    'round_trip_minutes': round(out_min + stay_min + back_min, 1),
+                })
+                # 区間キャッシュにも登録しておき、ルート一括計算で再利用
+                if source == 'osrm':
+                    self.osrm_client.leg_cache.put(hotel, coords[i], out_m, out_s)
+                    self.osrm_client.leg_cache.put(coords[i], hotel, back_m, back_s)
+
+            by_outbound = sorted(entries, key=lambda e: e['outbound_minutes'])
+            by_round_trip = sorted(entries, key=lambda e: e['round_trip_minutes'])
+            self._table = {
+                'source': source,
+                'computed_at': time.time(),
+                'by_outbound': by_outbound,
+                'outbound_keys': [e['outbound_minutes'] for e in by_outbound],
+                'by_round_trip': by_round_trip,
+                'round_trip_keys': [e['round_trip_minutes'] for e in by_round_trip],
+                'by_id': {e['destination_id']: e for e in entries},
+            }
+            log_event(logger, logging.INFO, 'hotel.precomputed', source=source, destinations=len(entries),
+                      ms=round((time.perf_counter() - t0) * 1000, 1))
+            return self._table
+
+    def current_table(self) -> Dict:
+        """
+        問い合わせ用のテーブル（まだ無いときだけその場で作成）
+        期限切れの直線近似テーブルはそのまま返し、作り直しはバックグラウンドで行う（OSRM を待たせない）
+        """
+        table = self._table
+        if table is None:
+            return self.precompute()
+        if not self._table_is_fresh(table):
+            self.warm_async()
+        return table
+
+    def warm_async(self) -> None:
+        """バックグラウンドでテーブルを事前計算（実行中なら何もしない）"""
+        with self._warm_lock:
+            if self._warm_thread is not None and self._warm_thread.is_alive():
+                return
+            self._warm_thread = threading.Thread(target=self.precompute, name='hotel-precompute', daemon=True)
+            self._warm_thread.start()
+
+    def wait_warm(self, timeout: Optional[float] = None) -> None:
+        """バックグラウンドの事前計算が終わるまで待つ（テストの後始末用）"""
+        thread = self._warm_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _table_is_fresh(self, table: Optional[Dict]) -> bool:
+        if table is None:
+            return False
+        if table['source'] == 'fallback':
+            return time.time() - table['computed_at'] < self.fallback_ttl_seconds
+        return True
+
+    def get_hotel_info(self) -> Dict:
+        """ホテル設定と事前計算テーブルの状態"""
+        table = self._table
+        return {
+            'status': 'success',
+            'hotel': self.hotel,
+            'precomputed': {
+                'ready': table is not None,
+                'source': table['source'] if table else None,
+                'destinations': len(table['by_id']) if table else 0,
+                'computed_at': table['computed_at'] if table else None,
+            }
+        }
+
+    def get_travel_minutes(self, destination_id: str) -> Optional[Dict]:
+        """ホテル⇔観光地の所要時間（事前計算済みのもの）"""
+        return self.current_table()['by_id'].get(destination_id)
+
+    def find_reachable(self, minutes: Optional[float] = None, budget_minutes: Optional[float] = None) -> Dict:
+        """
+        事前計算テーブルから到達可能な観光地を取得
+
+        Args:
+            minutes: ホテルから片道 minutes 分以内に着ける観光地
+            budget_minutes: 往路＋滞在＋復路が budget_minutes 分以内に収まる観光地
+
+        Returns:
+            条件を満たす観光地（所要時間の短い順）
+        """
+        if minutes is None and budget_minutes is None:
+            return {
+                'status': 'error',
+                'message': 'minutes または budget_minutes が必要です'
+            }
+
+        table = self.current_table()
+        if budget_minutes is not None:
+            end = bisect.bisect_right(table['round_trip_keys'], budget_minutes)
+            results = table['by_round_trip'][:end]
+            if minutes is not None:
+                results = [e for e in results if e['outbound_minutes'] <= minutes]
+        else:
+            end = bisect.bisect_right(table['outbound_keys'], minutes)
+            results = table['by_outbound'][:end]
+
+        return {
+            'status': 'success',
+            'hotel': self.hotel,
+            'search_params': {
+                'minutes': minutes,
+                'budget_minutes': budget_minutes
+            },
+            'source': table['source'],
+            'destinations': results,
+            'total_found': len(results)
+        }
+
+
+# シングルトンインスタンス
+hotel_service = HotelService()
@@ -6,6 +6,10 @@
 from typing import Dict, List
 from datetime import datetime, timedelta
 import json
+import time
+from services.hotel_service import hotel_service
+from services.plan_store import plan_store
+from services.scheduler import scheduler, estimate_leg_minutes, format_hhmm, parse_hhmm
 
 class ItineraryService:
     """旅程作成サービス"""
@@ -60,7 +64,7 @@ class ItineraryService:
                     int(w0.get('estimated_stay_minutes', 0) or 0) == 0
                 )
                 if is_start and len(waypoints) >= 2:
-                    origin_label = 'ホテル'
+                    origin_label = hotel_service.hotel['name']
                     # 出発イベント
                     schedule.append({
                         'time': current_time.strftime('%H:%M'),
@@ -172,28 +176,348 @@ class ItineraryService:
     
     def create_detailed_schedule(self, route: Dict, preferences: Dict = None) -> Dict:
         """
-        より詳細な旅程を作成（将来拡張用）
+        営業時間・最終入場・食事枠を考慮した詳細旅程を作成
         
         Args:
             route: ルート情報
             preferences: 旅行者の好み設定
+                - start_time: 開始時刻 (HH:MM)
+                - end_time: 終了期限 (HH:MM、任意)
+                - travel_date: 旅行日 (YYYY-MM-DD)
+                - meals: 昼食・夕食枠を挿入するか（既定: True）
+                - repair: 違反がある場合に地点を外して修復するか（既定: False）
+                - plan_kind: 保存するプランの種類（既定: standard、雨天版は rain、複数日旅程の試行は trial）
             
         Returns:
-            詳細旅程
+            詳細旅程（create_itinerary の形式に feasible / violations / warnings を追加）
         """
-        # 基本旅程を作成
-        basic_itinerary = self.create_itinerary(route)
+        try:
+            if not route or 'waypoints' not in route:
+                return {
+                    'status': 'error',
+                    'message': 'ルート情報が不正です'
+                }
+            
+            preferences = preferences or {}
+            start_time = preferences.get('start_time') or self.default_start_time
+            end_time = preferences.get('end_time')
+            travel_date = preferences.get('travel_date') or datetime.now().strftime('%Y-%m-%d')
+            meals = preferences.get('meals', True)
+            if not self._parse_time(start_time):
+                return {
+                    'status': 'error',
+                    'message': '開始時刻の形式が不正です (HH:MM)'
+                }
+            
+            stops = scheduler.stops_from_waypoints(route['waypoints'])
+            if preferences.get('repair'):
+                result = scheduler.repair(stops, start_time, end_time=end_time, meals=meals)
+                stops = result['stops']
+            else:
+                result = scheduler.schedule(stops, start_time, end_time=end_time, meals=meals)
+            
+            origin_label = hotel_service.hotel['name']
+            event_lists = [scheduler.item_events(stops, item, origin_label) for item in result['timeline']]
+            schedule = [event for events in event_lists for event in events]
+            end_label = format_hhmm(result['end'])
+            summary = self._detailed_summary(route, schedule, start_time, end_label)
+            
+            # 単発編集（edit_plan）で差分だけ再計算できるよう保存
+            plan = plan_store.create({
+                'result': result,
+                'events': schedule,
+                'event_counts': [len(events) for events in event_lists],
+                'travel_date': travel_date,
+                'origin_label': origin_label,
+                'kind': preferences.get('plan_kind', 'standard'),
+            })
+            
+            response = {
+                'status': 'success',
+                'plan_id': plan['plan_id'],
+                'version': plan['version'],
+                'itinerary': {
+                    'date': travel_date,
+                    'start_time': start_time,
+                    'end_time': end_label,
+                    'total_duration_hours': round((result['end'] - parse_hhmm(start_time)) / 60, 1),
+                    'schedule': schedule
+                },
+                'summary': summary,
+                'feasible': result['feasible'],
+                'violations': result['violations'],
+                'warnings': result['warnings'],
+            }
+            if preferences.get('repair'):
+                response['dropped'] = result['dropped']
+            return response
+        
+        except Exception as e:
+            return {
+                'status': 'error',
+                'message': f'詳細旅程作成中にエラーが発生しました: {str(e)}'
+            }
+    
+    def validate_plans(self, routes: List[Dict], start_time: str = None, end_time: str = None,
+                       meals: bool = True, repair: bool = False) -> Dict:
+        """
+        複数のルート案をまとめて営業時間・食事枠の制約で検証（必要なら修復）
+        
+        Args:
+            routes: ルート情報（waypoints を含む）のリスト
+            start_time: 開始時刻 (HH:MM)
+            end_time: 終了期限 (HH:MM、任意)
+            meals: 食事枠を考慮するか
+            repair: 違反のある案から地点を外して修復するか
+            
+        Returns:
+            案ごとの検証結果（入力順）
+        """
+        start_time = start_time or self.default_start_time
+        if not self._parse_time(start_time):
+            return {
+                'status': 'error',
+                'message': '開始時刻の形式が不正です (HH:MM)'
+            }
+        
+        t0 = time.perf_counter()
+        results = []
+        for index, route in enumerate(routes):
+            if not isinstance(route, dict) or not isinstance(route.get('waypoints'), list):
+                results.append({'index': index, 'status': 'error', 'message': 'ルート情報が不正です'})
+                continue
+            stops = scheduler.stops_from_waypoints(route['waypoints'])
+            if repair:
+                result = scheduler.repair(stops, start_time, end_time=end_time, meals=meals)
+            else:
+                result = scheduler.schedule(stops, start_time, end_time=end_time, meals=meals)
+            item = {
+                'index': index,
+                'status': 'success',
+                'feasible': result['feasible'],
+                'violations': result['violations'],
+                'warnings': result['warnings'],
+                'end_time': format_hhmm(result['end']),
+            }
+            if repair:
+                item['dropped'] = result['dropped']
+                item['destination_ids'] = [s['destination_id'] for s in result['stops']]
+            results.append(item)
+        
+        return {
+            'status': 'success',
+            'results': results,
+            'meta': {
+                'plans': len(routes),
+                'feasible': sum(1 for r in results if r.get('feasible')),
+                'elapsed_ms': round((time.perf_counter() - t0) * 1000, 2),
+            }
+        }
+    
+    def edit_plan(self, plan_id: str, edit: Dict, version: int = None) -> Dict:
+        """
+        保存済みプランに単発の編集を適用し、影響のある後続部分だけ再計算
+        
+        Args:
+            plan_id: create_detailed_schedule が返した plan_id
+            edit: 編集内容
+                - {"op": "shift", "index": i, "minutes": 15}  滞在時間を増減（index=0 の出発地なら出発時刻）
+                - {"op": "swap", "index": i, "with": j}       2地点を入れ替え
+                - {"op": "insert", "index": i, "destination_id": "D005"}  i 番目に観光地を挿入
+                - {"op": "delete", "index": i}                 i 番目の地点を削除
+              index は旅程の地点順（出発地を含む waypoints の順）
+            version: 編集元のバージョン（指定時、最新と異なれば競合としてエラー）
+            
+        Returns:
+            新しい version と、イベント列への差分（patch）
+        """
+        t0 = time.perf_counter()
+        with plan_store.lock:
+            plan = plan_store.get(plan_id)
+            if plan is None:
+                return {
+                    'status': 'error',
+                    'error_code': 'not_found',
+                    'message': 'プランが見つかりません'
+                }
+            if version is not None and int(version) != plan['version']:
+                return {
+                    'status': 'error',
+                    'error_code': 'version_conflict',
+                    'message': 'プランが更新されています。最新のバージョンを取得してください',
+                    'current_version': plan['version']
+                }
+            
+            previous = plan['result']
+            try:
+                stops, from_index, params, estimated = self._apply_edit(previous, edit or {})
+            except ValueError as e:
+                return {
+                    'status': 'error',
+                    'error_code': 'invalid_edit',
+                    'message': str(e)
+                }
+            if params is not previous['params']:
+                previous = dict(previous, params=params)
+            result = scheduler.reschedule(previous, stops, from_index)
+            
+            # 再計算したタイムライン範囲のイベントだけ作り直し、イベント列に反映
+            changed = result['changed']
+            event_lists = [scheduler.item_events(stops, item, plan['origin_label'])
+                           for item in result['timeline'][changed['from']:changed['to']]]
+            counts = plan['event_counts']
+            patch_start = sum(counts[:changed['from']])
+            delete_count = sum(counts[changed['from']:changed['old_to']])
+            inserted = [event for events in event_lists for event in events]
+            plan['events'][patch_start:patch_start + delete_count] = inserted
+            counts[changed['from']:changed['old_to']] = [len(events) for events in event_lists]
+            plan['result'] = result
+            plan_store.replace(plan)
+            
+            start_label = format_hhmm(params['start'])
+            end_label = format_hhmm(result['end'])
+            route_stub = {'total_distance_km': round(sum(s['distance_km'] or 0 for s in stops), 2)}
+            return {
+                'status': 'success',
+                'plan_id': plan['plan_id'],
+                'version': plan['version'],
+                'patch': {
+                    'start': patch_start,
+                    'delete_count': delete_count,
+                    'events': inserted
+                },
+                'itinerary': {
+                    'date': plan['travel_date'],
+                    'start_time': start_label,
+                    'end_time': end_label,
+                    'total_duration_hours': round((result['end'] - params['start']) / 60, 1),
+                    'event_count': len(plan['events'])
+                },
+                'destination_ids': [s['destination_id'] for s in stops],
+                'summary': self._detailed_summary(route_stub, plan['events'], start_label, end_label),
+                'feasible': result['feasible'],
+                'violations': result['violations'],
+                'warnings': result['warnings'],
+                'meta': {
+                    'from_index': from_index,
+                    'recomputed_items': changed['to'] - changed['from'],
+                    'reused_items': len(result['timeline']) - (changed['to'] - changed['from']),
+                    'estimated_legs': estimated,
+                    'elapsed_ms': round((time.perf_counter() - t0) * 1000, 3)
+                }
+            }
+    
+    def get_plan(self, plan_id: str) -> Dict:
+        """保存済みプランの現在の旅程"""
+        plan = plan_store.get(plan_id)
+        if plan is None:
+            return {
+                'status': 'error',
+                'error_code': 'not_found',
+                'message': 'プランが見つかりません'
+            }
+        result = plan['result']
+        return {
+            'status': 'success',
+            'plan_id': plan['plan_id'],
+            'version': plan['version'],
+            'itinerary': {
+                'date': plan['travel_date'],
+                'start_time': format_hhmm(result['params']['start']),
+                'end_time': format_hhmm(result['end']),
+                'total_duration_hours': round((result['end'] - result['params']['start']) / 60, 1),
+                'schedule': plan['events']
+            },
+            'destination_ids': [s['destination_id'] for s in result['stops']],
+            'feasible': result['feasible'],
+            'violations': result['violations'],
+            'warnings': result['warnings'],
+        }
+    
+    def _apply_edit(self, previous: Dict, edit: Dict):
+        """
+        編集を stops に適用
+        
+        変更のない地点は同じ dict のまま残し（再計算の打ち切り判定に使う）、
+        前後の区間が変わった地点だけ複製して所要時間を区間キャッシュから引き直す
         
-        if basic_itinerary['status'] != 'success':
-            return basic_itinerary
+        Returns:
+            (新しい stops, 再計算の開始インデックス, params, 見積もりで補った区間数)
+        """
+        stops = list(previous['stops'])
+        params = previous['params']
+        first = 1 if stops and stops[0]['is_origin'] else 0
+        op = edit.get('op')
+        
+        def index_of(key, upper):
+            try:
+                value = int(edit.get(key))
+            except (TypeError, ValueError):
+                raise ValueError(f'{key} が必要です')
+            if value < first or value > upper:
+                raise ValueError(f'{key} が範囲外です ({first}〜{upper})')
+            return value
         
-        # 将来実装予定の機能：
-        # - 食事時間の自動挿入
-        # - 休憩時間の提案
-        # - 天候に応じた調整
-        # - 個人の好みに応じたカスタマイズ
+        if op == 'shift':
+            try:
+                minutes = int(edit.get('minutes'))
+            except (TypeError, ValueError):
+                raise ValueError('minutes が必要です')
+            try:
+                index = int(edit.get('index'))
+            except (TypeError, ValueError):
+                raise ValueError('index が必要です')
+            if first == 1 and index == 0:
+                return stops, 0, dict(params, start=params['start'] + minutes), 0
+            i = index_of('index', len(stops) - 1)
+            stops[i] = dict(stops[i], stay=max(0, stops[i]['stay'] + minutes))
+            return stops, i, params, 0
         
-        return basic_itinerary
+        if op == 'swap':
+            i = index_of('index', len(stops) - 1)
+            j = index_of('with', len(stops) - 1)
+            if i == j:
+                raise ValueError('同じ地点は入れ替えられません')
+            i, j = min(i, j), max(i, j)
+            stops[i], stops[j] = stops[j], stops[i]
+            touched = {i - 1, i, j - 1, j}
+        elif op == 'insert':
+            i = index_of('index', len(stops))
+            stop = scheduler.stop_for_destination(str(edit.get('destination_id') or ''))
+            if stop is None:
+                raise ValueError('destination_id が不正です')
+            stops.insert(i, stop)
+            touched = {i - 1, i}
+        elif op == 'delete':
+            i = index_of('index', len(stops) - 1)
+            if len(stops) - first <= 1:
+                raise ValueError('最後の1地点は削除できません')
+            del stops[i]
+            touched = {i - 1}
+        else:
+            raise ValueError('op は shift / swap / insert / delete のいずれかです')
+        
+        # 前後の区間が変わった地点の所要時間を引き直す
+        estimated = 0
+        for p in sorted(t for t in touched if 0 <= t < len(stops)):
+            stop = dict(stops[p])
+            if p < len(stops) - 1:
+                stop['travel'], stop['distance_km'], is_estimate = estimate_leg_minutes(
+                    stop['point'], stops[p + 1]['point'])
+                estimated += int(is_estimate)
+            else:
+                stop['travel'], stop['distance_km'] = None, None
+            stops[p] = stop
+        return stops, max(0, min(touched)), params, estimated
+    
+    def _detailed_summary(self, route: Dict, schedule: List[Dict], start_time: str, end_time: str) -> Dict:
+        """詳細旅程のサマリー（食事・開館待ちの合計を含む）"""
+        summary = self._calculate_summary(route, schedule, start_time, end_time)
+        summary['total_meal_time_minutes'] = sum(
+            s.get('duration_minutes', 0) for s in schedule if s['activity_type'] == 'meal')
+        summary['total_wait_time_minutes'] = sum(
+            s.get('duration_minutes', 0) for s in schedule if s['activity_type'] == 'wait')
+        return summary
     
     def _parse_time(self, time_str: str) -> datetime:
         """時刻文字列をdatetimeオブジェクトに変換"""
@@ -236,6 +560,10 @@ class ItineraryService:
             if event['activity_type'] == 'sightseeing':
                 lines.append(f"{event['time']} - {event['location']}")
                 lines.append(f"  {event['description']} ({event.get('duration_minutes', 0)}分)")
+            elif event['activity_type'] == 'meal':
+                lines.append(f"{event['time']} - {event['description']}")
+            elif event['activity_type'] == 'wait':
+                lines.append(f"{event['time']} - {event['description']}")
             elif event['activity_type'] == 'travel':
                 lines.append(f"{event['time']} - 移動")
                 lines.append(f"  {event['from']} → {event['to']}")
@@ -0,0 +1,310 @@
+"""
+OpenAI 互換 Chat Completions クライアント
+- 接続プール（utils/async_http.py）を使い回す
+- single-flight: 同じキーの呼び出しが同時に来たら、実行中の1回の結果を共有する
+- 同時実行数の上限: 超えた分は待ち行列に入り、待ち時間が上限を超えたら諦める
+- ストリーミング（stream=true）の応答を断片ごとに受け取る
+
+環境変数:
+- LLM_MAX_CONCURRENCY: LLM への同時リクエスト数（既定: 4）
+- LLM_QUEUE_TIMEOUT_SECONDS: 空きを待つ最大秒数（既定: 10）
+- LLM_TIMEOUT_SECONDS: 1リクエストのタイムアウト（既定: 30）
+- LLM_LATENCY_TTL_SECONDS: 応答時間の見積もりを使う期間。これより古い実績は捨てて測り直す（既定: 300）
+- LLM_PROBE_INTERVAL_SECONDS: 期限に収まらないと見込んで使わなかったモデルを試しに呼ぶ間隔（既定: 60）
+"""
+
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, Optional
+
+import httpx
+
+from utils.async_http import AsyncHttpPool, http_pool
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('llm')
+
+# 応答時間の移動平均の重み
+LATENCY_EWMA_ALPHA = 0.2
+
+# 見積もりとして使うのに必要な実績の数（1回だけ遅かったモデルを外さない）
+LATENCY_MIN_SAMPLES = 3
+
+
+class LLMQueueTimeout(Exception):
+    """同時実行数の空きを待つ間にタイムアウトした"""
+
+
+class LLMStreamError(Exception):
+    """ストリーミング呼び出しの失敗"""
+
+
+class LLMClient:
+    """single-flight と同時実行数制限付きの Chat Completions クライアント"""
+
+    def __init__(self, pool: Optional[AsyncHttpPool] = None):
+        self.pool = pool or http_pool
+        self.max_concurrency = int(os.getenv('LLM_MAX_CONCURRENCY', 4))
+        self.queue_timeout = float(os.getenv('LLM_QUEUE_TIMEOUT_SECONDS', 10))
+        self.timeout = float(os.getenv('LLM_TIMEOUT_SECONDS', 30))
+        self.latency_ttl = float(os.getenv('LLM_LATENCY_TTL_SECONDS', 300))
+        self.probe_interval = float(os.getenv('LLM_PROBE_INTERVAL_SECONDS', 60))
+        # 以下はイベントループ上でのみ触る
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._active = 0
+        self._waiting = 0
+        # 統計（呼び出し元スレッドからも読むのでロックで保護）
+        self._stats_lock = threading.Lock()
+        # モデルごとの応答時間の指数移動平均[ms]・実績数・最終更新時刻（期限内に答えられるかの見積もりに使う）
+        self._latency: Dict[str, Dict[str, float]] = {}
+        # モデルごとの最後の試し呼び出しの時刻
+        self._probed_at: Dict[str, float] = {}
+        self._counters = {
+            'requests': 0,
+            'upstream_calls': 0,
+            'coalesced': 0,
+            'queued': 0,
+            'queue_timeouts': 0,
+            'errors': 0,
+            'max_waiting': 0,
+        }
+
+    def chat_json(self, base_url: str, api_key: str, body: Dict[str, Any],
+                  key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Chat Completions を呼び出し、応答メッセージの JSON を返す（HTTP エラー・解析失敗時は None）
+
+        Args:
+            base_url: OpenAI 互換エンドポイントのベースURL
+            api_key: API キー
+            body: リクエスト本文
+            key: single-flight のキー（同じキーの同時呼び出しは1回にまとめる）
+        """
+        self._count('requests')
+        return self.pool.run(self._shared(key, base_url, api_key, body),
+                             timeout=self.queue_timeout + self.timeout + 5)
+
+    def submit_chat(self, base_url: str, api_key: str, body: Dict[str, Any],
+                    key: Optional[str] = None, track_latency: bool = True) -> Future:
+        """
+        chat_json と同じ呼び出しを待たずに投入し、結果の Future を返す（期限付きの待ち合わせ用）
+        track_latency=False の呼び出し（一括処理など）は応答時間の見積もりに含めない
+        """
+        self._count('requests')
+        return self.pool.submit(self._shared(key, base_url, api_key, body, track_latency))
+
+    def expected_ms(self, model: str) -> Optional[float]:
+        """モデルの応答時間の見積もり[ms]（実績が LATENCY_MIN_SAMPLES 未満、または古い場合は None）"""
+        with self._stats_lock:
+            entry = self._latency.get(model)
+            if entry is None or entry['samples'] < LATENCY_MIN_SAMPLES:
+                return None
+            if time.monotonic() - entry['updated_at'] > self.latency_ttl:
+                return None
+            return entry['ms']
+
+    def should_probe(self, model: str) -> bool:
+        """
+        見積もりを理由に使わなかったモデルを試しに呼ぶか（モデルごとに probe_interval に1回だけ True）
+        呼ばれないモデルの見積もりが更新されず、一度遅かっただけで使われなくなるのを防ぐ
+        """
+        now = time.monotonic()
+        with self._stats_lock:
+            if now - self._probed_at.get(model, float('-inf')) < self.probe_interval:
+                return False
+            self._probed_at[model] = now
+            return True
+
+    def _record_latency(self, model: Optional[str], ms: float) -> None:
+        if not model:
+            return
+        now = time.monotonic()
+        with self._stats_lock:
+            entry = self._latency.get(model)
+            if entry is None or now - entry['updated_at'] > self.latency_ttl:
+                # 古い実績は引き継がずに測り直す
+                self._latency[model] = {'ms': ms, 'samples': 1, 'updated_at': now}
+                return
+            entry['ms'] = entry['ms'] * (1 - LATENCY_EWMA_ALPHA) + ms * LATENCY_EWMA_ALPHA
+            entry['samples'] += 1
+            entry['updated_at'] = now
+
+    async def _shared(self, key: Optional[str], base_url: str, api_key: str, body: Dict[str, Any],
+                      track_latency: bool = True):
+        if key is None:
+            return await self._limited(base_url, api_key, body, track_latency)
+        task = self._in_flight.get(key)
+        if task is not None:
+            self._count('coalesced')
+        else:
+            task = asyncio.ensure_future(self._limited(base_url, api_key, body, track_latency))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _t: self._in_flight.pop(key, None))
+        # 待っている呼び出し元の1つがキャンセルされても、共有中の呼び出しは止めない
+        return await asyncio.shield(task)
+
+    async def _limited(self, base_url: str, api_key: str, body: Dict[str, Any], track_latency: bool = True):
+        queued_ms = await self._acquire()
+        try:
+            return await self._post(base_url, api_key, body, queued_ms, track_latency)
+        finally:
+            self._release()
+
+    async def _acquire(self) -> float:
+        """同時実行数の枠を確保し、待った時間[ms]を返す（待ち時間が上限を超えたら LLMQueueTimeout）"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        t0 = time.perf_counter()
+        if self._semaphore.locked():
+            # 空きが無いので待ち行列に入る
+            self._count('queued')
+            self._waiting += 1
+            with self._stats_lock:
+                self._counters['max_waiting'] = max(self._counters['max_waiting'], self._waiting)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._count('queue_timeouts')
+                log_event(logger, logging.WARNING, 'llm.queue_timeout', waiting=self._waiting,
+                          active=self._active)
+                raise LLMQueueTimeout(f'LLM の空き待ちが {self.queue_timeout}s を超えました')
+            finally:
+                self._waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self._active += 1
+        return round((time.perf_counter() - t0) * 1000, 1)
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._semaphore.release()
+
+    async def _post(self, base_url: str, api_key: str, body: Dict[str, Any], queued_ms: float,
+                    track_latency: bool = True):
+        self._count('upstream_calls')
+        t0 = time.perf_counter()
+        try:
+            resp = await self.pool.client.post(
+                f"{base_url}/chat/completions",
+                headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+                json=body,
+                timeout=self.timeout,
+            )
+        except httpx.HTTPError as e:
+            self._count('errors')
+            log_event(logger, logging.WARNING, 'llm.request_failed', error=str(e) or type(e).__name__)
+            return None
+        ms = round((time.perf_counter() - t0) * 1000, 1)
+        log_event(logger, logging.INFO, 'llm.completed', status=resp.status_code, ms=ms,
+                  queued_ms=queued_ms, model=body.get('model'))
+        if resp.status_code >= 400:
+            self._count('errors')
+            return None
+        if track_latency:
+            self._record_latency(body.get('model'), ms)
+        try:
+            content = resp.json()["choices"][0]["message"]["content"]
+            return json.loads(content)
+        except Exception:
+            self._count('errors')
+            return None
+
+    def iter_chat_stream(self, base_url: str, api_key: str, body: Dict[str, Any]) -> Iterator[str]:
+        """
+        Chat Completions をストリーミング（stream=true）で呼び出し、応答テキストの断片を順に返す
+
+        同時実行数の制限は通常の呼び出しと共有する。ジェネレータを途中で閉じると上流の呼び出しも止める
+        接続・HTTP エラーは LLMStreamError、空き待ちのタイムアウトは LLMQueueTimeout を送出する
+        """
+        self._count('requests')
+        chunks: "queue.Queue" = queue.Queue()
+        future = self.pool.submit(self._stream(base_url, api_key, body, chunks))
+        deadline = time.monotonic() + self.queue_timeout + self.timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LLMStreamError('LLM ストリームがタイムアウトしました')
+                try:
+                    kind, value = chunks.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                if kind == 'delta':
+                    yield value
+                elif kind == 'error':
+                    raise value
+                else:
+                    return
+        finally:
+            future.cancel()
+
+    async def _stream(self, base_url: str, api_key: str, body: Dict[str, Any], chunks: "queue.Queue") -> None:
+        try:
+            queued_ms = await self._acquire()
+        except LLMQueueTimeout as e:
+            chunks.put(('error', e))
+            return
+        self._count('upstream_calls')
+        t0 = time.perf_counter()
+        first_ms = None
+        try:
+            async with self.pool.client.stream(
+                'POST',
+                f"{base_url}/chat/completions",
+                headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+                json={**body, "stream": True},
+                timeout=self.timeout,
+            ) as resp:
+                if resp.status_code >= 400:
+                    raise LLMStreamError(f'LLM がエラーを返しました (HTTP {resp.status_code})')
+                async for line in resp.aiter_lines():
+                    if not line.startswith('data:'):
+                        continue
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        break
+                    try:
+                        delta = json.loads(data)["choices"][0]["delta"].get("content")
+                    except (ValueError, KeyError, IndexError):
+                        continue
+                    if delta:
+                        if first_ms is None:
+                            first_ms = round((time.perf_counter() - t0) * 1000, 1)
+                        chunks.put(('delta', delta))
+            self._record_latency(body.get('model'), (time.perf_counter() - t0) * 1000)
+            log_event(logger, logging.INFO, 'llm.streamed', ms=round((time.perf_counter() - t0) * 1000, 1),
+                      first_token_ms=first_ms, queued_ms=queued_ms, model=body.get('model'))
+            chunks.put(('end', None))
+        except (httpx.HTTPError, LLMStreamError) as e:
+            self._count('errors')
+            log_event(logger, logging.WARNING, 'llm.stream_failed', error=str(e) or type(e).__name__)
+            chunks.put(('error', e if isinstance(e, LLMStreamError) else LLMStreamError(str(e) or type(e).__name__)))
+        finally:
+            self._release()
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {
+                **self._counters,
+                'in_flight': len(self._in_flight),
+                'active': self._active,
+                'waiting': self._waiting,
+                'max_concurrency': self.max_concurrency,
+                'latency_ms': {m: round(e['ms'], 1) for m, e in self._latency.items()},
+                'latency_samples': {m: int(e['samples']) for m, e in self._latency.items()},
+            }
+
+
+# シングルトンインスタンス
+llm_client = LLMClient()
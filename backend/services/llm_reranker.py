@@ -5,9 +5,16 @@ LLM ベースの再ランキングサービス。
 - 出力: JSON スキーマ準拠の ranked/rejected 配列
 
 環境変数:
-- OPENAI_API_KEY: 存在すれば OpenAI Chat Completions を HTTP 経由で呼び出し
+- OPENAI_API_KEY: 存在すれば OpenAI Chat Completions を HTTP 経由で呼び出し（services/llm_client.py）
 - OPENAI_BASE_URL: 代替エンドポイント（任意）
-- OPENAI_MODEL: 使用モデル（既定: gpt-4o-mini）
+- OPENAI_MODEL: balanced のモデル（既定: gpt-4o-mini）
+- OPENAI_MODEL_CHEAP / OPENAI_MODEL_QUALITY: cheap / quality のモデル（既定: gpt-4o-mini / gpt-4o）
+- LLM_DEADLINE_MS: 応答期限の既定値（既定: 8000）。超えたらルールベースの結果を返す
+- LLM_HEDGE: 本命が遅いとき cheap にも並行して問い合わせるか（既定: 1）
+- LLM_HEDGE_AFTER_MS: ヘッジを始めるまでの時間（既定: 期限の半分）
+
+プロンプトはトークン予算内に候補を絞り込んで作成し（services/prompt_builder.py）、
+LLM の結果はプロンプト＋モデルのハッシュをキーにキャッシュします（services/rerank_cache.py）。
 
 外部APIに失敗/未設定の場合は、ルールベースのフォールバックで再ランキングします。
 """
@@ -15,11 +22,21 @@ LLM ベースの再ランキングサービス。
 from __future__ import annotations
 
 import json
+import logging
 import os
-from typing import Any, Dict, List, Optional, Tuple
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from jsonschema import Draft202012Validator, ValidationError
+
+from services.llm_client import LLMClient, llm_client
+from services.prompt_builder import PromptBuilder
+from services.rerank_cache import RerankCache, prompt_key, rerank_cache
+from utils.json_stream import JsonObjectScanner
+from utils.telemetry import get_logger, log_event
 
-import requests
-from jsonschema import validate, ValidationError
+logger = get_logger("llm")
 
 
 SUGGEST_SCHEMA: Dict[str, Any] = {
@@ -56,12 +73,34 @@ SUGGEST_SCHEMA: Dict[str, Any] = {
     "additionalProperties": True,
 }
 
+# スキーマのチェックは一度だけ行い、検証器を使い回す（キャッシュヒット時の検証を軽くする）
+SUGGEST_VALIDATOR = Draft202012Validator(SUGGEST_SCHEMA)
+
+
+# model_profile ごとのモデル・温度（モデルは環境変数で差し替え可能）
+MODEL_PROFILES: Dict[str, Dict[str, Any]] = {
+    "cheap": {"model_env": "OPENAI_MODEL_CHEAP", "default_model": "gpt-4o-mini", "temperature": 0.0},
+    "balanced": {"model_env": "OPENAI_MODEL", "default_model": "gpt-4o-mini", "temperature": 0.0},
+    "quality": {"model_env": "OPENAI_MODEL_QUALITY", "default_model": "gpt-4o", "temperature": 0.2},
+}
+# 期限に収まらないときに下げていく順
+PROFILE_ORDER = ["quality", "balanced", "cheap"]
+
 
 class LLMReranker:
-    def __init__(self) -> None:
+    def __init__(self, cache: Optional[RerankCache] = None) -> None:
         self.openai_api_key: Optional[str] = os.getenv("OPENAI_API_KEY")
         self.openai_base_url: str = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-        self.openai_model: str = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+        self.profile_models: Dict[str, str] = {
+            name: os.getenv(p["model_env"], p["default_model"]) for name, p in MODEL_PROFILES.items()
+        }
+        # 既定の応答期限[ms]、ヘッジ（cheap への追加呼び出し）の有無と開始までの時間[ms]
+        self.deadline_ms: float = float(os.getenv("LLM_DEADLINE_MS", 8000))
+        self.hedge: bool = os.getenv("LLM_HEDGE", "1") not in ("0", "false", "False")
+        self.hedge_after_ms: Optional[float] = float(os.getenv("LLM_HEDGE_AFTER_MS")) if os.getenv("LLM_HEDGE_AFTER_MS") else None
+        self.cache: RerankCache = cache or rerank_cache
+        self.client: LLMClient = llm_client
+        self.prompt_builder = PromptBuilder(SUGGEST_SCHEMA)
 
     def rerank(
         self,
@@ -70,94 +109,399 @@ class LLMReranker:
         candidates: List[Dict[str, Any]],
         top_k: int = 10,
         model_profile: str = "balanced",
+        deadline_ms: Optional[float] = None,
+        hedge: Optional[bool] = None,
     ) -> Dict[str, Any]:
-        """再ランキングを行い、SUGGEST_SCHEMA 準拠の dict を返す。"""
-        # 1) OpenAI 呼び出し（可能なら）
+        """
+        再ランキングを行い、SUGGEST_SCHEMA 準拠の dict を返す。
+
+        deadline_ms（既定: LLM_DEADLINE_MS）以内に検証済みの LLM 結果が得られなければルールベースの結果を返す。
+        要求された profile のモデルが実績から期限に間に合わないと見込まれる場合は下位の profile に切り替え
+        （外した profile も時々試しに呼んで実績を更新する）、
+        hedge が有効なら途中から cheap でも並行して呼び出し、先に届いた有効な結果を採用する。
+        """
+        t0 = time.perf_counter()
+        # ルールベースのスコアは LLM を待つ前に計算しておく（プロンプトの候補絞り込みにも使う）
+        scored = self._fallback_scores(constraints, candidates)
+
+        reason = "no_llm"
         if self.openai_api_key and candidates:
-            try:
-                llm = self._call_openai(customer, constraints, candidates, top_k, model_profile)
-                if llm:
-                    validate(instance=llm, schema=SUGGEST_SCHEMA)
-                    # ID の整合性チェック
-                    self._ensure_ids_exist(llm, candidates)
-                    return llm
-            except Exception:
-                # LLM 失敗時はフォールバック
-                pass
+            budget = self.deadline_ms if deadline_ms is None else float(deadline_ms)
+            result, reason = self._rerank_within(
+                customer, constraints, candidates, scored, top_k, model_profile,
+                budget, self.hedge if hedge is None else bool(hedge), t0,
+            )
+            if result is not None:
+                return result
+
+        # フォールバック: ルールベースで並べ替え
+        result = self._fallback_result(scored, top_k, reason)
+        result["meta"]["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        return result
 
-        # 2) フォールバック: ルールベースで並べ替え
-        ranked, rejected = self._fallback_rank(customer, constraints, candidates, top_k)
+    def _fallback_result(self, scored: List[Tuple[float, Dict[str, Any]]], top_k: int, reason: str) -> Dict[str, Any]:
+        ranked, rejected = self._split_ranked(scored, top_k)
         return {
             "ranked": ranked,
             "rejected": rejected,
-            "meta": {"source": "fallback"},
+            "meta": {"source": "fallback", "fallback_reason": reason},
         }
 
-    def _call_openai(
+    def _rerank_within(
         self,
         customer: Dict[str, Any],
         constraints: Dict[str, Any],
         candidates: List[Dict[str, Any]],
+        scored: List[Tuple[float, Dict[str, Any]]],
         top_k: int,
         model_profile: str,
-    ) -> Optional[Dict[str, Any]]:
-        system = (
-            "You are a travel planner reranker."
-            " Rank items strictly based on constraints (budget, weather, season, accessibility)."
-            " Return only JSON with fields: ranked[], rejected[]."
-        )
-        # 入力をコンパクト化
-        brief_candidates = [
-            {
-                "id": c.get("destination_id") or c.get("id"),
-                "name": c.get("name"),
-                "category": c.get("category"),
-                "indoor": bool(c.get("indoor", False)),
-                "barrier_free": bool(c.get("barrier_free", False)),
-                "stroller_friendly": bool(c.get("stroller_friendly", False)),
-                "price_min_yen": c.get("price_min_yen"),
-                "crowd_level": c.get("crowd_level"),
-                "duration_min": c.get("estimated_duration_minutes") or c.get("estimated_duration"),
+        budget_ms: float,
+        hedge: bool,
+        t0: float,
+    ) -> Tuple[Optional[Dict[str, Any]], str]:
+        """期限内に LLM の結果を得る（得られなければ (None, 理由)）"""
+        if model_profile not in MODEL_PROFILES:
+            model_profile = "balanced"
+        prompt = self._build_prompt(customer, constraints, [c for _, c in scored], top_k)
+        requests_by_profile = {}
+        for profile in PROFILE_ORDER[PROFILE_ORDER.index(model_profile):]:
+            body = self._body(prompt, profile)
+            requests_by_profile[profile] = (body, prompt_key(body))
+
+        # 同じプロンプトの結果がキャッシュにあればそれを使う（要求以下のどの profile でも可）
+        for profile, (body, key) in requests_by_profile.items():
+            cached = self._cached_result(key, candidates)
+            if cached is not None:
+                cached["meta"].setdefault("profile", profile)
+                return cached, "cache"
+
+        profiles = self._plan_profiles(model_profile, budget_ms, hedge)
+        # 見積もりで外した profile も時々呼び、見積もりを更新する（結果はキャッシュに入る）
+        order = PROFILE_ORDER[PROFILE_ORDER.index(model_profile):]
+        for profile in order[:order.index(profiles[0])] if profiles else order:
+            self._probe(profile, candidates, prompt, requests_by_profile[profile])
+        if not profiles:
+            return None, "budget"
+
+        deadline = t0 + budget_ms / 1000
+        primary, hedge_profile = profiles[0], (profiles[1] if len(profiles) > 1 else None)
+        # 同じモデル・温度なら本文もキーも同じで、single-flight で本命の呼び出しにまとめられるだけなのでヘッジしない
+        if hedge_profile is not None and requests_by_profile[hedge_profile][1] == requests_by_profile[primary][1]:
+            hedge_profile = None
+        pending: Dict[Future, str] = {}
+
+        def launch(profile: str) -> None:
+            body, key = requests_by_profile[profile]
+            pending[self.client.submit_chat(self.openai_base_url, self.openai_api_key, body, key=key)] = profile
+
+        launch(primary)
+        hedge_at = None
+        if hedge_profile is not None:
+            hedge_at = t0 + self._hedge_delay_ms(primary, budget_ms) / 1000
+
+        reason = "deadline"
+        try:
+            while pending:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                wake = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, _ = wait(list(pending), timeout=max(0.0, wake - now), return_when=FIRST_COMPLETED)
+                for future in done:
+                    profile = pending.pop(future)
+                    result = self._accept_future(future, candidates, prompt, requests_by_profile[profile])
+                    if result is None:
+                        reason = "error"
+                        continue
+                    result["meta"].update({
+                        "profile": profile,
+                        "model": requests_by_profile[profile][0]["model"],
+                        "hedged": profile != primary,
+                        "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1),
+                    })
+                    log_event(logger, logging.INFO, "llm.rerank", profile=profile,
+                              requested=model_profile, hedged=result["meta"]["hedged"],
+                              ms=result["meta"]["elapsed_ms"], budget_ms=budget_ms)
+                    return result, "llm"
+                # ヘッジ開始時刻になった、または先行の呼び出しが失敗した
+                if hedge_at is not None and (time.perf_counter() >= hedge_at or not pending):
+                    launch(hedge_profile)
+                    hedge_at = None
+            if pending:
+                reason = "deadline"
+            log_event(logger, logging.WARNING, "llm.rerank_fallback", reason=reason,
+                      requested=model_profile, budget_ms=budget_ms)
+            return None, reason
+        finally:
+            # 期限に間に合わなかった呼び出しも、届いた結果はキャッシュに残して次回に使う
+            for future, profile in pending.items():
+                future.add_done_callback(
+                    lambda f, p=profile: self._accept_future(f, candidates, prompt, requests_by_profile[p])
+                )
+
+    def _plan_profiles(self, requested: str, budget_ms: float, hedge: bool) -> List[str]:
+        """
+        呼び出す profile の順（先頭が本命、2つ目がヘッジ）
+
+        要求された profile から下位へ順に、応答時間の実績が期限内に収まるものを本命とする（実績が無いものは試す）
+        """
+        order = PROFILE_ORDER[PROFILE_ORDER.index(requested):]
+        fits = [
+            p for p in order
+            if (self.client.expected_ms(self.profile_models[p]) or 0.0) <= budget_ms
+        ]
+        if not fits:
+            return []
+        profiles = [fits[0]]
+        if hedge and fits[0] != "cheap" and "cheap" in fits:
+            profiles.append("cheap")
+        return profiles
+
+    def _probe(self, profile: str, candidates: List[Dict[str, Any]], prompt: Dict[str, Any],
+               request: Tuple[Dict[str, Any], str]) -> None:
+        """使わなかった profile を待たずに呼ぶ（モデルごとに LLM_PROBE_INTERVAL_SECONDS に1回まで）"""
+        body, key = request
+        if not self.client.should_probe(body["model"]):
+            return
+        log_event(logger, logging.INFO, "llm.probe", profile=profile, model=body["model"])
+        future = self.client.submit_chat(self.openai_base_url, self.openai_api_key, body, key=key)
+        future.add_done_callback(lambda f: self._accept_future(f, candidates, prompt, request))
+
+    def _hedge_delay_ms(self, primary: str, budget_ms: float) -> float:
+        """ヘッジを始めるまでの時間（既定は期限の半分、本命の実績が期限の半分を超えるなら即時）"""
+        if self.hedge_after_ms is not None:
+            return min(self.hedge_after_ms, budget_ms)
+        expected = self.client.expected_ms(self.profile_models[primary])
+        if expected is not None and expected > budget_ms / 2:
+            return 0.0
+        return budget_ms / 2
+
+    def _accept_future(self, future: Future, candidates: List[Dict[str, Any]], prompt: Dict[str, Any],
+                       request: Tuple[Dict[str, Any], str]) -> Optional[Dict[str, Any]]:
+        """完了した呼び出しの結果を検証してキャッシュに登録（無効・失敗なら None）"""
+        if future.cancelled() or future.exception() is not None:
+            return None
+        return self._accept(future.result(), candidates, prompt, request)
+
+    def _accept(self, llm: Optional[Dict[str, Any]], candidates: List[Dict[str, Any]], prompt: Dict[str, Any],
+                request: Tuple[Dict[str, Any], str]) -> Optional[Dict[str, Any]]:
+        """LLM の結果を検証し、送らなかった候補などを補ってキャッシュに登録"""
+        if not llm:
+            return None
+        try:
+            SUGGEST_VALIDATOR.validate(llm)
+            # ID の整合性チェック
+            self._ensure_ids_exist(llm, candidates)
+        except ValidationError:
+            return None
+        body, key = request
+        result = self._with_prompt_info(llm, prompt)
+        self.cache.put(key, result, model=body["model"])
+        return {**result, "meta": dict(result["meta"])}
+
+    def _cached_result(self, key: str, candidates: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """キャッシュ済みの結果（スキーマ変更などで無効になったエントリは捨てる）"""
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+        try:
+            SUGGEST_VALIDATOR.validate(cached)
+            self._ensure_ids_exist(cached, candidates)
+        except ValidationError:
+            self.cache.invalidate(key)
+            return None
+        return {**cached, "meta": {**(cached.get("meta") or {}), "cache": "hit"}}
+
+    def rerank_batch(
+        self,
+        items: List[Dict[str, Any]],
+        top_k: int = 10,
+        model_profile: str = "balanced",
+        batch_size: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        複数顧客の再ランキングを、数人ずつ1つのプロンプトにまとめて実行する（前日夜の一括処理用）
+
+        顧客ごとの結果は単独の rerank と同じキーでキャッシュに登録するので、
+        同じ条件（constraints / top_k / model_profile / 候補）の suggest はキャッシュから即答になる。
+        まとめた応答のうち検証に通らなかった顧客は単独で呼び直し、それも失敗したらルールベースの結果にする。
+
+        Args:
+            items: [{"customer": 顧客情報, "constraints": {...}, "candidates": [...]}, ...]
+            batch_size: 1プロンプトにまとめる人数（既定: LLM_BATCH_SIZE または 4）
+
+        Returns:
+            items と同順の結果（SUGGEST_SCHEMA 準拠。meta.source は llm / fallback、meta.batch は処理方法）
+        """
+        profile = model_profile if model_profile in MODEL_PROFILES else "balanced"
+        batch_size = max(1, int(batch_size or os.getenv("LLM_BATCH_SIZE", 4)))
+        results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+        pending = []
+        for i, item in enumerate(items):
+            scored = self._fallback_scores(item["constraints"], item["candidates"])
+            entry = {"index": i, "scored": scored, "candidates": item["candidates"]}
+            if self.openai_api_key and item["candidates"]:
+                entry["prompt"] = self._build_prompt(item["customer"], item["constraints"],
+                                                     [c for _, c in scored], top_k)
+                body = self._body(entry["prompt"], profile)
+                entry["request"] = (body, prompt_key(body))
+                cached = self._cached_result(entry["request"][1], item["candidates"])
+                if cached is not None:
+                    results[i] = {**cached, "meta": {**cached["meta"], "batch": "cached"}}
+                    continue
+                pending.append(entry)
+            else:
+                results[i] = self._fallback_result(scored, top_k, "no_llm")
+
+        # まとめて問い合わせ（バッチ同士は同時実行数の上限内で並行）
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        futures = []
+        for batch in batches:
+            body = {
+                "model": self.profile_models[profile],
+                "temperature": MODEL_PROFILES[profile]["temperature"],
+                "response_format": {"type": "json_object"},
+                "messages": self.prompt_builder.build_batch([(str(e["index"]), e["prompt"]) for e in batch]),
             }
-            for c in candidates
+            futures.append((batch, self.client.submit_chat(self.openai_base_url, self.openai_api_key, body,
+                                                           track_latency=False)))
+
+        retry = []
+        for batch, future in futures:
+            try:
+                response = future.result(timeout=self.client.queue_timeout + self.client.timeout + 5)
+            except Exception as e:
+                log_event(logger, logging.WARNING, "llm.batch_failed", size=len(batch),
+                          error=str(e) or type(e).__name__)
+                response = None
+            slices = {}
+            if isinstance(response, dict) and isinstance(response.get("results"), list):
+                slices = {str(r.get("key")): r for r in response["results"] if isinstance(r, dict)}
+            for entry in batch:
+                part = slices.get(str(entry["index"]))
+                if part is not None:
+                    part = {k: v for k, v in part.items() if k != "key"}
+                result = self._accept(part, entry["candidates"], entry["prompt"], entry["request"])
+                if result is None:
+                    retry.append(entry)
+                else:
+                    results[entry["index"]] = {**result, "meta": {**result["meta"], "batch": "batched"}}
+
+        # 検証に通らなかった顧客は単独で呼び直す
+        singles = [
+            (entry, self.client.submit_chat(self.openai_base_url, self.openai_api_key, entry["request"][0],
+                                            key=entry["request"][1]))
+            for entry in retry
         ]
-        user = {
-            "customer": {
-                "id": customer.get("顧客ID") or customer.get("id") or customer.get("customer_id"),
-                "adults": customer.get("adults"),
-                "children": customer.get("children"),
-                "seniors": customer.get("seniors"),
-                "needs_stroller": customer.get("needs_stroller"),
-                "needs_wheelchair": customer.get("needs_wheelchair"),
-                "interests": customer.get("interests", []),
-            },
-            "constraints": constraints,
-            "top_k": top_k,
-            "candidates": brief_candidates,
-            "output_schema": SUGGEST_SCHEMA,
+        for entry, future in singles:
+            try:
+                llm = future.result(timeout=self.client.queue_timeout + self.client.timeout + 5)
+            except Exception:
+                llm = None
+            result = self._accept(llm, entry["candidates"], entry["prompt"], entry["request"])
+            if result is None:
+                results[entry["index"]] = self._fallback_result(entry["scored"], top_k, "error")
+            else:
+                results[entry["index"]] = {**result, "meta": {**result["meta"], "batch": "single"}}
+
+        log_event(logger, logging.INFO, "llm.batch_completed", items=len(items), batches=len(batches),
+                  retried=len(retry),
+                  fallback=sum(1 for r in results if r["meta"]["source"] == "fallback"))
+        return results
+
+    def iter_rerank(
+        self,
+        customer: Dict[str, Any],
+        constraints: Dict[str, Any],
+        candidates: List[Dict[str, Any]],
+        top_k: int = 10,
+        model_profile: str = "balanced",
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        ストリーミング版の再ランキング。ルールベースの結果をすぐに返し、LLM の結果が揃って検証を通ったら差し替える
+
+        Yields:
+            {"stage": "fallback", "suggest": {...}}（即時）
+            {"stage": "progress", "ranked": n}（LLM の ranked 要素が完成するたび）
+            {"stage": "llm", "suggest": {...}}（検証済みの LLM 結果）、失敗時は {"stage": "llm", "status": "error", "message"}
+            最後に {"done": True, "source": "llm" | "fallback", "ms": 所要時間}
+        """
+        t0 = time.perf_counter()
+        scored = self._fallback_scores(constraints, candidates)
+        ranked, rejected = self._split_ranked(scored, top_k)
+        yield {
+            "stage": "fallback",
+            "ms": round((time.perf_counter() - t0) * 1000, 2),
+            "suggest": {"ranked": ranked, "rejected": rejected, "meta": {"source": "fallback"}},
         }
+        if not (self.openai_api_key and candidates):
+            yield {"done": True, "source": "fallback", "ms": round((time.perf_counter() - t0) * 1000, 2)}
+            return
+
+        # フォールバックを返した後は、どこで失敗しても最後に done を返す
+        try:
+            prompt = self._build_prompt(customer, constraints, [c for _, c in scored], top_k)
+            body = self._body(prompt, model_profile if model_profile in MODEL_PROFILES else "balanced")
+            key = prompt_key(body)
+            llm = self._cached_result(key, candidates)
+            if llm is None:
+                scanner = JsonObjectScanner(track_keys=("ranked",))
+                reported = 0
+                for delta in self.client.iter_chat_stream(self.openai_base_url, self.openai_api_key, body):
+                    if scanner.feed(delta) is not None:
+                        break
+                    if scanner.counts["ranked"] > reported:
+                        reported = scanner.counts["ranked"]
+                        yield {"stage": "progress", "ranked": reported}
+                if not scanner.complete:
+                    raise ValueError("LLM の応答が JSON オブジェクトとして完結しませんでした")
+                llm = self._accept(json.loads(scanner.document), candidates, prompt, (body, key))
+                if llm is None:
+                    raise ValueError("LLM の応答がスキーマ検証を通りませんでした")
+        except Exception as e:
+            # LLM 失敗時はフォールバックのまま
+            yield {"stage": "llm", "status": "error", "message": str(e) or type(e).__name__}
+            yield {"done": True, "source": "fallback", "ms": round((time.perf_counter() - t0) * 1000, 2)}
+            return
+        yield {"stage": "llm", "ms": round((time.perf_counter() - t0) * 1000, 2), "suggest": llm}
+        yield {"done": True, "source": "llm", "ms": round((time.perf_counter() - t0) * 1000, 2)}
 
-        url = f"{self.openai_base_url}/chat/completions"
-        headers = {"Authorization": f"Bearer {self.openai_api_key}", "Content-Type": "application/json"}
-        body = {
-            "model": self.openai_model,
-            "temperature": 0.2 if model_profile == "quality" else 0.0,
+    def _build_prompt(
+        self,
+        customer: Dict[str, Any],
+        constraints: Dict[str, Any],
+        ranked_candidates: List[Dict[str, Any]],
+        top_k: int,
+    ) -> Dict[str, Any]:
+        """トークン予算内のプロンプト（profile 間で共通）"""
+        prompt = self.prompt_builder.build(customer, constraints, ranked_candidates, top_k)
+        log_event(logger, logging.INFO, "llm.prompt", tokens_est=prompt["estimated_tokens"]["total"],
+                  sent=len(prompt["sent_ids"]), pruned=len(prompt["pruned_ids"]))
+        return prompt
+
+    def _body(self, prompt: Dict[str, Any], profile: str) -> Dict[str, Any]:
+        """Chat Completions のリクエスト本文（キャッシュキーの元にもなる）"""
+        return {
+            "model": self.profile_models[profile],
+            "temperature": MODEL_PROFILES[profile]["temperature"],
             "response_format": {"type": "json_object"},
-            "messages": [
-                {"role": "system", "content": system},
-                {"role": "user", "content": json.dumps(user, ensure_ascii=False)},
-            ],
+            "messages": prompt["messages"],
         }
 
-        resp = requests.post(url, headers=headers, json=body, timeout=30)
-        if resp.status_code >= 400:
-            return None
-        data = resp.json()
-        try:
-            content = data["choices"][0]["message"]["content"]
-            return json.loads(content)
-        except Exception:
-            return None
+    def _with_prompt_info(self, result: Dict[str, Any], prompt: Dict[str, Any]) -> Dict[str, Any]:
+        """送らなかった候補を rejected に加え、推定トークン数を meta に記録"""
+        listed = {item.get("id") for item in result["ranked"] + result["rejected"]}
+        rejected = result["rejected"] + [
+            {"id": cid, "reasons": ["pruned"]} for cid in prompt["pruned_ids"] if cid not in listed
+        ]
+        meta = {
+            **(result.get("meta") or {}),
+            "source": "llm",
+            "prompt_tokens_est": prompt["estimated_tokens"]["total"],
+            "candidates_sent": len(prompt["sent_ids"]),
+            "candidates_pruned": len(prompt["pruned_ids"]),
+        }
+        return {**result, "rejected": rejected, "meta": meta}
 
     def _fallback_rank(
         self,
@@ -166,6 +510,14 @@ class LLMReranker:
         candidates: List[Dict[str, Any]],
         top_k: int,
     ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        return self._split_ranked(self._fallback_scores(constraints, candidates), top_k)
+
+    def _fallback_scores(
+        self,
+        constraints: Dict[str, Any],
+        candidates: List[Dict[str, Any]],
+    ) -> List[Tuple[float, Dict[str, Any]]]:
+        """ルールベースのスコアで候補を並べ替える（プロンプトの候補絞り込みにも使う）"""
         budget = constraints.get("budget_yen")
         weather = constraints.get("weather")  # 'sunny'|'rainy'|'cloudy'
         crowd_avoid = constraints.get("crowd_avoid")  # 'off'|'mid'|'high'
@@ -191,6 +543,13 @@ class LLMReranker:
             scored.append((score, c))
 
         scored.sort(key=lambda x: x[0], reverse=True)
+        return scored
+
+    def _split_ranked(
+        self,
+        scored: List[Tuple[float, Dict[str, Any]]],
+        top_k: int,
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
         ranked_items = [
             {"id": (c.get("destination_id") or c.get("id") or ""), "score": s}
             for s, c in scored[:top_k]
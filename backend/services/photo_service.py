@@ -0,0 +1,353 @@
+"""
+カード用写真の検索キャッシュとサムネイルプロキシ（FastAPI の /media/photo・/media/thumb 用）
+
+- 検索語 → 画像 URL を SQLite に保存する（見つからなかった結果も短めの期限で保存）
+- 検索は Openverse → 日本語版 Wikipedia → 英語版 Wikipedia を同時に投げ、その優先順で最初に見つかったものを使う
+- 同じ検索語の同時リクエストは1回の検索にまとめる
+- プロキシ有効時は画像を1回だけダウンロードしてディスクに置き、再検証の間隔と同じ期間ブラウザにキャッシュさせるヘッダ付きで返す
+  （期限が来たら ETag / Last-Modified で条件付き GET して再検証）
+
+一括プリフェッチ（backend ディレクトリで）:
+    python -m services.photo_service --concurrency 4
+
+環境変数:
+- PHOTO_CACHE_PATH: SQLite ファイル（既定: backend/instance/photo_cache.db）
+- PHOTO_CACHE_TTL_SECONDS: 見つかった URL の有効期限（既定: 2592000 = 30日）
+- PHOTO_CACHE_NEGATIVE_TTL_SECONDS: 見つからなかった結果の有効期限（既定: 86400 = 1日）
+- PHOTO_PROXY: 1 でサムネイルプロキシを使う（既定: 0）
+- PHOTO_THUMB_DIR: サムネイルの保存先（既定: backend/instance/thumbs）
+- PHOTO_THUMB_REVALIDATE_SECONDS: サムネイルを再検証するまでの期間（既定: 604800 = 7日）
+- PHOTO_THUMB_MAX_BYTES: ダウンロードする画像の上限サイズ（既定: 5MB）
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils.async_http import http_pool
+from utils.sqlite_pool import SQLitePool
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('photo')
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance')
+
+
+async def search_openverse(query: str) -> Optional[str]:
+    odata = await http_pool.get_json("https://api.openverse.engineering/v1/images/", {"q": query, "page_size": 1})
+    results = odata.get("results") or []
+    if results:
+        first = results[0]
+        return first.get("thumbnail") or first.get("url")
+    return None
+
+
+async def search_wikipedia(query: str, lang: str) -> Optional[str]:
+    q = {
+        "action": "query",
+        "generator": "search",
+        "gsrsearch": query,
+        "gsrlimit": 1,
+        "prop": "pageimages",
+        "piprop": "thumbnail",
+        "pithumbsize": 160,
+        "format": "json",
+        "origin": "*",
+    }
+    data = await http_pool.get_json(f"https://{lang}.wikipedia.org/w/api.php", q)
+    pages = (data.get("query", {}) or {}).get("pages", {})
+    for _, p in pages.items():
+        thumb = (p.get("thumbnail") or {}).get("source")
+        if thumb:
+            return thumb
+    return None
+
+
+async def search_photo(query: str) -> Tuple[Optional[str], Optional[str], bool]:
+    """
+    全ソースを同時に検索し、優先順で最初に見つかった URL を返す
+    先行するソースがすべて答えた時点で返し、残りはキャンセルする
+
+    Returns:
+        (URL, ソース名, 失敗したソースがあったか)
+    """
+    sources = [
+        ("openverse", search_openverse(query)),
+        ("wikipedia_ja", search_wikipedia(query, "ja")),
+        ("wikipedia_en", search_wikipedia(query, "en")),
+    ]
+    tasks = [(name, asyncio.create_task(coro)) for name, coro in sources]
+    failed = False
+    try:
+        for name, task in tasks:
+            try:
+                url = await task
+            except Exception as e:
+                failed = True
+                log_event(logger, logging.DEBUG, 'photo.source_failed', source=name, error=repr(e))
+                continue
+            if url:
+                return url, name, failed
+        return None, None, failed
+    finally:
+        for _, task in tasks:
+            task.cancel()
+
+
+def thumb_key(url: str) -> str:
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+
+class PhotoService:
+    """検索結果キャッシュとサムネイルの保存・再検証"""
+
+    def __init__(self, db_path: Optional[str] = None, thumb_dir: Optional[str] = None):
+        self.db_path = db_path or os.getenv('PHOTO_CACHE_PATH') or os.path.join(INSTANCE_DIR, 'photo_cache.db')
+        self.thumb_dir = thumb_dir or os.getenv('PHOTO_THUMB_DIR') or os.path.join(INSTANCE_DIR, 'thumbs')
+        self.ttl_seconds = float(os.getenv('PHOTO_CACHE_TTL_SECONDS', 30 * 86400))
+        self.negative_ttl_seconds = float(os.getenv('PHOTO_CACHE_NEGATIVE_TTL_SECONDS', 86400))
+        self.proxy_enabled = os.getenv('PHOTO_PROXY', '0') == '1'
+        self.revalidate_seconds = float(os.getenv('PHOTO_THUMB_REVALIDATE_SECONDS', 7 * 86400))
+        self.max_bytes = int(os.getenv('PHOTO_THUMB_MAX_BYTES', 5 * 1024 * 1024))
+        self.db = SQLitePool(self.db_path, size=2)
+        self._ready = False
+        self._ready_lock = threading.Lock()
+        self._searches: Dict[str, asyncio.Task] = {}
+        self._downloads: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def _ensure_schema(self) -> None:
+        if self._ready:
+            return
+        with self._ready_lock:
+            if self._ready:
+                return
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            os.makedirs(self.thumb_dir, exist_ok=True)
+            with self.db.connection() as conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS photo_urls (
+                        query TEXT PRIMARY KEY,
+                        url TEXT,
+                        source TEXT,
+                        fetched_at REAL NOT NULL
+                    )
+                    """
+                )
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS thumbnails (
+                        key TEXT PRIMARY KEY,
+                        url TEXT NOT NULL,
+                        content_type TEXT,
+                        digest TEXT,
+                        etag TEXT,
+                        last_modified TEXT,
+                        fetched_at REAL
+                    )
+                    """
+                )
+            self._ready = True
+
+    def _execute(self, sql: str, params: Tuple = ()) -> None:
+        self._ensure_schema()
+        with self.db.connection() as conn:
+            conn.execute(sql, params)
+
+    def _fetchone(self, sql: str, params: Tuple = ()) -> Optional[Dict[str, Any]]:
+        self._ensure_schema()
+        row = self.db.fetchone(sql, params)
+        return dict(row) if row else None
+
+    async def lookup(self, query: str) -> Dict[str, Any]:
+        """
+        検索語の画像 URL
+
+        Returns:
+            {"url": URL または None, "source": ソース名, "cache": "hit" | "negative" | "miss" | "stale"}
+        """
+        query = query.strip()
+        row = await self.db.run(self._fetchone, "SELECT * FROM photo_urls WHERE query = ?", (query,))
+        if row:
+            ttl = self.ttl_seconds if row['url'] else self.negative_ttl_seconds
+            if time.time() - row['fetched_at'] < ttl:
+                if row['url']:
+                    self.hits += 1
+                else:
+                    self.negative_hits += 1
+                return {"url": row['url'], "source": row['source'], "cache": "hit" if row['url'] else "negative"}
+
+        self.misses += 1
+        task = self._searches.get(query)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._search_and_store(query))
+            self._searches[query] = task
+            task.add_done_callback(lambda _: self._searches.pop(query, None))
+        url, source, failed = await asyncio.shield(task)
+        if url is None and failed and row:
+            # 検索に失敗しただけなら、期限切れでも以前の結果を返す
+            return {"url": row['url'], "source": row['source'], "cache": "stale"}
+        return {"url": url, "source": source, "cache": "miss"}
+
+    async def _search_and_store(self, query: str) -> Tuple[Optional[str], Optional[str], bool]:
+        url, source, failed = await search_photo(query)
+        # 失敗したソースがある「見つからない」は一時的な可能性があるので保存しない
+        if url or not failed:
+            await self.db.run(
+                self._execute,
+                "INSERT OR REPLACE INTO photo_urls (query, url, source, fetched_at) VALUES (?, ?, ?, ?)",
+                (query, url, source, time.time()),
+            )
+        return url, source, failed
+
+    async def register_thumb(self, url: str) -> str:
+        """プロキシで配信する画像 URL を登録してキーを返す（登録済みの URL しか配信しない）"""
+        key = thumb_key(url)
+        await self.db.run(self._execute, "INSERT OR IGNORE INTO thumbnails (key, url) VALUES (?, ?)", (key, url))
+        return key
+
+    def thumb_path(self, key: str) -> str:
+        return os.path.join(self.thumb_dir, key)
+
+    async def thumbnail(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        保存済みのサムネイル（無ければダウンロード、期限切れなら再検証）
+
+        Returns:
+            {"path", "content_type", "digest", "last_modified"}、未登録・取得失敗なら None
+        """
+        row = await self.db.run(self._fetchone, "SELECT * FROM thumbnails WHERE key = ?", (key,))
+        if row is None:
+            return None
+        on_disk = row['digest'] is not None and os.path.exists(self.thumb_path(key))
+        if not on_disk or time.time() - (row['fetched_at'] or 0) >= self.revalidate_seconds:
+            task = self._downloads.get(key)
+            if task is None:
+                task = asyncio.get_running_loop().create_task(self._download(row, on_disk))
+                self._downloads[key] = task
+                task.add_done_callback(lambda _: self._downloads.pop(key, None))
+            try:
+                row = await asyncio.shield(task)
+            except Exception as e:
+                log_event(logger, logging.WARNING, 'photo.thumb_failed', key=key, error=repr(e))
+                if not on_disk:
+                    return None
+        return {
+            "path": self.thumb_path(key),
+            "content_type": row['content_type'] or 'application/octet-stream',
+            "digest": row['digest'],
+            "last_modified": row['last_modified'],
+        }
+
+    async def _download(self, row: Dict[str, Any], on_disk: bool) -> Dict[str, Any]:
+        headers = {}
+        if on_disk and row['etag']:
+            headers['If-None-Match'] = row['etag']
+        if on_disk and row['last_modified']:
+            headers['If-Modified-Since'] = row['last_modified']
+        # 上限を超える画像は最後まで読まずに打ち切る
+        resp, content = await http_pool.download('GET', row['url'], self.max_bytes, headers=headers,
+                                                 follow_redirects=True)
+        now = time.time()
+        if resp.status_code == 304 and on_disk:
+            await self.db.run(self._execute, "UPDATE thumbnails SET fetched_at = ? WHERE key = ?", (now, row['key']))
+            return {**row, 'fetched_at': now}
+        resp.raise_for_status()
+        content_type = resp.headers.get('content-type', '').split(';')[0].strip()
+        if not content_type.startswith('image/'):
+            raise ValueError(f'not an image: {content_type or "unknown"}')
+
+        def store() -> Dict[str, Any]:
+            self._ensure_schema()
+            path = self.thumb_path(row['key'])
+            tmp = f'{path}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, path)
+            updated = {
+                **row,
+                'content_type': content_type,
+                'digest': hashlib.sha256(content).hexdigest()[:32],
+                'etag': resp.headers.get('etag'),
+                'last_modified': resp.headers.get('last-modified'),
+                'fetched_at': now,
+            }
+            self._execute(
+                "UPDATE thumbnails SET content_type = ?, digest = ?, etag = ?, last_modified = ?, fetched_at = ? WHERE key = ?",
+                (updated['content_type'], updated['digest'], updated['etag'], updated['last_modified'], now, row['key']),
+            )
+            return updated
+
+        return await self.db.run(store)
+
+    async def prefetch(self, queries: Iterable[str], concurrency: int = 4, thumbs: bool = True) -> Dict[str, Any]:
+        """検索語をまとめて解決し、必要ならサムネイルもダウンロードしておく"""
+        slots = asyncio.Semaphore(concurrency)
+        counts = {"queries": 0, "found": 0, "not_found": 0, "thumbs": 0, "thumb_failed": 0}
+
+        async def one(query: str) -> None:
+            async with slots:
+                found = await self.lookup(query)
+                counts["queries"] += 1
+                if not found["url"]:
+                    counts["not_found"] += 1
+                    return
+                counts["found"] += 1
+                if thumbs:
+                    key = await self.register_thumb(found["url"])
+                    if await self.thumbnail(key):
+                        counts["thumbs"] += 1
+                    else:
+                        counts["thumb_failed"] += 1
+
+        await asyncio.gather(*(one(q) for q in dict.fromkeys(q.strip() for q in queries if q and q.strip())))
+        return counts
+
+    def stats(self) -> Dict[str, Any]:
+        served = self.hits + self.negative_hits + self.misses
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.negative_hits) / served, 3) if served else None,
+            "proxy": self.proxy_enabled,
+        }
+
+
+# シングルトンインスタンス
+photo_service = PhotoService()
+
+
+def catalog_queries() -> List[str]:
+    """プランナーのカードに出る名前（カタログ項目と観光地）"""
+    from data.data_loader import data_loader
+    names = [item['name'] for item in data_loader.load_catalog_items()]
+    names += [d['name'] for d in data_loader.load_destinations() if d.get('name')]
+    return names
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='カタログ全体の写真 URL・サムネイルを事前に取得する')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--no-thumbs', action='store_true', help='URL の解決だけ行う')
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    result = asyncio.run(photo_service.prefetch(catalog_queries(), concurrency=args.concurrency,
+                                                thumbs=not args.no_thumbs))
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    log_event(logger, logging.INFO, 'photo.prefetch_completed', **result)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
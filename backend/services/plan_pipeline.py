@@ -0,0 +1,255 @@
+"""
+プラン作成パイプライン
+推薦 → 選定 → ルート → 旅程 をサーバー内で一括実行する
+
+観光地が明示指定されている場合は、推薦と並行してルート（道路ジオメトリ）を取得する
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+from services.destination_service import DestinationService
+from services.hotel_service import hotel_service
+from services.itinerary_service import ItineraryService
+from services.route_service import RouteService
+from services.scheduler import parse_hhmm
+from utils import geo
+from utils.osrm_client import FALLBACK_SPEED_KMH
+from utils.telemetry import get_logger, log_event, span
+
+logger = get_logger('plan')
+
+
+class PlanPipeline:
+    """推薦から旅程までを1回で作成するパイプライン"""
+
+    # 推薦候補数・選定する観光地数の既定値
+    default_limit = 10
+    default_select = 3
+
+    def __init__(self):
+        self.destination_service = DestinationService()
+        self.route_service = RouteService()
+        self.itinerary_service = ItineraryService()
+        self.hotel_service = hotel_service
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='plan')
+
+    def run(self, params: Dict) -> Dict:
+        """
+        パイプラインを実行して1つの結果にまとめる
+
+        Args:
+            params: iter_stages と同じ
+
+        Returns:
+            candidates / selected / route / itinerary を含む辞書（失敗時は status=error）
+        """
+        result: Dict = {'status': 'success'}
+        for item in self.iter_stages(params):
+            if item.get('done'):
+                result['meta'] = item['meta']
+            elif item.get('status') == 'error':
+                return {'status': 'error', 'stage': item['stage'], 'message': item['message']}
+            else:
+                result.update(item['data'])
+        return result
+
+    def validate(self, params: Dict) -> Optional[str]:
+        """
+        入力を検証（ストリームで段階を返し始める前に呼び、400 を返せるようにする）
+
+        Returns:
+            エラーメッセージ（問題なければ None）
+        """
+        if not params.get('customer_id'):
+            return 'customer_idが必要です'
+        start_time = params.get('start_time') or self.itinerary_service.default_start_time
+        end_time = params.get('end_time') or '18:00'
+        if parse_hhmm(start_time) is None or parse_hhmm(end_time) is None:
+            return '時刻の形式が不正です (HH:MM)'
+        for key in ('limit', 'select'):
+            value = params.get(key)
+            if value is None:
+                continue
+            try:
+                if isinstance(value, bool) or int(value) < 1:
+                    raise ValueError
+            except (TypeError, ValueError):
+                return f'{key} は1以上の整数で指定してください'
+        return None
+
+    def iter_stages(self, params: Dict) -> Iterator[Dict]:
+        """
+        パイプラインを実行し、段階ごとの結果を順に返すジェネレータ
+
+        Args:
+            params:
+                - customer_id: 顧客ID（必須）
+                - weather / season / budget_yen / crowd_avoid: 推薦条件
+                - limit: 推薦候補数（既定: 10）
+                - select: 選定する観光地数（既定: 3）
+                - destination_ids: 訪問する観光地を明示指定（指定時は選定を省略）
+                - optimize: 訪問順を最適化するか（既定: True）
+                - start_time / end_time / travel_date: 旅程の時間枠
+                - detailed: 営業時間・食事枠を考慮した詳細旅程にするか（既定: True）
+
+        Yields:
+            {"stage": 名前, "ms": 所要時間, "data": {...}}、失敗時は {"stage", "status": "error", "message"}、
+            最後に {"done": True, "meta": {...}}
+        """
+        error = self.validate(params)
+        if error:
+            yield {'stage': 'recommend', 'status': 'error', 'message': error}
+            return
+        t0 = time.perf_counter()
+        timings: Dict[str, float] = {}
+        customer_id = params['customer_id']
+        start_time = params.get('start_time') or self.itinerary_service.default_start_time
+        end_time = params.get('end_time') or '18:00'
+        hotel = self.hotel_service.hotel
+        explicit_ids = params.get('destination_ids')
+
+        # 明示指定があれば、推薦と並行してルートを先に取得
+        early_route = None
+        if explicit_ids:
+            early_route = self._executor.submit(self._route, explicit_ids, params.get('optimize', True))
+        try:
+            with span('plan.recommend') as rec:
+                recommended = self.destination_service.get_recommended_destinations(
+                    customer_id=customer_id,
+                    weather=params.get('weather', 'sunny'),
+                    season=params.get('season', 'spring'),
+                    limit=int(params.get('limit') or self.default_limit),
+                    budget_yen=params.get('budget_yen'),
+                    crowd_avoid=params.get('crowd_avoid'),
+                    origin=(hotel['longitude'], hotel['latitude'])
+                )
+            timings['recommend'] = rec['ms']
+            if recommended['status'] != 'success':
+                yield {'stage': 'recommend', 'status': 'error', 'message': recommended['message']}
+                return
+            yield {
+                'stage': 'recommend',
+                'ms': rec['ms'],
+                'data': {
+                    'customer_info': recommended['customer_info'],
+                    'candidates': recommended['destinations'],
+                }
+            }
+
+            with span('plan.select') as sel:
+                if explicit_ids:
+                    selected = self._explicit_selection(explicit_ids, recommended)
+                else:
+                    selected = self._select(recommended['destinations'], start_time, end_time,
+                                            int(params.get('select') or self.default_select))
+            timings['select'] = sel['ms']
+            if not selected:
+                yield {'stage': 'select', 'status': 'error', 'message': '時間枠に収まる観光地がありません'}
+                return
+            yield {'stage': 'select', 'ms': sel['ms'], 'data': {'selected': selected}}
+
+            with span('plan.route') as rt:
+                if early_route is not None:
+                    route = early_route.result()
+                else:
+                    route = self._route([d['destination_id'] for d in selected], params.get('optimize', True))
+            timings['route'] = rt['ms']
+            if route['status'] != 'success':
+                yield {'stage': 'route', 'status': 'error', 'message': route['message']}
+                return
+            yield {
+                'stage': 'route',
+                'ms': rt['ms'],
+                'data': {'route': route['route'], 'route_summary': route['summary']}
+            }
+
+            with span('plan.itinerary') as it:
+                if params.get('detailed', True):
+                    itinerary = self.itinerary_service.create_detailed_schedule(route['route'], {
+                        'start_time': start_time,
+                        'end_time': end_time,
+                        'travel_date': params.get('travel_date'),
+                    })
+                else:
+                    itinerary = self.itinerary_service.create_itinerary(
+                        route['route'], start_time=start_time, travel_date=params.get('travel_date'))
+            timings['itinerary'] = it['ms']
+            if itinerary['status'] != 'success':
+                yield {'stage': 'itinerary', 'status': 'error', 'message': itinerary['message']}
+                return
+            yield {
+                'stage': 'itinerary',
+                'ms': it['ms'],
+                'data': {k: v for k, v in itinerary.items() if k != 'status'}
+            }
+
+            meta = {
+                'stage_ms': timings,
+                'route_prefetched': early_route is not None,
+                'total_ms': round((time.perf_counter() - t0) * 1000, 1),
+            }
+            log_event(logger, logging.INFO, 'plan.completed', customer_id=customer_id,
+                      selected=len(selected), **meta)
+            yield {'done': True, 'meta': meta}
+        finally:
+            # 途中で失敗・切断した場合、まだ始まっていない先行ルート取得は取り消す
+            if early_route is not None:
+                early_route.cancel()
+
+    def _route(self, destination_ids: List[str], optimize: bool = True) -> Dict:
+        """ホテル出発で観光地を巡るルート"""
+        stops = [{'destination_id': 'START'}]
+        for dest_id in destination_ids:
+            dest = self.destination_service.get_destination_details(dest_id)
+            if dest is None:
+                return {'status': 'error', 'message': f'観光地ID {dest_id} が見つかりません'}
+            stops.append({
+                'destination_id': dest_id,
+                'latitude': dest['latitude'],
+                'longitude': dest['longitude'],
+            })
+        if optimize:
+            return self.route_service.get_optimized_route(stops)
+        return self.route_service.calculate_route(stops)
+
+    def _explicit_selection(self, destination_ids: List[str], recommended: Dict) -> List[Dict]:
+        """明示指定された観光地（推薦結果にあればスコア付き）"""
+        by_id = {d['destination_id']: d for d in recommended['destinations'] + recommended.get('others', [])}
+        selected = []
+        for dest_id in destination_ids:
+            dest = by_id.get(dest_id) or self.destination_service.get_destination_details(dest_id)
+            if dest is not None:
+                selected.append(dest)
+        return selected
+
+    def _select(self, candidates: List[Dict], start_time: str, end_time: str, count: int) -> List[Dict]:
+        """
+        スコア順に、時間枠に収まる範囲で観光地を選ぶ
+
+        所要時間の見積もり = 滞在 + バッファ + 既に選んだ地点（またはホテル）のうち最寄りからの直線移動
+        """
+        budget = parse_hhmm(end_time) - parse_hhmm(start_time)
+        buffer = self.itinerary_service.default_buffer_minutes
+        hotel = self.hotel_service.hotel
+        points = [(hotel['longitude'], hotel['latitude'])]
+        selected: List[Dict] = []
+        used = 0.0
+        for cand in candidates:
+            if len(selected) >= count:
+                break
+            point = (cand['longitude'], cand['latitude'])
+            travel = float(geo.distances_from_km(point, points).min()) / FALLBACK_SPEED_KMH * 60
+            cost = cand.get('estimated_duration', 60) + buffer + travel
+            if used + cost > budget:
+                continue
+            selected.append(cand)
+            points.append(point)
+            used += cost
+        return selected
+
+
+# シングルトンインスタンス
+plan_pipeline = PlanPipeline()
@@ -0,0 +1,85 @@
+"""
+旅程プランの保存（メモリ内）
+詳細旅程を plan_id / version 付きで保持し、単発の編集で差分だけ再計算できるようにする
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+
+class PlanStore:
+    """plan_id をキーにしたスレッドセーフな LRU ストア"""
+
+    def __init__(self, max_plans: int = 1000):
+        self.max_plans = max_plans
+        self._plans: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._listeners: List[Callable[[Dict], None]] = []
+
+    def add_listener(self, listener: Callable[[Dict], None]) -> None:
+        """プランの作成・更新後に呼ばれる関数を登録（呼び出しはロック外）"""
+        self._listeners.append(listener)
+
+    def _notify(self, plan: Dict) -> None:
+        for listener in self._listeners:
+            listener(plan)
+
+    @property
+    def lock(self) -> threading.RLock:
+        """編集（読み出し〜保存）をまとめて行う場合に使うロック"""
+        return self._lock
+
+    def create(self, plan: Dict) -> Dict:
+        """新しいプランを version=1 で登録"""
+        with self._lock:
+            plan['plan_id'] = uuid.uuid4().hex[:12]
+            plan['version'] = 1
+            plan['updated_at'] = time.time()
+            self._plans[plan['plan_id']] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        self._notify(plan)
+        return plan
+
+    def get(self, plan_id: str) -> Optional[Dict]:
+        with self._lock:
+            plan = self._plans.get(plan_id)
+            if plan is not None:
+                self._plans.move_to_end(plan_id)
+            return plan
+
+    def replace(self, plan: Dict) -> Dict:
+        """編集後のプランを version を1つ進めて保存"""
+        with self._lock:
+            plan['version'] += 1
+            plan['updated_at'] = time.time()
+            self._plans[plan['plan_id']] = plan
+            self._plans.move_to_end(plan['plan_id'])
+        self._notify(plan)
+        return plan
+
+    def set_kind(self, plan_id: str, kind: str) -> Optional[Dict]:
+        """プランの種類を変更（version は進めない。変更後に登録済みの関数を呼ぶ）"""
+        with self._lock:
+            plan = self._plans.get(plan_id)
+            if plan is None:
+                return None
+            plan['kind'] = kind
+        self._notify(plan)
+        return plan
+
+    def delete(self, plan_id: str) -> Optional[Dict]:
+        """プランを削除し、削除したプランを返す（無ければ None）"""
+        with self._lock:
+            return self._plans.pop(plan_id, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'plans': len(self._plans), 'max_plans': self.max_plans}
+
+
+# シングルトンインスタンス
+plan_store = PlanStore()
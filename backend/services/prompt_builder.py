@@ -0,0 +1,161 @@
+"""
+LLM 再ランキング用のプロンプト作成
+トークン予算に収まるよう候補を絞り込み、短いフィールド名で詰めて送る
+
+- 固定部分（指示・フィールド名の凡例・出力スキーマ）は system メッセージにまとめ、毎回同じ文字列にする
+  （プロバイダ側のプレフィックスキャッシュが効く）
+- 候補はフォールバックのスコア順に並べ、予算を超える分は送らない（pruned として返す）
+- 値が null / false / 空の項目は省く
+
+環境変数:
+- LLM_PROMPT_TOKEN_BUDGET: user メッセージの推定トークン数の上限（既定: 1500）
+- LLM_PROMPT_MAX_CANDIDATES: 送る候補数の上限（既定: top_k の2倍、最低10）
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# 候補の項目と短縮名（凡例は system メッセージに1回だけ載せる）
+CANDIDATE_FIELDS: Sequence[Tuple[str, str, str]] = (
+    ('i', 'id', 'id'),
+    ('n', 'name', 'name'),
+    ('c', 'category', 'category'),
+    ('in', 'indoor', '1 = indoor'),
+    ('bf', 'barrier_free', '1 = barrier free'),
+    ('sf', 'stroller_friendly', '1 = stroller friendly'),
+    ('p', 'price_min_yen', 'minimum price (JPY)'),
+    ('cr', 'crowd_level', 'crowd level 1-5'),
+    ('d', 'duration_min', 'typical visit (min)'),
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（ASCII は4文字で1、日本語などは1文字で1）"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def _compact(value: Dict[str, Any]) -> Dict[str, Any]:
+    """null / false / 空の項目を除き、true は 1 にする"""
+    out = {}
+    for k, v in value.items():
+        if v is None or v is False or v == [] or v == {} or v == '':
+            continue
+        out[k] = 1 if v is True else v
+    return out
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
+
+class PromptBuilder:
+    """トークン予算付きの再ランキングプロンプト作成"""
+
+    def __init__(self, schema: Dict[str, Any], token_budget: Optional[int] = None):
+        self.token_budget = int(token_budget or os.getenv('LLM_PROMPT_TOKEN_BUDGET', 1500))
+        self.max_candidates = int(os.getenv('LLM_PROMPT_MAX_CANDIDATES', 0)) or None
+        legend = ', '.join(f'{short}={desc}' for short, _, desc in CANDIDATE_FIELDS)
+        self.system = (
+            "You are a travel planner reranker."
+            " Rank items strictly based on constraints (budget, weather, season, accessibility)."
+            " Return only JSON with fields: ranked[], rejected[]."
+            " Candidates are listed best-first by a rule-based score; use only their ids."
+            f" Candidate fields: {legend}. Omitted fields are unknown or false."
+            f" Output schema: {_dumps(schema)}"
+        )
+        self.system_tokens = estimate_tokens(self.system)
+        # 複数顧客をまとめて送る一括再ランキング用
+        self.batch_system = (
+            self.system
+            + " The user message holds several independent requests in requests[], each with a key."
+            " Rank each one separately and return only JSON of the form"
+            ' {"results":[{"key":<key>,"ranked":[...],"rejected":[...]}]} with one entry per request.'
+        )
+
+    def build(self, customer: Dict[str, Any], constraints: Dict[str, Any],
+              ranked_candidates: List[Dict[str, Any]], top_k: int) -> Dict[str, Any]:
+        """
+        メッセージを作成
+
+        Args:
+            customer: 顧客情報
+            constraints: 制約条件
+            ranked_candidates: フォールバックのスコア順に並べた候補
+            top_k: 返してほしい件数
+
+        Returns:
+            {"messages", "sent_ids", "pruned_ids", "estimated_tokens": {"system", "user", "total"}}
+        """
+        head = {
+            "customer": _compact({
+                "id": customer.get("顧客ID") or customer.get("id") or customer.get("customer_id"),
+                "adults": customer.get("adults"),
+                "children": customer.get("children"),
+                "seniors": customer.get("seniors"),
+                "needs_stroller": customer.get("needs_stroller"),
+                "needs_wheelchair": customer.get("needs_wheelchair"),
+                "interests": customer.get("interests", []),
+            }),
+            "constraints": _compact(constraints),
+            "top_k": top_k,
+        }
+        # 候補以外の部分と、候補配列の括弧・区切り分
+        used = estimate_tokens(_dumps(head)) + 8
+        limit = self.max_candidates or max(top_k * 2, 10)
+
+        rows: List[Dict[str, Any]] = []
+        pruned: List[str] = []
+        for c in ranked_candidates:
+            cid = c.get("destination_id") or c.get("id")
+            row = _compact({
+                "i": cid,
+                "n": c.get("name"),
+                "c": c.get("category"),
+                "in": bool(c.get("indoor", False)),
+                "bf": bool(c.get("barrier_free", False)),
+                "sf": bool(c.get("stroller_friendly", False)),
+                "p": c.get("price_min_yen"),
+                "cr": c.get("crowd_level"),
+                "d": c.get("estimated_duration_minutes") or c.get("estimated_duration"),
+            })
+            cost = estimate_tokens(_dumps(row)) + 1
+            # 上位 top_k 件は予算を超えても送る（そこまで削ると再ランキングの意味がない）
+            if len(rows) >= limit or (len(rows) >= top_k and used + cost > self.token_budget):
+                pruned.append(cid)
+                continue
+            rows.append(row)
+            used += cost
+
+        user = _dumps({**head, "candidates": rows})
+        user_tokens = estimate_tokens(user)
+        return {
+            "messages": [
+                {"role": "system", "content": self.system},
+                {"role": "user", "content": user},
+            ],
+            "sent_ids": [r["i"] for r in rows],
+            "pruned_ids": pruned,
+            "estimated_tokens": {
+                "system": self.system_tokens,
+                "user": user_tokens,
+                "total": self.system_tokens + user_tokens,
+            },
+        }
+
+    def build_batch(self, prompts: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, str]]:
+        """
+        顧客ごとのプロンプト（build の結果）を1つのメッセージにまとめる
+
+        Args:
+            prompts: [(キー, プロンプト), ...]
+        """
+        requests = [
+            {"key": key, **json.loads(prompt["messages"][1]["content"])}
+            for key, prompt in prompts
+        ]
+        return [
+            {"role": "system", "content": self.batch_system},
+            {"role": "user", "content": _dumps({"requests": requests})},
+        ]
@@ -0,0 +1,277 @@
+"""
+雨天プランサービス
+保存された旅程ごとに、屋外の観光地を屋内の代替地に差し替えた雨天版をバックグラウンドで作成しておき、
+雨が降り出したときに即座に切り替えられるようにする
+
+代替地の選び方:
+1. 観光地データの rain_alt_id（屋内で、同じ旅程に含まれていないもの）
+2. なければ近くの屋内観光地（同じカテゴリを優先）
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+from data.data_loader import data_loader
+from services.itinerary_service import ItineraryService
+from services.plan_store import plan_store
+from services.route_service import RouteService
+from services.scheduler import format_hhmm
+from utils.geo import distances_from_km
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('rain_plan')
+
+# 屋内代替地を探す範囲[km]
+SUBSTITUTE_RADIUS_KM = 30.0
+
+# 同じカテゴリの代替地を優先する度合い（距離[km]に換算）
+SAME_CATEGORY_BONUS_KM = 5.0
+
+
+class RainPlanService:
+    """保存済み旅程の雨天版を事前作成するサービス"""
+
+    def __init__(self, max_workers: int = 2):
+        self.data_loader = data_loader
+        self.plan_store = plan_store
+        self.route_service = RouteService()
+        self.itinerary_service = ItineraryService()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rain-plan')
+        self._queued: Set[str] = set()
+        self._lock = threading.Lock()
+        # プランごとの作成ロックと待っている呼び出しの数（0 になったら消す）
+        self._build_locks: Dict[str, List] = {}
+        self.plan_store.add_listener(self._on_plan_saved)
+
+    def _on_plan_saved(self, plan: Dict) -> None:
+        """旅程の作成・編集のたびに雨天版の作成を予約（雨天版自身や複数日旅程の試行は対象外）"""
+        if plan.get('kind', 'standard') == 'standard':
+            self.schedule_build(plan['plan_id'])
+
+    def schedule_build(self, plan_id: str) -> None:
+        """雨天版の作成をバックグラウンドに登録（同じプランの重複登録はまとめる）"""
+        with self._lock:
+            if plan_id in self._queued:
+                return
+            self._queued.add(plan_id)
+        self._executor.submit(self._run_queued, plan_id)
+
+    def _run_queued(self, plan_id: str) -> None:
+        with self._lock:
+            self._queued.discard(plan_id)
+        try:
+            self.build(plan_id)
+        except Exception as e:
+            log_event(logger, logging.WARNING, 'rain_plan.failed', plan_id=plan_id, error=str(e))
+
+    def build(self, plan_id: str) -> Optional[Dict]:
+        """
+        雨天版を作成して元のプランに紐づける
+
+        Returns:
+            元のプランに保存した雨天版の情報（プランが無い・作成中に編集された場合は None）
+        """
+        # 同じプランの作成はバックグラウンドと同期呼び出しで重ならないようにする
+        with self._lock:
+            entry = self._build_locks.setdefault(plan_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                return self._build(plan_id)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._build_locks.pop(plan_id, None)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """バックグラウンドの作成を止める（wait=True なら実行中・予約済みの作成の完了を待つ）"""
+        self._executor.shutdown(wait=wait)
+
+    def discard(self, plan_id: str) -> None:
+        """プランとその雨天版を削除（作成中の雨天版は保存時に捨てる）"""
+        plan = self.plan_store.delete(plan_id)
+        rain = (plan or {}).get('rain') or {}
+        if rain.get('plan_id'):
+            self.plan_store.delete(rain['plan_id'])
+
+    def _build(self, plan_id: str) -> Optional[Dict]:
+        plan = self.plan_store.get(plan_id)
+        if plan is None:
+            return None
+        version = plan['version']
+        current = plan.get('rain')
+        if current and current.get('status') == 'ready' and current.get('source_version') == version:
+            return current
+
+        t0 = time.perf_counter()
+        result = plan['result']
+        stops = result['stops']
+        substitutions = self._substitutions(stops)
+
+        route_stops = []
+        for stop in stops:
+            replacement = substitutions.get(stop['destination_id'])
+            if replacement is not None:
+                route_stops.append({
+                    'destination_id': replacement['destination_id'],
+                    'latitude': float(replacement['latitude']),
+                    'longitude': float(replacement['longitude']),
+                })
+            else:
+                route_stops.append({
+                    'destination_id': stop['destination_id'],
+                    'longitude': stop['point'][0],
+                    'latitude': stop['point'][1],
+                })
+
+        route = self.route_service.route_for_order(route_stops)
+        if route['status'] != 'success':
+            rain = {'status': 'error', 'message': route['message'], 'source_version': version}
+        else:
+            params = result['params']
+            itinerary = self.itinerary_service.create_detailed_schedule(route['route'], {
+                'start_time': format_hhmm(params['start']),
+                'end_time': format_hhmm(params['deadline']) if params['deadline'] is not None else None,
+                'travel_date': plan['travel_date'],
+                'meals': params['meals'],
+                'plan_kind': 'rain',
+            })
+            if itinerary['status'] != 'success':
+                rain = {'status': 'error', 'message': itinerary['message'], 'source_version': version}
+            else:
+                rain = {
+                    'status': 'ready',
+                    'plan_id': itinerary['plan_id'],
+                    'source_version': version,
+                    'substitutions': [
+                        {
+                            'original_id': original_id,
+                            'original_name': self._name_of(original_id),
+                            'destination_id': sub['destination_id'],
+                            'name': sub['name'],
+                            'reason': sub['reason'],
+                        }
+                        for original_id, sub in substitutions.items()
+                    ],
+                    'kept_outdoor': [
+                        s['destination_id'] for s in stops
+                        if not s['is_origin'] and not self._is_indoor(s['destination_id'])
+                        and s['destination_id'] not in substitutions
+                    ],
+                    'feasible': itinerary['feasible'],
+                    'built_at': time.time(),
+                }
+
+        # 作成中に元のプランが編集されていたら、古い雨天版は保存しない（編集時に再作成が予約される）
+        with self.plan_store.lock:
+            latest = self.plan_store.get(plan_id)
+            if latest is None or latest['version'] != version:
+                if rain.get('plan_id'):
+                    self.plan_store.delete(rain['plan_id'])
+                return None
+            previous = latest.get('rain') or {}
+            latest['rain'] = rain
+            # 置き換えた雨天版は参照されなくなるので消す（ストアの枠を実際の旅程に残す）
+            if previous.get('plan_id') and previous['plan_id'] != rain.get('plan_id'):
+                self.plan_store.delete(previous['plan_id'])
+        log_event(logger, logging.INFO, 'rain_plan.built', plan_id=plan_id, status=rain['status'],
+                  substitutions=len(rain.get('substitutions', [])),
+                  ms=round((time.perf_counter() - t0) * 1000, 1))
+        return rain
+
+    def get_rain_plan(self, plan_id: str) -> Dict:
+        """
+        雨天版の旅程を取得（事前作成が済んでいなければこの場で作成）
+        """
+        plan = self.plan_store.get(plan_id)
+        if plan is None:
+            return {
+                'status': 'error',
+                'error_code': 'not_found',
+                'message': 'プランが見つかりません'
+            }
+        rain = plan.get('rain')
+        precomputed = bool(rain and rain.get('status') == 'ready' and rain.get('source_version') == plan['version'])
+        if not precomputed:
+            rain = self.build(plan_id) or plan.get('rain')
+        if not rain or rain.get('status') != 'ready':
+            return {
+                'status': 'error',
+                'message': (rain or {}).get('message', '雨天版を作成できませんでした')
+            }
+        rain_plan = self.itinerary_service.get_plan(rain['plan_id'])
+        if rain_plan['status'] != 'success':
+            return rain_plan
+        return {
+            **rain_plan,
+            'original_plan_id': plan_id,
+            'original_version': rain['source_version'],
+            'substitutions': rain['substitutions'],
+            'kept_outdoor': rain['kept_outdoor'],
+            'precomputed': precomputed,
+        }
+
+    def switch_plans(self, plan_ids: List[str]) -> Dict:
+        """複数の旅程をまとめて雨天版に切り替え（事前作成済みのものは即時）"""
+        t0 = time.perf_counter()
+        results = []
+        for plan_id in plan_ids:
+            item = self.get_rain_plan(plan_id)
+            results.append({'plan_id': plan_id, **item})
+        return {
+            'status': 'success',
+            'results': results,
+            'meta': {
+                'plans': len(plan_ids),
+                'precomputed': sum(1 for r in results if r.get('precomputed')),
+                'elapsed_ms': round((time.perf_counter() - t0) * 1000, 2),
+            }
+        }
+
+    def _substitutions(self, stops: List[Dict]) -> Dict[str, Dict]:
+        """屋外の観光地ごとの屋内代替地"""
+        destinations = self.data_loader.load_destinations()
+        coords = self.data_loader.get_destination_coordinates()
+        used = {s['destination_id'] for s in stops}
+        substitutions: Dict[str, Dict] = {}
+        for stop in stops:
+            dest_id = stop['destination_id']
+            if stop['is_origin'] or self._is_indoor(dest_id):
+                continue
+            details = self.data_loader.get_destination_by_id(dest_id) or {}
+            alt_id = details.get('rain_alt_id')
+            if alt_id and alt_id not in used and self._is_indoor(alt_id):
+                alt = self.data_loader.get_destination_by_id(alt_id)
+                substitutions[dest_id] = {**alt, 'reason': 'rain_alt_id'}
+                used.add(alt_id)
+                continue
+
+            distances = distances_from_km(stop['point'], coords)
+            best = None
+            best_score = None
+            for i, cand in enumerate(destinations):
+                if not cand.get('indoor') or cand['destination_id'] in used or distances[i] > SUBSTITUTE_RADIUS_KM:
+                    continue
+                score = distances[i] - (SAME_CATEGORY_BONUS_KM if cand.get('category') == details.get('category') else 0.0)
+                if best_score is None or score < best_score:
+                    best, best_score = cand, score
+            if best is not None:
+                substitutions[dest_id] = {**best, 'reason': 'nearest_indoor'}
+                used.add(best['destination_id'])
+        return substitutions
+
+    def _is_indoor(self, destination_id: str) -> bool:
+        details = self.data_loader.get_destination_by_id(destination_id)
+        return bool(details and details.get('indoor'))
+
+    def _name_of(self, destination_id: str) -> Optional[str]:
+        details = self.data_loader.get_destination_by_id(destination_id)
+        return details.get('name') if details else None
+
+
+# シングルトンインスタンス
+rain_plan_service = RainPlanService()
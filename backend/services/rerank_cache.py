@@ -0,0 +1,200 @@
+"""
+LLM 再ランキング結果のキャッシュ
+コンパクト化したプロンプトとモデルのハッシュをキーに、メモリ（LRU）と SQLite の2段で保持する
+
+環境変数:
+- LLM_CACHE_PATH: SQLite ファイル（既定: backend/instance/llm_cache.db、空文字でメモリのみ）
+- LLM_CACHE_TTL_SECONDS: 有効期限（既定: 43200 = 12時間）
+- LLM_CACHE_MAX_ENTRIES: SQLite に保持する最大件数（既定: 5000）
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('llm_cache')
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'llm_cache.db')
+
+
+def prompt_key(body: Dict[str, Any]) -> str:
+    """リクエスト本文（モデル・温度・メッセージ）を正規化した JSON の SHA-256"""
+    normalized = json.dumps(body, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class RerankCache:
+    """TTL・件数上限付きのスレッドセーフな2段キャッシュ"""
+
+    def __init__(self, db_path: Optional[str] = None, ttl_seconds: Optional[float] = None,
+                 max_entries: Optional[int] = None, max_memory_entries: int = 256):
+        if db_path is None:
+            db_path = os.getenv('LLM_CACHE_PATH', DEFAULT_DB_PATH)
+        self.db_path = db_path or None
+        self.ttl_seconds = float(ttl_seconds if ttl_seconds is not None else os.getenv('LLM_CACHE_TTL_SECONDS', 43200))
+        self.max_entries = int(max_entries if max_entries is not None else os.getenv('LLM_CACHE_MAX_ENTRIES', 5000))
+        self.max_memory_entries = max_memory_entries
+        self._memory: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalid = 0
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """SQLite 接続（初回に作成、開けなければメモリのみで動作）"""
+        if self.db_path is None:
+            return None
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS rerank_cache (
+                        key TEXT PRIMARY KEY,
+                        model TEXT,
+                        value TEXT NOT NULL,
+                        expires_at REAL NOT NULL,
+                        last_access REAL NOT NULL
+                    )
+                    """
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_rerank_cache_access ON rerank_cache(last_access)")
+                conn.commit()
+                self._conn = conn
+            except sqlite3.Error as e:
+                log_event(logger, logging.WARNING, 'llm_cache.disabled', path=self.db_path, error=str(e))
+                self.db_path = None
+                return None
+        return self._conn
+
+    def get(self, key: str) -> Optional[Dict]:
+        """有効期限内のエントリを取得（メモリ → SQLite の順）"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+                self.expired += 1
+
+            conn = self._db()
+            if conn is not None:
+                try:
+                    row = conn.execute(
+                        "SELECT value, expires_at FROM rerank_cache WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is not None and row[1] > now:
+                        conn.execute("UPDATE rerank_cache SET last_access = ? WHERE key = ?", (now, key))
+                        conn.commit()
+                        value = json.loads(row[0])
+                        self._remember(key, row[1], value)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return value
+                    if row is not None:
+                        conn.execute("DELETE FROM rerank_cache WHERE key = ?", (key,))
+                        conn.commit()
+                        self.expired += 1
+                except (sqlite3.Error, ValueError) as e:
+                    log_event(logger, logging.WARNING, 'llm_cache.read_failed', error=str(e))
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Dict, model: Optional[str] = None) -> None:
+        """エントリを登録（件数上限を超えた分は最終参照が古いものから削除）"""
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        with self._lock:
+            self._remember(key, expires_at, value)
+            conn = self._db()
+            if conn is None:
+                return
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO rerank_cache (key, model, value, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, model, json.dumps(value, ensure_ascii=False), expires_at, now),
+                )
+                conn.execute("DELETE FROM rerank_cache WHERE expires_at <= ?", (now,))
+                conn.execute(
+                    """
+                    DELETE FROM rerank_cache WHERE key IN (
+                        SELECT key FROM rerank_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,),
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                log_event(logger, logging.WARNING, 'llm_cache.write_failed', error=str(e))
+
+    def invalidate(self, key: str) -> None:
+        """スキーマ検証に通らなかったエントリを削除"""
+        with self._lock:
+            self.invalid += 1
+            self._memory.pop(key, None)
+            conn = self._db()
+            if conn is not None:
+                try:
+                    conn.execute("DELETE FROM rerank_cache WHERE key = ?", (key,))
+                    conn.commit()
+                except sqlite3.Error:
+                    pass
+
+    def _remember(self, key: str, expires_at: float, value: Dict) -> None:
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            stored = None
+            conn = self._db()
+            if conn is not None:
+                try:
+                    stored = conn.execute("SELECT COUNT(*) FROM rerank_cache").fetchone()[0]
+                except sqlite3.Error:
+                    pass
+            return {
+                'memory_entries': len(self._memory),
+                'stored_entries': stored,
+                'persistent': conn is not None,
+                'ttl_seconds': self.ttl_seconds,
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'invalid': self.invalid,
+                'hit_rate': round(self.hits / total, 3) if total else None,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            conn = self._db()
+            if conn is not None:
+                conn.execute("DELETE FROM rerank_cache")
+                conn.commit()
+            self.hits = self.disk_hits = self.misses = self.expired = self.invalid = 0
+
+
+# シングルトンインスタンス
+rerank_cache = RerankCache()
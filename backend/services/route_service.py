@@ -3,16 +3,29 @@
 OSRM を使用した最適ルート計算
 """
 
-from typing import List, Dict, Tuple
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, List, Dict, Optional, Tuple
+from utils.geo import distance_matrix_km, nearest_neighbor_order
+from utils.leg_cache import point_key
 from utils.osrm_client import osrm_client
+from utils.telemetry import get_logger, log_event
 from data.data_loader import data_loader
+from services.hotel_service import hotel_service
+
+logger = get_logger('route')
 
 class RouteService:
     """ルート取得サービス"""
     
+    # OSRM table API に一度に渡す地点数の上限（公開デモサーバーの制限に合わせる）
+    max_table_points = 100
+    
     def __init__(self):
         self.osrm_client = osrm_client
         self.data_loader = data_loader
+        self.hotel_service = hotel_service
+        self.leg_cache = osrm_client.leg_cache
     
     def calculate_route(self, destinations: List[Dict]) -> Dict:
         """
@@ -32,61 +45,24 @@ class RouteService:
                 }
             
             # 座標リストを作成 (longitude, latitude)
-            coordinates = []
-            destination_info = []
-            
-            for dest in destinations:
-                if not all(key in dest for key in ['latitude', 'longitude']):
-                    return {
-                        'status': 'error',
-                        'message': 'latitude と longitude が必要です'
-                    }
-                
-                lat = float(dest['latitude'])
-                lon = float(dest['longitude'])
-                coordinates.append((lon, lat))
-                
-                # 観光地詳細情報を取得
-                dest_details = None
-                dest_id = str(dest.get('destination_id') or '')
-                if dest_id:
-                    dest_details = self.data_loader.get_destination_by_id(dest_id)
-
-                # START（ホテル出発）を特別扱い
-                if dest_id.upper() == 'START':
-                    destination_info.append({
-                        'destination_id': 'START',
-                        'latitude': lat,
-                        'longitude': lon,
-                        'name': 'ホテル',
-                        'estimated_stay_minutes': 0,
-                    })
-                else:
-                    destination_info.append({
-                        'destination_id': dest.get('destination_id'),
-                        'latitude': lat,
-                        'longitude': lon,
-                        'name': (dest_details.get('name') if dest_details else f"地点{len(destination_info)+1}"),
-                        'estimated_stay_minutes': (int(dest_details.get('estimated_duration_minutes', 60)) if dest_details else 60)
-                    })
-            
-            # OSRM でルート計算（正確性重視でスナップON）
-            print(f"🔍 OSRM API呼び出し開始: {len(coordinates)}地点")
-            print(f"📍 座標: {coordinates}")
+            prepared = self._prepare_stops(destinations)
+            if prepared is None:
+                return {
+                    'status': 'error',
+                    'message': 'latitude と longitude が必要です'
+                }
+            coordinates, destination_info = prepared
             
-            route_data = self.osrm_client.get_route(coordinates, profile='driving', snap=True)
+            # OSRM でルート計算（区間キャッシュを利用、未取得区間のみスナップONで取得）
+            route_data = self.osrm_client.get_route_via_legs(coordinates, profile='driving', snap=True)
             
-            print(f"📊 OSRM API結果: {route_data is not None}")
             if route_data:
-                print(f"✅ ルート取得成功: 距離{route_data.get('distance_km', 'N/A')}km, 時間{route_data.get('duration_minutes', 'N/A')}分")
-                print(f"📊 ルートデータ詳細:")
-                print(f"   - ジオメトリ: {type(route_data.get('geometry', 'N/A'))}")
-                print(f"   - 座標数: {len(route_data.get('geometry', {}).get('coordinates', [])) if route_data.get('geometry') else 'N/A'}")
-                print(f"   - 距離: {route_data.get('distance_km', 'N/A')}km")
-                print(f"   - 時間: {route_data.get('duration_minutes', 'N/A')}分")
-                print(f"   - 全データ: {route_data}")
+                log_event(logger, logging.INFO, 'route.calculated', points=len(coordinates),
+                          distance_km=route_data.get('distance_km'), duration_minutes=route_data.get('duration_minutes'),
+                          osrm_base=(route_data.get('meta') or {}).get('osrm_base'),
+                          legs_cached=(route_data.get('meta') or {}).get('legs_cached'))
             else:
-                print(f"❌ ルート取得失敗: OSRM APIがNoneを返しました")
+                log_event(logger, logging.WARNING, 'route.failed', points=len(coordinates))
             
             if not route_data:
                 return {
@@ -95,22 +71,7 @@ class RouteService:
                 }
             
             # レスポンス形式に整形
-            return {
-                'status': 'success',
-                'route': {
-                    'geometry': route_data['geometry'],
-                    'total_distance_km': route_data['distance_km'],
-                    'total_duration_minutes': route_data['duration_minutes'],
-                    'waypoints': self._create_waypoints_info(destination_info, route_data)
-                },
-                'destinations': destination_info,
-                'summary': {
-                    'total_destinations': len(destinations),
-                    'total_travel_time': route_data['duration_minutes'],
-                    'total_stay_time': sum(d['estimated_stay_minutes'] for d in destination_info),
-                    'estimated_total_time': route_data['duration_minutes'] + sum(d['estimated_stay_minutes'] for d in destination_info)
-                }
-            }
+            return self._build_route_response(destination_info, route_data)
             
         except ValueError as e:
             return {
@@ -136,67 +97,283 @@ class RouteService:
                 }
 
             # 準備: coordinates/destination_info を作成
-            coords: List[Tuple[float, float]] = []
-            info: List[Dict] = []
-            for dest in destinations:
-                lat = float(dest['latitude']); lon = float(dest['longitude'])
-                coords.append((lon, lat))
-                dest_id = str(dest.get('destination_id') or '')
-                details = self.data_loader.get_destination_by_id(dest_id) if dest_id else None
-                if dest_id.upper() == 'START':
-                    info.append({
-                        'destination_id': 'START', 'latitude': lat, 'longitude': lon,
-                        'name': 'ホテル', 'estimated_stay_minutes': 0,
-                    })
-                else:
-                    info.append({
-                        'destination_id': dest.get('destination_id'), 'latitude': lat, 'longitude': lon,
-                        'name': (details.get('name') if details else f"地点{len(info)+1}"),
-                        'estimated_stay_minutes': (int(details.get('estimated_duration_minutes', 60)) if details else 60)
-                    })
+            prepared = self._prepare_stops(destinations)
+            if prepared is None:
+                return { 'status': 'error', 'message': 'latitude と longitude が必要です' }
+            coords, info = prepared
 
             # Nearest Neighbor で順序最適化（0番目＝出発地固定）
-            order = [0]
-            remaining = list(range(1, len(coords)))
-            def hav(a, b):
-                import math
-                (lon1, lat1), (lon2, lat2) = coords[a], coords[b]
-                R=6371.0
-                dlat=math.radians(lat2-lat1); dlon=math.radians(lon2-lon1)
-                x=math.sin(dlat/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*math.sin(dlon/2)**2
-                return 2*R*math.asin(min(1, math.sqrt(x)))
-            while remaining:
-                cur = order[-1]
-                nxt = min(remaining, key=lambda j: hav(cur, j))
-                order.append(nxt)
-                remaining.remove(nxt)
+            order = nearest_neighbor_order(distance_matrix_km(coords), start=0)
 
             coords_ord = [coords[i] for i in order]
             info_ord = [info[i] for i in order]
 
-            route_data = self.osrm_client.get_route(coords_ord, profile='driving', snap=True)
+            route_data = self.osrm_client.get_route_via_legs(coords_ord, profile='driving', snap=True)
             if not route_data:
                 return { 'status': 'error', 'message': 'ルート計算に失敗しました' }
 
-            return {
-                'status': 'success',
-                'route': {
-                    'geometry': route_data['geometry'],
-                    'total_distance_km': route_data['distance_km'],
-                    'total_duration_minutes': route_data['duration_minutes'],
-                    'waypoints': self._create_waypoints_info(info_ord, route_data)
-                },
-                'destinations': info_ord,
-                'summary': {
-                    'total_destinations': len(info_ord),
-                    'total_travel_time': route_data['duration_minutes'],
-                    'total_stay_time': sum(d['estimated_stay_minutes'] for d in info_ord),
-                    'estimated_total_time': route_data['duration_minutes'] + sum(d['estimated_stay_minutes'] for d in info_ord)
-                }
-            }
+            return self._build_route_response(info_ord, route_data)
         except Exception as e:
             return { 'status': 'error', 'message': f'最適化中にエラー: {e}' }
     
+    def calculate_routes_batch(self, plans: List[List[Dict]], include_geometry: bool = False) -> Dict:
+        """
+        複数プランのルートを一括計算
+        
+        Args:
+            plans: 地点リスト（calculate_route と同形式）のリスト
+            include_geometry: True の場合は各プランの道路ジオメトリも取得
+            
+        Returns:
+            results（入力順）と meta を含む辞書
+        """
+        results: List[Optional[Dict]] = [None] * len(plans)
+        meta: Dict = {}
+        for item in self.iter_routes_batch(plans, include_geometry=include_geometry):
+            if 'index' in item:
+                results[item.pop('index')] = item
+            else:
+                meta = item.get('meta', {})
+        return {
+            'status': 'success',
+            'results': results,
+            'meta': meta
+        }
+
+    def iter_routes_batch(self, plans: List[List[Dict]], include_geometry: bool = False) -> Iterator[Dict]:
+        """
+        複数プランのルートを計算し、完了したものから順に返すジェネレータ
+        
+        全プランの区間所要時間は共有の table リクエスト1回（区間キャッシュ済みのものは除外）で求める。
+        各要素は {"index": i, ...calculate_route と同形式}、最後に {"done": True, "meta": {...}} を返す。
+        """
+        prepared: Dict[int, Tuple[List[Tuple[float, float]], List[Dict]]] = {}
+        for i, plan in enumerate(plans):
+            if not plan or len(plan) < 2:
+                yield {'index': i, 'status': 'error', 'message': '最低2つの観光地が必要です'}
+                continue
+            stops = self._prepare_stops(plan)
+            if stops is None:
+                yield {'index': i, 'status': 'error', 'message': 'latitude と longitude が必要です'}
+                continue
+            prepared[i] = stops
+
+        pairs, osrm_requests, source = self._resolve_pairs(
+            [[point_key(c) for c in coords] for coords, _ in prepared.values()]
+        )
+
+        legs_fetched: List[int] = []
+
+        def build(i: int) -> Dict:
+            coords, info = prepared[i]
+            route_data = None
+            if include_geometry:
+                route_data = self.osrm_client.get_route_via_legs(coords, profile='driving', allow_fallback=False)
+                if route_data:
+                    legs_fetched.append(route_data['meta'].get('legs_fetched', 0))
+            if not route_data:
+                route_data = self._route_from_pairs(coords, pairs)
+            if route_data is None:
+                return {'index': i, 'status': 'error', 'message': 'ルート計算に失敗しました'}
+            return {'index': i, **self._build_route_response(info, route_data)}
+
+        if include_geometry and len(prepared) > 1:
+            with ThreadPoolExecutor(max_workers=min(8, len(prepared))) as ex:
+                futs = [ex.submit(build, i) for i in prepared]
+                for f in as_completed(futs):
+                    yield f.result()
+        else:
+            for i in prepared:
+                yield build(i)
+
+        log_event(logger, logging.INFO, 'route.batch', plans=len(plans), osrm_requests=osrm_requests,
+                  source=source, legs_fetched=sum(legs_fetched))
+        yield {
+            'done': True,
+            'meta': {
+                'plans': len(plans),
+                'osrm_requests': osrm_requests,
+                'matrix_source': source,
+                'geometry_legs_fetched': sum(legs_fetched)
+            }
+        }
+
+    def get_pair_table(self, coords: List[Tuple[float, float]]) -> Tuple[Dict, int, str]:
+        """
+        地点集合の全区間 (from, to) の距離・時間（区間キャッシュ＋不足分は table リクエスト1回）
+        
+        Returns:
+            (区間辞書 {(from, to): (meters, seconds)}, リクエスト数, 取得元)
+        """
+        keys = [point_key(c) for c in coords]
+        return self._resolve_pairs([[a, b] for a in keys for b in keys if a != b])
+
+    def route_for_order(self, destinations: List[Dict], pairs: Optional[Dict] = None,
+                        include_geometry: bool = False) -> Dict:
+        """
+        訪問順が決まった地点列のルートを作成（calculate_route と同形式）
+        
+        Args:
+            destinations: 地点リスト（先頭は START 可）
+            pairs: get_pair_table で取得済みの区間辞書（あれば OSRM への問い合わせなし）
+            include_geometry: True の場合は道路ジオメトリも取得
+        """
+        prepared = self._prepare_stops(destinations)
+        if prepared is None:
+            return {'status': 'error', 'message': 'latitude と longitude が必要です'}
+        coords, info = prepared
+        route_data = None
+        if include_geometry:
+            route_data = self.osrm_client.get_route_via_legs(coords, profile='driving', snap=True)
+        if not route_data:
+            if pairs is None:
+                pairs, _, _ = self._resolve_pairs([[point_key(c) for c in coords]])
+            route_data = self._route_from_pairs(coords, pairs)
+        if route_data is None:
+            return {'status': 'error', 'message': 'ルート計算に失敗しました'}
+        return self._build_route_response(info, route_data)
+
+    def _resolve_pairs(self, sequences: List[List[Tuple[float, float]]]) -> Tuple[Dict, int, str]:
+        """
+        各地点列の区間 (from, to) の距離・時間を求める
+        未キャッシュの区間は table リクエスト1回でまとめて取得し、(区間辞書, リクエスト数, 取得元) を返す
+        """
+        needed = {(a, b) for seq in sequences for a, b in zip(seq, seq[1:])}
+        pairs = {}
+        for a, b in needed:
+            leg = self.leg_cache.get(a, b, 'driving')
+            if leg is not None:
+                pairs[(a, b)] = (leg['distance_meters'], leg['duration_seconds'])
+        missing = needed - pairs.keys()
+        if not missing:
+            return pairs, 0, 'cache'
+
+        points = sorted({p for pair in missing for p in pair})
+        if len(points) > self.max_table_points:
+            # 上限超過時はプランごとの table リクエストに分割
+            # 1プランで上限を超えるものは、隣り合う区間が切れないよう1地点ずつ重ねた区切りごとに取得する
+            requests_made = 0
+            source = 'osrm'
+            size = self.max_table_points
+            for seq in sequences:
+                if len(set(seq)) <= size:
+                    chunks = [seq]
+                else:
+                    chunks = [seq[i:i + size] for i in range(0, len(seq) - 1, size - 1)]
+                for chunk in chunks:
+                    sub, n, src = self._resolve_pairs([chunk])
+                    pairs.update(sub)
+                    requests_made += n
+                    if src == 'fallback':
+                        source = src
+            return pairs, requests_made, source
+
+        matrix = self.osrm_client.get_distance_matrix(points, profile='driving', allow_fallback=True)
+        source = 'osrm' if matrix['meta'].get('osrm_base') else 'fallback'
+        index = {p: k for k, p in enumerate(points)}
+        fetched = {}
+        for a, b in missing:
+            meters = matrix['distances'][index[a]][index[b]]
+            seconds = matrix['durations'][index[a]][index[b]]
+            if meters is not None and seconds is not None:
+                fetched[(a, b)] = (float(meters), float(seconds))
+        pairs.update(fetched)
+        # 直線近似の値はキャッシュせず、このリクエスト内でのみ使う
+        if source == 'osrm':
+            for (a, b), (meters, seconds) in fetched.items():
+                self.leg_cache.put(a, b, meters, seconds, profile='driving')
+        return pairs, 1, source
+
+    def _route_from_pairs(self, coords: List[Tuple[float, float]], pairs: Dict) -> Optional[Dict]:
+        """区間ごとの距離・時間からルート情報を組み立てる（ジオメトリは地点を結ぶ折れ線）"""
+        legs = []
+        total_m = 0.0
+        total_s = 0.0
+        for i, (a, b) in enumerate(zip(coords, coords[1:])):
+            pair = pairs.get((point_key(a), point_key(b)))
+            if pair is None:
+                return None
+            meters, seconds = pair
+            total_m += meters
+            total_s += seconds
+            legs.append({
+                'leg_index': i,
+                'distance_meters': meters,
+                'duration_seconds': seconds,
+                'distance_km': round(meters / 1000, 2),
+                'duration_minutes': round(seconds / 60, 1),
+                'steps_count': 0,
+            })
+        return {
+            'geometry': {'type': 'LineString', 'coordinates': [[lon, lat] for lon, lat in coords]},
+            'distance_meters': total_m,
+            'duration_seconds': total_s,
+            'distance_km': round(total_m / 1000, 2),
+            'duration_minutes': round(total_s / 60, 1),
+            'legs': legs,
+            'waypoints': []
+        }
+
+    def _prepare_stops(self, destinations: List[Dict]) -> Optional[Tuple[List[Tuple[float, float]], List[Dict]]]:
+        """
+        入力地点から (longitude, latitude) 座標リストと観光地情報を作成（座標欠落時は None）
+        START は座標省略時にホテル設定の座標を使う
+        """
+        coordinates: List[Tuple[float, float]] = []
+        destination_info: List[Dict] = []
+        hotel = self.hotel_service.hotel
+        for dest in destinations:
+            if str(dest.get('destination_id') or '').upper() == 'START' and 'latitude' not in dest:
+                dest = {**dest, 'latitude': hotel['latitude'], 'longitude': hotel['longitude']}
+            if not all(key in dest for key in ['latitude', 'longitude']):
+                return None
+            lat = float(dest['latitude'])
+            lon = float(dest['longitude'])
+            coordinates.append((lon, lat))
+
+            # 観光地詳細情報を取得
+            dest_id = str(dest.get('destination_id') or '')
+            details = self.data_loader.get_destination_by_id(dest_id) if dest_id else None
+
+            # START（ホテル出発）を特別扱い
+            if dest_id.upper() == 'START':
+                destination_info.append({
+                    'destination_id': 'START',
+                    'latitude': lat,
+                    'longitude': lon,
+                    'name': hotel['name'],
+                    'estimated_stay_minutes': 0,
+                })
+            else:
+                destination_info.append({
+                    'destination_id': dest.get('destination_id'),
+                    'latitude': lat,
+                    'longitude': lon,
+                    'name': (details.get('name') if details else f"地点{len(destination_info)+1}"),
+                    'estimated_stay_minutes': (int(details.get('estimated_duration_minutes', 60)) if details else 60)
+                })
+        return coordinates, destination_info
+
+    def _build_route_response(self, destination_info: List[Dict], route_data: Dict) -> Dict:
+        """ルート計算結果をAPIレスポンス形式に整形"""
+        total_stay = sum(d['estimated_stay_minutes'] for d in destination_info)
+        return {
+            'status': 'success',
+            'route': {
+                'geometry': route_data['geometry'],
+                'total_distance_km': route_data['distance_km'],
+                'total_duration_minutes': route_data['duration_minutes'],
+                'waypoints': self._create_waypoints_info(destination_info, route_data)
+            },
+            'destinations': destination_info,
+            'summary': {
+                'total_destinations': len(destination_info),
+                'total_travel_time': route_data['duration_minutes'],
+                'total_stay_time': total_stay,
+                'estimated_total_time': route_data['duration_minutes'] + total_stay
+            }
+        }
+
     def _create_waypoints_info(self, destinations: List[Dict], route_data: Dict) -> List[Dict]:
         """ウェイポイント情報を作成"""
         waypoints = []
@@ -0,0 +1,523 @@
+"""
+旅程スケジューラ
+営業時間・最終入場・食事枠（昼食/夕食）を考慮して、既知の区間所要時間から時刻を割り当てる
+
+時刻はすべて 0:00 からの分（int）で扱い、1プランあたり数十マイクロ秒で検証できるようにしている
+- 前向き伝播: 到着 → 開館待ち → 滞在 → 出発 の最早時刻
+- 後ろ向き伝播: 最終入場・閉館・後続地点の制約から求めた最遅開始時刻（余裕時間）
+"""
+
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from data.data_loader import data_loader
+from utils import geo
+from utils.leg_cache import leg_cache
+from utils.osrm_client import FALLBACK_SPEED_KMH
+
+# 食事枠: (種類, 表示名, 開始可能時刻, 開始期限, 所要分)
+MEAL_SLOTS = (
+    ('lunch', '昼食', 11 * 60 + 30, 14 * 60, 60),
+    ('dinner', '夕食', 18 * 60, 20 * 60 + 30, 60),
+)
+
+# 候補レストランを探す半径[km]
+MEAL_SEARCH_RADIUS_KM = 10.0
+
+# 直線距離から道路距離への補正係数（区間キャッシュに無い区間の見積もり用）
+ROAD_FACTOR = 1.3
+
+
+def parse_hhmm(value) -> Optional[int]:
+    """'HH:MM' を 0:00 からの分に変換（空・不正値は None）"""
+    if value is None:
+        return None
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        h, m = text.split(':')
+        return int(h) * 60 + int(m)
+    except ValueError:
+        return None
+
+
+def format_hhmm(minutes: int) -> str:
+    """分を 'HH:MM' に変換（24時以降もそのまま 24:30 のように表記）"""
+    minutes = int(minutes)
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def estimate_leg_minutes(a: Tuple[float, float], b: Tuple[float, float]) -> Tuple[int, float, bool]:
+    """
+    区間の所要時間[分]・距離[km]・見積もりかどうか
+    区間キャッシュ（OSRM 由来）にあればそれを使い、無ければ直線距離から見積もる
+    """
+    entry = leg_cache.get(a, b)
+    if entry is not None:
+        return int(round(entry['duration_seconds'] / 60)), round(entry['distance_meters'] / 1000, 2), False
+    km = geo.haversine_km(a, b) * ROAD_FACTOR
+    return int(round(km / FALLBACK_SPEED_KMH * 60)), round(km, 2), True
+
+
+class Scheduler:
+    """営業時間・食事枠を考慮した旅程スケジューラ"""
+
+    def __init__(self, buffer_minutes: int = 15):
+        self.buffer_minutes = buffer_minutes
+        self.data_loader = data_loader
+        self._hours: Optional[Dict[str, Tuple[Optional[int], Optional[int], Optional[int]]]] = None
+        self._nearest_restaurant: Dict[Tuple[float, float], Optional[Dict]] = {}
+        self._lock = threading.Lock()
+
+    # ---- データ準備 ----
+
+    def opening_hours(self, destination_id: str) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+        """観光地の (開館, 閉館, 最終入場) を分で返す（設定が無い項目は None）"""
+        if self._hours is None:
+            with self._lock:
+                if self._hours is None:
+                    self._hours = {
+                        d.get('destination_id'): (
+                            parse_hhmm(d.get('open_time')),
+                            parse_hhmm(d.get('close_time')),
+                            parse_hhmm(d.get('last_entry_time')),
+                        )
+                        for d in self.data_loader.load_destinations()
+                    }
+        return self._hours.get(destination_id, (None, None, None))
+
+    def nearest_restaurant(self, point: Tuple[float, float]) -> Optional[Dict]:
+        """地点から MEAL_SEARCH_RADIUS_KM 以内で最も近いカタログの飲食店（地点ごとにキャッシュ）"""
+        key = (round(point[0], 4), round(point[1], 4))
+        if key in self._nearest_restaurant:
+            return self._nearest_restaurant[key]
+        restaurants = self.data_loader.get_catalog_restaurants()
+        found = None
+        if restaurants:
+            idx = geo.within_radius(point, [(r['lng'], r['lat']) for r in restaurants], MEAL_SEARCH_RADIUS_KM)
+            if len(idx):
+                r = restaurants[int(idx[0])]
+                found = {
+                    'id': r['id'],
+                    'name': r['name'],
+                    'latitude': r['lat'],
+                    'longitude': r['lng'],
+                    'distance_km': round(geo.haversine_km(point, (r['lng'], r['lat'])), 2),
+                }
+        self._nearest_restaurant[key] = found
+        return found
+
+    # ---- 入力の正規化 ----
+
+    def stops_from_waypoints(self, waypoints: List[Dict]) -> List[Dict]:
+        """
+        ルートの waypoints をスケジューラ入力（stops）に変換
+
+        先頭の START は出発地として扱い、区間の所要時間は travel_to_next を使う
+        """
+        stops = []
+        for w in waypoints:
+            dest_id = str(w.get('destination_id') or '')
+            travel = w.get('travel_to_next') or None
+            open_min, close_min, last_entry = self.opening_hours(dest_id)
+            stops.append({
+                'destination_id': dest_id,
+                'name': w.get('name') or dest_id,
+                'point': (float(w.get('longitude', 0)), float(w.get('latitude', 0))),
+                'stay': int(w.get('estimated_stay_minutes', 60) or 0),
+                'is_origin': dest_id.upper() == 'START',
+                'travel': int(round(travel['duration_minutes'])) if travel else None,
+                'distance_km': travel['distance_km'] if travel else None,
+                'open': open_min,
+                'close': close_min,
+                'last_entry': last_entry,
+            })
+        # 途中の欠けた区間は見積もる
+        for i in range(len(stops) - 1):
+            if stops[i]['travel'] is None:
+                stops[i]['travel'], stops[i]['distance_km'], _ = estimate_leg_minutes(
+                    stops[i]['point'], stops[i + 1]['point'])
+        return stops
+
+    def stop_for_destination(self, destination_id: str) -> Optional[Dict]:
+        """観光地IDから stop を作成（区間の所要時間は未設定）"""
+        details = self.data_loader.get_destination_by_id(destination_id)
+        if not details:
+            return None
+        open_min, close_min, last_entry = self.opening_hours(destination_id)
+        return {
+            'destination_id': destination_id,
+            'name': details.get('name') or destination_id,
+            'point': (float(details.get('longitude', 0)), float(details.get('latitude', 0))),
+            'stay': int(details.get('estimated_duration_minutes') or 60),
+            'is_origin': False,
+            'travel': None,
+            'distance_km': None,
+            'open': open_min,
+            'close': close_min,
+            'last_entry': last_entry,
+        }
+
+    # ---- スケジューリング ----
+
+    def schedule(self, stops: List[Dict], start_time: str = '09:00', *,
+                 end_time: Optional[str] = None, meals: bool = True) -> Dict:
+        """
+        stops に時刻を割り当てる
+
+        Args:
+            stops: stops_from_waypoints の結果
+            start_time: 出発時刻 (HH:MM)
+            end_time: 旅程の終了期限 (HH:MM)。超過は違反として報告
+            meals: 昼食・夕食枠を挿入するか
+
+        Returns:
+            {'feasible', 'violations', 'warnings', 'timeline', 'state', 'end', ...}
+            timeline は内部表現（分）で、to_events でイベント列に変換する
+        """
+        t = parse_hhmm(start_time)
+        if t is None:
+            raise ValueError('開始時刻の形式が不正です (HH:MM)')
+        params = {
+            'start': t,
+            'deadline': parse_hhmm(end_time) if end_time else None,
+            'meals': meals,
+        }
+        return self._run(stops, params, 0, t, 0 if meals else len(MEAL_SLOTS))
+
+    def reschedule(self, previous: Dict, stops: List[Dict], from_index: int) -> Dict:
+        """
+        直前の schedule 結果を使い、from_index 以降だけを再計算する
+
+        from_index より前の地点は previous の結果をそのまま使う。
+        再計算中に、編集されていない後続地点へ以前と同じ時刻・食事状態で到達した時点で
+        打ち切り、それ以降も previous の結果を（インデックスをずらして）再利用する
+
+        Args:
+            previous: schedule / reschedule の結果
+            stops: 編集後の stops（変更のない地点は previous['stops'] と同じ dict を使うこと）
+            from_index: 最初に変更された地点のインデックス
+
+        Returns:
+            schedule と同じ形式。'changed' に再計算したタイムライン範囲を含む
+        """
+        from_index = max(0, min(from_index, len(previous['checkpoints']), len(stops)))
+        if from_index == 0:
+            params = previous['params']
+            result = self._run(stops, params, 0, params['start'], 0 if params['meals'] else len(MEAL_SLOTS))
+            result['changed']['old_to'] = len(previous['timeline'])
+            return result
+        t, meal_pos = previous['checkpoints'][from_index]
+        return self._run(stops, previous['params'], from_index, t, meal_pos, previous)
+
+    def _run(self, stops: List[Dict], params: Dict, k: int, t: int, meal_pos: int,
+             previous: Optional[Dict] = None) -> Dict:
+        """
+        地点 k から前向きに時刻を伝播（k より前は previous から引き継ぐ）
+
+        checkpoints[i] は地点 i に到着した時点の (時刻, 次に確保する食事枠の位置)
+        """
+        buffer = self.buffer_minutes
+        n = len(stops)
+        if previous is not None:
+            prefix_len = next((p for p, item in enumerate(previous['timeline']) if item[1] >= k),
+                              len(previous['timeline']))
+            timeline = previous['timeline'][:prefix_len]
+            violations = [v for v in previous['violations'] if v.get('index', n) < k]
+            warnings = [w for w in previous['warnings'] if w['index'] < k]
+            state = [dict(s) for s in previous['state'] if s['index'] < k]
+            checkpoints = previous['checkpoints'][:k]
+            old_stops = previous['stops']
+            delta = n - len(old_stops)
+            # 末尾から見て編集前と同じ地点が続く長さ
+            common = 0
+            while common < min(n, len(old_stops)) - k and stops[n - 1 - common] is old_stops[-1 - common]:
+                common += 1
+        else:
+            prefix_len = 0
+            timeline, violations, warnings, state, checkpoints = [], [], [], [], []
+            old_stops, delta, common = None, 0, 0
+
+        converged_at = None
+        i = k
+        while i < n:
+            stop = stops[i]
+            if (previous is not None and i > k and i >= n - common
+                    and previous['checkpoints'][i - delta] == (t, meal_pos)):
+                converged_at = i
+                break
+            checkpoints.append((t, meal_pos))
+
+            if stop['is_origin'] and i == 0:
+                timeline.append(('origin', i, t, t))
+            else:
+                arrive = t
+                begin = arrive
+                if stop['open'] is not None and begin < stop['open']:
+                    begin = stop['open']
+                    timeline.append(('wait', i, arrive, begin))
+                entry_limit = stop['last_entry'] if stop['last_entry'] is not None else stop['close']
+                if entry_limit is not None and begin > entry_limit:
+                    violations.append({
+                        'type': 'after_last_entry',
+                        'index': i,
+                        'destination_id': stop['destination_id'],
+                        'name': stop['name'],
+                        'arrival': format_hhmm(begin),
+                        'limit': format_hhmm(entry_limit),
+                        'overrun_minutes': begin - entry_limit,
+                    })
+                end = begin + stop['stay']
+                if stop['close'] is not None and end > stop['close']:
+                    violations.append({
+                        'type': 'past_closing',
+                        'index': i,
+                        'destination_id': stop['destination_id'],
+                        'name': stop['name'],
+                        'end': format_hhmm(end),
+                        'limit': format_hhmm(stop['close']),
+                        'overrun_minutes': end - stop['close'],
+                    })
+                timeline.append(('visit', i, begin, end))
+                state.append({'index': i, 'arrive': arrive, 'start': begin, 'end': end})
+                t = end
+
+            if i == n - 1:
+                i += 1
+                break
+
+            # 次の移動の前に食事枠に入っていれば食事を挿入
+            while meal_pos < len(MEAL_SLOTS) and t >= MEAL_SLOTS[meal_pos][3]:
+                kind, label, _, latest, _ = MEAL_SLOTS[meal_pos]
+                meal_pos += 1
+                warnings.append({'type': 'meal_missed', 'meal': kind, 'index': i,
+                                 'message': f"{label}の時間帯（{format_hhmm(latest)}まで）に食事枠を確保できません"})
+            if meal_pos < len(MEAL_SLOTS) and t >= MEAL_SLOTS[meal_pos][2]:
+                kind, label, _, _, duration = MEAL_SLOTS[meal_pos]
+                meal_pos += 1
+                restaurant = self.nearest_restaurant(stop['point'])
+                detour = 0
+                if restaurant:
+                    detour = int(round(restaurant['distance_km'] * ROAD_FACTOR * 2 / FALLBACK_SPEED_KMH * 60))
+                timeline.append(('meal', i, t, t + duration + detour, kind, label, restaurant, detour))
+                t += duration + detour
+
+            travel = stop['travel'] or 0
+            timeline.append(('travel', i, t, t + travel))
+            t += travel + buffer
+            i += 1
+
+        changed_to = len(timeline)
+        if converged_at is not None:
+            # 以降は編集前と同じ結果（インデックスだけずらす）
+            old_from = converged_at - delta
+            old_pos = next(p for p, item in enumerate(previous['timeline']) if item[1] >= old_from)
+            timeline.extend((item[0], item[1] + delta) + tuple(item[2:]) for item in previous['timeline'][old_pos:])
+            violations.extend(dict(v, index=v['index'] + delta) for v in previous['violations']
+                              if v.get('index', -1) >= old_from)
+            warnings.extend(dict(w, index=w['index'] + delta) for w in previous['warnings'] if w['index'] >= old_from)
+            state.extend(dict(s, index=s['index'] + delta) for s in previous['state'] if s['index'] >= old_from)
+            checkpoints.extend(previous['checkpoints'][old_from:])
+            t, meal_pos = previous['end'], previous['meal_pos']
+            old_changed_to = old_pos
+        else:
+            # 最後の観光が食事の時間帯にかかって終わった場合は、その後に食事枠を確保する
+            for kind, label, earliest, latest, duration in MEAL_SLOTS[meal_pos:]:
+                if t < earliest or not stops:
+                    continue
+                if t <= latest:
+                    restaurant = self.nearest_restaurant(stops[-1]['point'])
+                    timeline.append(('meal', n - 1, t, t + duration, kind, label, restaurant, 0))
+                    t += duration
+                else:
+                    warnings.append({'type': 'meal_missed', 'meal': kind, 'index': n - 1,
+                                     'message': f"{label}の時間帯（{format_hhmm(latest)}まで）に食事枠を確保できません"})
+                meal_pos += 1
+            changed_to = len(timeline)
+            old_changed_to = len(previous['timeline']) if previous is not None else 0
+
+        deadline = params['deadline']
+        if deadline is not None and t > deadline:
+            violations.append({
+                'type': 'day_overrun',
+                'end': format_hhmm(t),
+                'limit': format_hhmm(deadline),
+                'overrun_minutes': t - deadline,
+            })
+
+        self._propagate_slack(stops, state, deadline)
+        return {
+            'feasible': not violations,
+            'violations': violations,
+            'warnings': warnings,
+            'timeline': timeline,
+            'state': state,
+            'end': t,
+            'stops': stops,
+            'params': params,
+            'checkpoints': checkpoints,
+            'meal_pos': meal_pos,
+            # 再計算したタイムライン範囲: 旧 [from, old_to) を 新 [from, to) で置き換え
+            'changed': {'from': prefix_len, 'to': changed_to, 'old_to': old_changed_to},
+        }
+
+    def _propagate_slack(self, stops: List[Dict], state: List[Dict], deadline: Optional[int]) -> None:
+        """
+        後ろ向きに最遅開始時刻を伝播し、各地点の余裕時間（slack）を state に記録
+
+        slack が負の地点は、それ以降のどこかで制約を満たせないことを表す
+        """
+        latest_next = deadline
+        for rec in reversed(state):
+            stop = stops[rec['index']]
+            limits = []
+            entry_limit = stop['last_entry'] if stop['last_entry'] is not None else stop['close']
+            if entry_limit is not None:
+                limits.append(entry_limit)
+            if stop['close'] is not None:
+                limits.append(stop['close'] - stop['stay'])
+            if latest_next is not None:
+                travel = stop['travel'] or 0
+                limits.append(latest_next - stop['stay'] - travel - self.buffer_minutes)
+            latest = min(limits) if limits else None
+            rec['latest_start'] = latest
+            rec['slack'] = (latest - rec['start']) if latest is not None else None
+            latest_next = latest
+
+    # ---- 検証・修復 ----
+
+    def validate(self, waypoints: List[Dict], start_time: str = '09:00', *,
+                 end_time: Optional[str] = None, meals: bool = True) -> Dict:
+        """waypoints を検証して違反を返す（イベント列は作らない）"""
+        result = self.schedule(self.stops_from_waypoints(waypoints), start_time, end_time=end_time, meals=meals)
+        return {
+            'feasible': result['feasible'],
+            'violations': result['violations'],
+            'warnings': result['warnings'],
+            'end_time': format_hhmm(result['end']),
+        }
+
+    def repair(self, stops: List[Dict], start_time: str = '09:00', *,
+               end_time: Optional[str] = None, meals: bool = True, max_drops: Optional[int] = None) -> Dict:
+        """
+        違反がなくなるまで最も超過の大きい地点を外して再計算
+
+        外した地点の前後をつなぐ区間は、区間キャッシュまたは直線距離の見積もりで補う
+
+        Returns:
+            schedule の結果に 'stops'（修復後）と 'dropped'（外した地点）を加えたもの
+        """
+        stops = [dict(s) for s in stops]
+        dropped = []
+        limit = max_drops if max_drops is not None else len(stops)
+        result = self.schedule(stops, start_time, end_time=end_time, meals=meals)
+        while not result['feasible'] and len(dropped) < limit:
+            idx = self._worst_stop(result['violations'], stops)
+            if idx is None:
+                break
+            dropped.append({'destination_id': stops[idx]['destination_id'], 'name': stops[idx]['name']})
+            del stops[idx]
+            if 0 < idx < len(stops):
+                prev = stops[idx - 1]
+                prev['travel'], prev['distance_km'], _ = estimate_leg_minutes(prev['point'], stops[idx]['point'])
+            elif idx == len(stops) and stops:
+                stops[-1]['travel'], stops[-1]['distance_km'] = None, None
+            result = self.schedule(stops, start_time, end_time=end_time, meals=meals)
+        result['stops'] = stops
+        result['dropped'] = dropped
+        return result
+
+    @staticmethod
+    def _worst_stop(violations: List[Dict], stops: List[Dict]) -> Optional[int]:
+        """外す地点を選ぶ（地点に紐づく違反のうち超過最大、日の超過のみなら最後の地点）"""
+        per_stop = [v for v in violations if 'index' in v]
+        if per_stop:
+            return max(per_stop, key=lambda v: v['overrun_minutes'])['index']
+        for i in range(len(stops) - 1, -1, -1):
+            if not stops[i]['is_origin']:
+                return i
+        return None
+
+    # ---- 出力 ----
+
+    def to_events(self, stops: List[Dict], timeline: List[tuple], origin_label: str) -> List[Dict]:
+        """timeline を create_itinerary と同じ形式のイベント列に変換（wait / meal を追加）"""
+        events = []
+        for item in timeline:
+            events.extend(self.item_events(stops, item, origin_label))
+        return events
+
+    def item_events(self, stops: List[Dict], item: tuple, origin_label: str) -> List[Dict]:
+        """timeline の1要素をイベント（0〜2件）に変換"""
+        events = []
+        kind, i, begin, end = item[:4]
+        stop = stops[i]
+        name = origin_label if stop['is_origin'] else stop['name']
+        if kind == 'origin':
+            events.append({
+                'time': format_hhmm(begin),
+                'activity_type': 'departure',
+                'location': name,
+                'description': f"{name}から出発",
+            })
+        elif kind == 'wait':
+            events.append({
+                'time': f"{format_hhmm(begin)}-{format_hhmm(end)}",
+                'activity_type': 'wait',
+                'location': name,
+                'description': f"{name}の開館待ち ({end - begin}分)",
+                'duration_minutes': end - begin,
+            })
+        elif kind == 'visit':
+            events.append({
+                'time': format_hhmm(begin),
+                'activity_type': 'arrival',
+                'location': name,
+                'description': f"{name}に到着",
+            })
+            events.append({
+                'time': format_hhmm(begin),
+                'activity_type': 'sightseeing',
+                'location': name,
+                'description': f"{name}で観光",
+                'duration_minutes': stop['stay'],
+            })
+        elif kind == 'meal':
+            _, _, _, _, meal, label, restaurant, detour = item
+            place = restaurant['name'] if restaurant else f"{name}周辺"
+            event = {
+                'time': f"{format_hhmm(begin)}-{format_hhmm(end)}",
+                'activity_type': 'meal',
+                'meal': meal,
+                'location': place,
+                'description': f"{label} ({place})",
+                'duration_minutes': end - begin,
+            }
+            if restaurant:
+                event['restaurant'] = restaurant
+                event['detour_minutes'] = detour
+            events.append(event)
+        elif kind == 'travel':
+            nxt = stops[i + 1]['name']
+            if not stop['is_origin']:
+                events.append({
+                    'time': format_hhmm(begin),
+                    'activity_type': 'departure',
+                    'location': name,
+                    'description': f"{name}から出発",
+                })
+            events.append({
+                'time': f"{format_hhmm(begin)}-{format_hhmm(end)}",
+                'activity_type': 'travel',
+                'from': name,
+                'to': nxt,
+                'description': f"移動 ({stop['distance_km']}km, {stop['travel']}分)",
+                'travel_time_minutes': stop['travel'],
+                'distance_km': stop['distance_km'],
+            })
+        return events
+
+
+# シングルトンインスタンス
+scheduler = Scheduler()
@@ -0,0 +1,418 @@
+"""
+複数日旅程プランナー
+予約のチェックイン〜チェックアウトから日ごとの観光時間枠を作り、選択された観光地を
+地理的にまとまった日程に分割して、日ごとに訪問順の決定・スケジュールを行う
+
+- 分割: ホテルからの方位で観光地を並べ（スイープ）、各日の使える時間に比例して連続区間に切る
+- 順序: 日ごとに所要時間行列の最近傍法
+- スケジュール: 営業時間・食事枠を考慮した詳細旅程（入りきらない地点は他の日への挿入を試す）
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from data.data_loader import data_loader
+from services.destination_service import DestinationService
+from services.hotel_service import hotel_service
+from services.itinerary_service import ItineraryService
+from services.plan_store import plan_store
+from services.rain_plan_service import rain_plan_service
+from services.route_service import RouteService
+from services.scheduler import MEAL_SLOTS, format_hhmm, parse_hhmm, scheduler
+from utils.geo import bearing_deg, distance_matrix_km, nearest_neighbor_order
+from utils.leg_cache import point_key
+from utils.osrm_client import FALLBACK_SPEED_KMH
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('trip')
+
+# これより短い時間枠の日は観光に使わない[分]
+MIN_DAY_MINUTES = 90
+
+# 観光地指定がない場合に、推薦から1件選ぶごとに見込む時間[分]（滞在＋移動）
+MINUTES_PER_RECOMMENDATION = 150
+
+
+class TripPlanner:
+    """予約の滞在期間に合わせた複数日旅程プランナー"""
+
+    def __init__(self):
+        self.data_loader = data_loader
+        self.hotel_service = hotel_service
+        self.route_service = RouteService()
+        self.itinerary_service = ItineraryService()
+        self.destination_service = DestinationService()
+        self.plan_store = plan_store
+        self.rain_plan_service = rain_plan_service
+
+    def day_windows(self, reservation: Dict, day_start: str = '09:00', day_end: str = '19:00') -> List[Dict]:
+        """
+        予約のチェックイン〜チェックアウトから日ごとの観光時間枠を作成
+
+        初日はチェックイン時刻から、最終日はチェックアウト時刻までに制限する
+        """
+        check_in = datetime.strptime(reservation['check_in'], '%Y-%m-%d %H:%M:%S')
+        check_out = datetime.strptime(reservation['check_out'], '%Y-%m-%d %H:%M:%S')
+        base_start = parse_hhmm(day_start)
+        base_end = parse_hhmm(day_end)
+        if base_start is None or base_end is None:
+            raise ValueError('day_start / day_end の形式が不正です (HH:MM)')
+
+        windows = []
+        date = check_in.date()
+        while date <= check_out.date():
+            start = base_start
+            end = base_end
+            if date == check_in.date():
+                start = max(start, check_in.hour * 60 + check_in.minute)
+            if date == check_out.date():
+                end = min(end, check_out.hour * 60 + check_out.minute)
+            if end - start >= MIN_DAY_MINUTES:
+                windows.append({'date': date.isoformat(), 'start': start, 'end': end})
+            date += timedelta(days=1)
+        return windows
+
+    def plan_trip(self, reservation_id: Optional[str] = None, customer_id: Optional[str] = None,
+                  destination_ids: Optional[List[str]] = None, day_start: str = '09:00',
+                  day_end: str = '19:00', include_geometry: bool = False) -> Dict:
+        """
+        滞在期間全体の旅程を1回で作成
+
+        Args:
+            reservation_id: 予約ID（省略時は customer_id の最新の有効な予約）
+            customer_id: 顧客ID
+            destination_ids: 訪問したい観光地ID（省略時は顧客への推薦から選ぶ）
+            day_start / day_end: 各日の観光時間枠 (HH:MM)
+            include_geometry: True の場合は各日の道路ジオメトリも取得
+
+        Returns:
+            日ごとのルート・詳細旅程（plan_id 付き）と、入りきらなかった観光地
+        """
+        t0 = time.perf_counter()
+        try:
+            if reservation_id:
+                reservation = self.data_loader.get_reservation_by_id(reservation_id)
+            elif customer_id:
+                reservation = self.data_loader.get_reservation_for_customer(customer_id)
+            else:
+                return {'status': 'error', 'message': 'reservation_id または customer_id が必要です'}
+            if not reservation:
+                return {'status': 'error', 'message': '有効な予約が見つかりません'}
+            if reservation['status'] == 'キャンセル':
+                return {'status': 'error', 'message': 'キャンセル済みの予約です'}
+
+            windows = self.day_windows(reservation, day_start, day_end)
+            if not windows:
+                return {'status': 'error', 'message': '観光に使える時間枠がありません'}
+
+            hotel = self.hotel_service.hotel
+            if destination_ids is None:
+                recommended = self.destination_service.get_recommended_destinations(
+                    customer_id=reservation['customer_id'],
+                    limit=max(1, sum(w['end'] - w['start'] for w in windows) // MINUTES_PER_RECOMMENDATION),
+                    origin=(hotel['longitude'], hotel['latitude'])
+                )
+                if recommended['status'] != 'success':
+                    return recommended
+                destination_ids = [d['destination_id'] for d in recommended['destinations']]
+
+            destinations = []
+            for dest_id in dict.fromkeys(destination_ids):
+                dest = self.data_loader.get_destination_by_id(dest_id)
+                if not dest:
+                    return {'status': 'error', 'message': f'観光地ID {dest_id} が見つかりません'}
+                destinations.append(dest)
+            if not destinations:
+                return {'status': 'error', 'message': '観光地が指定されていません'}
+            if len(destinations) >= self.route_service.max_table_points:
+                return {
+                    'status': 'error',
+                    'message': f'観光地は{self.route_service.max_table_points - 1}件までです'
+                }
+
+            # ホテル＋観光地の所要時間行列（table リクエスト1回、区間キャッシュ済みなら0回）
+            coords = [(hotel['longitude'], hotel['latitude'])] + [
+                (float(d['longitude']), float(d['latitude'])) for d in destinations
+            ]
+            pairs, osrm_requests, source = self.route_service.get_pair_table(coords)
+            minutes = self._minutes_matrix(coords, pairs)
+
+            groups = self._partition(destinations, coords, minutes, windows)
+
+            # 日ごとの順序付け・ルート作成・スケジュールを並列に実行
+            with ThreadPoolExecutor(max_workers=min(8, len(windows))) as ex:
+                days = list(ex.map(
+                    lambda d: self._plan_day(d, windows[d], groups[d], destinations, minutes, pairs, include_geometry),
+                    range(len(windows))
+                ))
+
+            unscheduled = [u for day in days for u in day.pop('_dropped')]
+            unscheduled = self._place_leftovers(unscheduled, days, destinations, minutes, pairs, include_geometry)
+
+            elapsed_ms = round((time.perf_counter() - t0) * 1000, 1)
+            log_event(logger, logging.INFO, 'trip.planned', reservation_id=reservation['reservation_id'],
+                      days=len(days), destinations=len(destinations), unscheduled=len(unscheduled),
+                      matrix_source=source, ms=elapsed_ms)
+            return {
+                'status': 'success',
+                'reservation': {
+                    'reservation_id': reservation['reservation_id'],
+                    'customer_id': reservation['customer_id'],
+                    'check_in': reservation['check_in'],
+                    'check_out': reservation['check_out'],
+                    'nights': reservation['nights'],
+                },
+                'hotel': hotel,
+                'days': days,
+                'unscheduled': [
+                    {'destination_id': destinations[i]['destination_id'], 'name': destinations[i]['name']}
+                    for i in unscheduled
+                ],
+                'meta': {
+                    'destinations': len(destinations),
+                    'days': len(days),
+                    'matrix_source': source,
+                    'osrm_requests': osrm_requests,
+                    'elapsed_ms': elapsed_ms,
+                }
+            }
+
+        except Exception as e:
+            return {
+                'status': 'error',
+                'message': f'複数日旅程の作成中にエラーが発生しました: {str(e)}'
+            }
+
+    def _minutes_matrix(self, coords: List, pairs: Dict) -> np.ndarray:
+        """区間辞書から所要時間行列[分]を作成（欠けた区間は直線距離で見積もる）"""
+        keys = [point_key(c) for c in coords]
+        estimate = distance_matrix_km(coords) / FALLBACK_SPEED_KMH * 60
+        minutes = np.zeros((len(coords), len(coords)))
+        for i, a in enumerate(keys):
+            for j, b in enumerate(keys):
+                if i != j:
+                    pair = pairs.get((a, b))
+                    minutes[i, j] = pair[1] / 60 if pair else estimate[i, j]
+        return minutes
+
+    def _partition(self, destinations: List[Dict], coords: List, minutes: np.ndarray,
+                   windows: List[Dict]) -> List[List[int]]:
+        """
+        観光地を日ごとのグループに分割
+
+        - 到着日・出発日のような短い時間枠の日には、ホテルから近い観光地を先に割り当てる
+        - 残りは方位スイープで並べ、終日使える日の時間に比例した連続区間に切る
+
+        Returns:
+            日ごとの観光地インデックス（destinations の位置、0 始まり）
+        """
+        n = len(destinations)
+        buffer = self.itinerary_service.default_buffer_minutes
+        stays = [int(d.get('estimated_duration_minutes') or 60) + buffer for d in destinations]
+        round_trips = minutes[0, 1:] + minutes[1:, 0]
+        # 各観光地の負荷 = 滞在 + バッファ + 最寄りの他地点への移動
+        sub = minutes[1:, 1:] + np.diag(np.full(n, np.inf))
+        nearest = sub.min(axis=1) if n > 1 else minutes[0, 1:]
+        weights = [stays[i] + float(nearest[i]) for i in range(n)]
+
+        # 各日の使える時間 = 枠 − 枠内の食事
+        capacities = []
+        for w in windows:
+            meals = sum(duration for _, _, earliest, latest, duration in MEAL_SLOTS
+                        if w['start'] <= latest and w['end'] >= earliest + duration)
+            capacities.append(max(0.0, w['end'] - w['start'] - meals))
+
+        groups: List[List[int]] = [[] for _ in windows]
+        unassigned = set(range(n))
+        full_day = max(capacities)
+        short_days = [d for d, c in enumerate(capacities) if c < full_day * 0.6]
+        long_days = [d for d in range(len(windows)) if d not in short_days]
+        for d in sorted(short_days, key=lambda d: capacities[d]):
+            used = 0.0
+            for i in sorted(unassigned, key=lambda i: round_trips[i]):
+                # 単独で訪れても営業時間内に収まらない観光地は除く
+                opens, closes, _ = scheduler.opening_hours(destinations[i].get('destination_id'))
+                begin = max(windows[d]['start'] + float(minutes[0, i + 1]), opens or 0)
+                if begin + stays[i] + float(minutes[i + 1, 0]) > min(windows[d]['end'], closes or 24 * 60):
+                    continue
+                cost = stays[i] + (float(round_trips[i]) if not groups[d] else float(nearest[i]))
+                if used + cost <= capacities[d] and len(unassigned) > len(long_days):
+                    groups[d].append(i)
+                    used += cost
+            unassigned -= set(groups[d])
+        if not long_days:
+            long_days = short_days
+        if not unassigned:
+            return groups
+
+        # 最も大きく開いた方位の隙間から走査を始め、同じ方面の観光地を分断しない
+        rest = sorted(unassigned)
+        bearings = bearing_deg(coords[0], [coords[i + 1] for i in rest])
+        order = [rest[k] for k in np.argsort(bearings, kind='stable')]
+        if len(order) > 1:
+            sorted_b = np.sort(bearings, kind='stable')
+            gaps = np.diff(np.append(sorted_b, sorted_b[0] + 360.0))
+            start = (int(np.argmax(gaps)) + 1) % len(order)
+            order = order[start:] + order[:start]
+
+        # 終日の日はホテルとの往復（中央値）も差し引いた時間に比例して切る
+        round_trip = float(np.median(round_trips))
+        usable = [max(0.0, capacities[d] - round_trip) for d in long_days]
+        total_usable = sum(usable) or 1.0
+        targets = [sum(weights[i] for i in order) * u / total_usable for u in usable]
+
+        k = 0
+        load = 0.0
+        for idx in order:
+            while k < len(long_days) - 1 and load + weights[idx] / 2 > targets[k]:
+                k += 1
+                load = 0.0
+            groups[long_days[k]].append(int(idx))
+            load += weights[idx]
+        return groups
+
+    def _plan_day(self, day_index: int, window: Dict, group: List[int], destinations: List[Dict],
+                  minutes: np.ndarray, pairs: Dict, include_geometry: bool) -> Dict:
+        """1日分の訪問順を決め、ルートと詳細旅程を作成"""
+        day = {
+            'day': day_index + 1,
+            'date': window['date'],
+            'window': {'start': format_hhmm(window['start']), 'end': format_hhmm(window['end'])},
+            'destination_ids': [],
+            '_dropped': [],
+        }
+        if not group:
+            day['itinerary'] = None
+            return day
+
+        # 行列上の位置（0 = ホテル）で最近傍法
+        nodes = [0] + [i + 1 for i in group]
+        order = nearest_neighbor_order(minutes[np.ix_(nodes, nodes)], start=0)
+        ordered = [group[k - 1] for k in order[1:]]
+        return self._schedule_day(day, window, ordered, destinations, minutes, pairs, include_geometry)
+
+    def _schedule_day(self, day: Dict, window: Dict, ordered: List[int], destinations: List[Dict],
+                      minutes: np.ndarray, pairs: Dict, include_geometry: bool, plan_kind: str = 'standard') -> Dict:
+        """
+        訪問順の決まった1日分のルート・詳細旅程を作成（ホテルへ戻る時間を終了期限から差し引く）
+        修復で観光地を外したら、残りの最後の観光地からの戻り時間で期限を決め直して作り直す（外れなくなるまで）
+        plan_kind='trial' の旅程は採用されるまで雨天版を作らない
+        """
+        kept = list(ordered)
+        itinerary = None
+        while True:
+            route = self.route_service.route_for_order(self._day_stops(kept, destinations), pairs=pairs,
+                                                       include_geometry=include_geometry)
+            if route['status'] != 'success':
+                return self._day_error(day, ordered, route['message'], itinerary)
+
+            return_minutes = int(round(minutes[kept[-1] + 1, 0])) if kept else 0
+            # 途中の試行は雨天版を作らないよう trial で作り、確定したものだけ plan_kind にする
+            attempt = self.itinerary_service.create_detailed_schedule(route['route'], {
+                'start_time': format_hhmm(window['start']),
+                'end_time': format_hhmm(window['end'] - return_minutes),
+                'travel_date': window['date'],
+                'repair': True,
+                'plan_kind': 'trial',
+            })
+            if itinerary is not None:
+                # 作り直す前の試行は使わない
+                self.plan_store.delete(itinerary['plan_id'])
+            if attempt['status'] != 'success':
+                return self._day_error(day, ordered, attempt['message'])
+            itinerary = attempt
+
+            dropped_ids = {d['destination_id'] for d in itinerary.get('dropped', [])}
+            if not dropped_ids:
+                break
+            kept = [i for i in kept if destinations[i]['destination_id'] not in dropped_ids]
+
+        kept_ids = [destinations[i]['destination_id'] for i in kept]
+        if plan_kind != 'trial':
+            self.plan_store.set_kind(itinerary['plan_id'], plan_kind)
+        day.update({
+            'destination_ids': kept_ids,
+            'route': route['route'],
+            'plan_id': itinerary['plan_id'],
+            'version': itinerary['version'],
+            'itinerary': itinerary['itinerary'],
+            'summary': itinerary['summary'],
+            'feasible': itinerary['feasible'],
+            'violations': itinerary['violations'],
+            'warnings': itinerary['warnings'],
+            'return_to_hotel_minutes': return_minutes,
+            '_dropped': [i for i in ordered if i not in kept],
+        })
+        return day
+
+    def _day_error(self, day: Dict, ordered: List[int], message: str, itinerary: Optional[Dict] = None) -> Dict:
+        """1日分の作成に失敗した日（途中の試行の旅程は消す）"""
+        if itinerary is not None:
+            self.plan_store.delete(itinerary['plan_id'])
+        day['_dropped'] = list(ordered)
+        day['error'] = message
+        day['itinerary'] = None
+        return day
+
+    @staticmethod
+    def _day_stops(ordered: List[int], destinations: List[Dict]) -> List[Dict]:
+        """ホテル（START）から訪問順に並べた route_for_order 用の地点列"""
+        return [{'destination_id': 'START'}] + [
+            {
+                'destination_id': destinations[i]['destination_id'],
+                'latitude': float(destinations[i]['latitude']),
+                'longitude': float(destinations[i]['longitude']),
+            }
+            for i in ordered
+        ]
+
+    def _place_leftovers(self, leftovers: List[int], days: List[Dict], destinations: List[Dict],
+                         minutes: np.ndarray, pairs: Dict, include_geometry: bool) -> List[int]:
+        """
+        入りきらなかった観光地を、近い日から順に最も移動の増えない位置へ挿入してみる
+        （その日の詳細旅程に違反が出なければ採用）
+
+        Returns:
+            どの日にも入らなかった観光地のインデックス
+        """
+        id_to_index = {d['destination_id']: i for i, d in enumerate(destinations)}
+        remaining = []
+        for leftover in leftovers:
+            node = leftover + 1
+            candidates = [d for d in days if d.get('itinerary') and d['destination_ids']]
+            candidates.sort(key=lambda d: min(minutes[node, id_to_index[x] + 1] for x in d['destination_ids']))
+            placed = False
+            for day in candidates:
+                ordered = [id_to_index[x] for x in day['destination_ids']]
+                nodes = [0] + [i + 1 for i in ordered] + [0]
+                best = min(range(1, len(nodes)),
+                           key=lambda k: minutes[nodes[k - 1], node] + minutes[node, nodes[k]] - minutes[nodes[k - 1], nodes[k]])
+                window = {'date': day['date'], 'start': parse_hhmm(day['window']['start']),
+                          'end': parse_hhmm(day['window']['end'])}
+                base = {'day': day['day'], 'date': day['date'], 'window': day['window'],
+                        'destination_ids': [], '_dropped': []}
+                rebuilt = self._schedule_day(base, window, ordered[:best - 1] + [leftover] + ordered[best - 1:],
+                                             destinations, minutes, pairs, include_geometry, plan_kind='trial')
+                if rebuilt.get('itinerary') and rebuilt['feasible'] and not rebuilt['_dropped']:
+                    # 採用した試行を通常の旅程にし（雨天版の作成が予約される）、置き換えた旅程は消す
+                    self.plan_store.set_kind(rebuilt['plan_id'], 'standard')
+                    self.rain_plan_service.discard(day['plan_id'])
+                    rebuilt.pop('_dropped')
+                    day.clear()
+                    day.update(rebuilt)
+                    placed = True
+                    break
+                if rebuilt.get('plan_id'):
+                    self.plan_store.delete(rebuilt['plan_id'])
+            if not placed:
+                remaining.append(leftover)
+        return remaining
+
+
+# シングルトンインスタンス
+trip_planner = TripPlanner()
@@ -1,10 +1,12 @@
 """
-Flaskサーバー起動スクリプト
+サーバー起動スクリプト
+FastAPI（main.py）と Flask の /api/* を1つの ASGI アプリ（main:app）として uvicorn で起動する
 本番環境での起動に使用
 """
 
 import os
-from app import create_app
+
+import uvicorn
 
 def main():
     """メイン関数"""
@@ -12,31 +14,32 @@ def main():
     print("=" * 50)
     
     # 環境変数から設定を読み込み
-    host = os.getenv('FLASK_HOST', '0.0.0.0')
-    port = int(os.getenv('FLASK_PORT', 5001))
-    debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    host = os.getenv('HOST', os.getenv('FLASK_HOST', '0.0.0.0'))
+    port = int(os.getenv('PORT', os.getenv('FLASK_PORT', 8000)))
+    debug = os.getenv('DEBUG', os.getenv('FLASK_DEBUG', 'False')).lower() == 'true'
+    workers = int(os.getenv('WEB_CONCURRENCY', 1))
     
     print(f"サーバー設定:")
     print(f"  ホスト: {host}")
     print(f"  ポート: {port}")
     print(f"  デバッグモード: {debug}")
+    print(f"  ワーカー数: {workers}")
     print()
     
-    # アプリケーション作成
-    app = create_app()
-    
     print("APIエンドポイント:")
     print(f"  ヘルスチェック: http://{host}:{port}/api/health")
     print(f"  候補地取得: http://{host}:{port}/api/destinations")
     print(f"  ルート取得: http://{host}:{port}/api/route")
     print(f"  旅程作成: http://{host}:{port}/api/itinerary")
+    print(f"  カタログ: http://{host}:{port}/catalog/items")
     print()
     
     print("サーバー起動中...")
     print("停止するには Ctrl+C を押してください")
     
     try:
-        app.run(host=host, port=port, debug=debug)
+        # reload は単一ワーカーのみ
+        uvicorn.run('main:app', host=host, port=port, reload=debug, workers=1 if debug else workers)
     except KeyboardInterrupt:
         print("\nサーバーを停止しました")
 
@@ -14,6 +14,7 @@ from services.destination_service import DestinationService
 from services.route_service import RouteService
 from services.itinerary_service import ItineraryService
 from utils.osrm_client import OSRMClient
+from utils import geo
 
 def test_destination_service():
     """候補地取得サービスのテスト"""
@@ -138,6 +139,366 @@ def test_itinerary_service(route_data=None):
     
     print()
 
+def test_geo_utils():
+    """地理計算ユーティリティのテスト"""
+    print("=== 地理計算ユーティリティテスト ===")
+    
+    hotel = (127.7723, 26.3105)
+    points = [(127.7199, 26.2173), (127.6792, 26.2124), (127.8779, 26.6940)]
+    
+    matrix = geo.distance_matrix_km(points)
+    print(f"距離行列: {matrix.round(2).tolist()}")
+    assert matrix.shape == (3, 3)
+    assert abs(matrix[0, 1] - geo.haversine_km(points[0], points[1])) < 1e-9
+    assert abs(geo.haversine_km(hotel, points[0]) - 11.6) < 0.1
+    
+    order = geo.nearest_neighbor_order(geo.distance_matrix_km([hotel] + points), start=0)
+    print(f"最近傍順: {order}")
+    assert order[0] == 0 and sorted(order) == [0, 1, 2, 3]
+    
+    # 北向きの区間からの距離
+    d = geo.point_to_polyline_km((127.80, 26.40), [(127.75, 26.30), (127.75, 26.50)])
+    print(f"折れ線までの距離: {d:.2f}km")
+    assert 4.5 < d < 5.5
+    
+    print()
+
+def test_scheduler():
+    """営業時間・食事枠スケジューラのテスト"""
+    print("=== スケジューラテスト ===")
+    
+    service = ItineraryService()
+    waypoints = [
+        {'destination_id': 'START', 'name': 'ホテル', 'latitude': 26.3105, 'longitude': 127.7723,
+         'estimated_stay_minutes': 0, 'travel_to_next': {'distance_km': 12.0, 'duration_minutes': 20}},
+        {'destination_id': 'D001', 'name': '首里城', 'latitude': 26.2173, 'longitude': 127.7199,
+         'estimated_stay_minutes': 90, 'travel_to_next': {'distance_km': 5.0, 'duration_minutes': 15}},
+        {'destination_id': 'D003', 'name': '国際通り', 'latitude': 26.2124, 'longitude': 127.6792,
+         'estimated_stay_minutes': 60, 'travel_to_next': {'distance_km': 80.0, 'duration_minutes': 110}},
+        {'destination_id': 'D002', 'name': '美ら海水族館', 'latitude': 26.6940, 'longitude': 127.8779,
+         'estimated_stay_minutes': 120, 'travel_to_next': None},
+    ]
+    
+    # 07:30 出発: 首里城の開館待ちと昼食枠が入り、違反なし
+    result = service.create_detailed_schedule({'waypoints': waypoints}, {'start_time': '07:30'})
+    types = [e['activity_type'] for e in result['itinerary']['schedule']]
+    print(f"イベント: {types}")
+    assert result['feasible'] and 'wait' in types and 'meal' in types
+    
+    # 11:30 出発: 美ら海水族館の最終入場に間に合わず、修復で外れる
+    checked = service.validate_plans([{'waypoints': waypoints}], start_time='11:30', repair=True)
+    item = checked['results'][0]
+    print(f"修復: {item['dropped']} ({checked['meta']['elapsed_ms']}ms)")
+    assert item['feasible'] and [d['destination_id'] for d in item['dropped']] == ['D002']
+    
+    # 単発編集: 差分を当てた結果が保存済みプランと一致する
+    schedule = list(result['itinerary']['schedule'])
+    edited = service.edit_plan(result['plan_id'], {'op': 'shift', 'index': 2, 'minutes': 30},
+                               version=result['version'])
+    patch = edited['patch']
+    schedule[patch['start']:patch['start'] + patch['delete_count']] = patch['events']
+    print(f"編集: version={edited['version']} {edited['meta']}")
+    assert schedule == service.get_plan(result['plan_id'])['itinerary']['schedule']
+    assert service.edit_plan(result['plan_id'], {'op': 'delete', 'index': 1}, version=1)['error_code'] == 'version_conflict'
+    
+    print()
+
+def test_trip_planner():
+    """複数日旅程プランナーのテスト"""
+    print("=== 複数日旅程テスト ===")
+    
+    from services.trip_planner import trip_planner
+    from data.data_loader import data_loader
+    
+    reservation = next(r for r in data_loader.load_reservations() if r['nights'] == 5 and r['status'] != 'キャンセル')
+    windows = trip_planner.day_windows(reservation)
+    print(f"時間枠: {[(w['date'], w['start'], w['end']) for w in windows]}")
+    assert len(windows) == 6 and windows[0]['start'] == 15 * 60 and windows[-1]['end'] == 11 * 60
+    
+    ids = ['D001', 'D002', 'D003', 'D004', 'D005', 'D007', 'D008', 'D009']
+    result = trip_planner.plan_trip(reservation_id=reservation['reservation_id'], destination_ids=ids)
+    print(f"結果: {result['status']} {result.get('meta')}")
+    assert result['status'] == 'success' and len(result['days']) == 6
+    planned = [x for day in result['days'] for x in day['destination_ids']]
+    unscheduled = [u['destination_id'] for u in result['unscheduled']]
+    assert sorted(planned + unscheduled) == sorted(ids)
+    for day in result['days']:
+        print(f"  {day['date']}: {day['destination_ids']}")
+        assert day.get('feasible', True)
+    
+    # 修復で最後の D003 が外れると、ホテルまで遠い D006 が最後になり期限が早まる（D006 も外れる）
+    from services.rain_plan_service import rain_plan_service
+    from services.scheduler import parse_hhmm
+    from utils.leg_cache import point_key
+    destinations = [data_loader.get_destination_by_id(x) for x in ['D011', 'D006', 'D003']]
+    coords = [(trip_planner.hotel_service.hotel['longitude'], trip_planner.hotel_service.hotel['latitude'])] + [
+        (float(d['longitude']), float(d['latitude'])) for d in destinations
+    ]
+    return_minutes = {1: 10, 2: 60, 3: 10}
+    pairs = {
+        (point_key(a), point_key(b)): (5000.0, 60.0 * (return_minutes[i] if j == 0 else 10))
+        for i, a in enumerate(coords) for j, b in enumerate(coords) if i != j
+    }
+    minutes = trip_planner._minutes_matrix(coords, pairs)
+    window = {'date': '2025-07-01', 'start': 14 * 60, 'end': 18 * 60}
+    day = trip_planner._schedule_day({'day': 1, 'date': window['date'], 'destination_ids': [], '_dropped': []},
+                                     window, [0, 1, 2], destinations, minutes, pairs, False)
+    print(f"戻り区間: {day['destination_ids']} return={day['return_to_hotel_minutes']} end={day['itinerary']['end_time']}")
+    assert day['destination_ids'] == ['D011'] and day['_dropped'] == [1, 2]
+    assert day['return_to_hotel_minutes'] == 10 and day['feasible']
+    assert parse_hhmm(day['itinerary']['end_time']) + day['return_to_hotel_minutes'] <= window['end']
+    rain_plan_service.discard(day['plan_id'])
+    
+    print()
+
+def test_rain_plan():
+    """雨天版旅程のテスト"""
+    print("=== 雨天版旅程テスト ===")
+    
+    from services.rain_plan_service import rain_plan_service
+    
+    waypoints = [
+        {'destination_id': 'START', 'name': 'ホテル', 'latitude': 26.3105, 'longitude': 127.7723,
+         'estimated_stay_minutes': 0, 'travel_to_next': {'distance_km': 12.0, 'duration_minutes': 20}},
+        {'destination_id': 'D003', 'name': '国際通り', 'latitude': 26.2124, 'longitude': 127.6792,
+         'estimated_stay_minutes': 60, 'travel_to_next': {'distance_km': 5.0, 'duration_minutes': 15}},
+        {'destination_id': 'D001', 'name': '首里城', 'latitude': 26.2173, 'longitude': 127.7199,
+         'estimated_stay_minutes': 90, 'travel_to_next': None},
+    ]
+    plan = ItineraryService().create_detailed_schedule({'waypoints': waypoints}, {'start_time': '09:00'})
+    rain_plan_service.build(plan['plan_id'])
+    result = rain_plan_service.get_rain_plan(plan['plan_id'])
+    print(f"差し替え: {result['substitutions']} precomputed={result['precomputed']}")
+    assert result['precomputed'] and result['destination_ids'] == ['START', 'D013', 'D001']
+    
+    print()
+
+def test_json_stream():
+    """ストリーミング JSON スキャナのテスト"""
+    print("=== JSON スキャナテスト ===")
+    
+    from utils.json_stream import JsonObjectScanner
+    
+    document = '{"ranked": [{"id": "D001", "reasons": ["{x}", "say \\"]\\""]}, {"id": "D002"}], "rejected": [], "note": "a\\\\"}'
+    text = '```json\n' + document + '\n```'
+    # 文字列・エスケープの途中を含め、3文字ずつに切って流す
+    scanner = JsonObjectScanner(track_keys=("ranked",))
+    closed = None
+    progress = []
+    for i in range(0, len(text), 3):
+        closed = closed or scanner.feed(text[i:i + 3])
+        progress.append(scanner.counts["ranked"])
+    print(f"進捗: {sorted(set(progress))}")
+    assert closed == document and scanner.complete
+    assert json.loads(closed)["ranked"][0]["reasons"] == ["{x}", 'say "]"']
+    assert scanner.counts["ranked"] == 2 and sorted(set(progress)) == [0, 1, 2]
+    
+    # 閉じる前は未完成
+    partial = JsonObjectScanner()
+    assert partial.feed(document[:-1]) is None and not partial.complete
+    
+    print()
+
+class StubLLMClient:
+    """LLMClient の代わり: 呼び出しごとに Future を返し、結果はテスト側で決める"""
+    
+    def __init__(self, expected=None, answers=None):
+        self.expected = expected or {}
+        # モデルごとに即時に返す結果（無いモデルの Future はテスト側で完了させるまで保留）
+        self.answers = answers or {}
+        self.calls = []
+        self.probed = set()
+    
+    def submit_chat(self, base_url, api_key, body, key=None, track_latency=True):
+        from concurrent.futures import Future
+        future = Future()
+        self.calls.append((body['model'], future))
+        if body['model'] in self.answers:
+            future.set_result(self.answers[body['model']])
+        return future
+    
+    def expected_ms(self, model):
+        return self.expected.get(model)
+    
+    def should_probe(self, model):
+        if model in self.probed:
+            return False
+        self.probed.add(model)
+        return True
+
+def test_llm_deadline():
+    """LLM 再ランキングの期限・ヘッジ・profile 切り替えのテスト"""
+    print("=== LLM 期限テスト ===")
+    
+    from services.llm_client import LLMClient
+    from services.llm_reranker import LLMReranker
+    from services.rerank_cache import RerankCache
+    
+    candidates = [{'destination_id': f'D00{i}', 'name': f'観光地{i}', 'recommendation_score': i / 10} for i in range(1, 4)]
+    answer = {'ranked': [{'id': 'D001', 'score': 0.9}], 'rejected': []}
+    
+    def reranker(client, cheap='stub-cheap'):
+        r = LLMReranker(cache=RerankCache(db_path=''))
+        r.openai_api_key = 'stub'
+        r.client = client
+        r.profile_models = {'cheap': cheap, 'balanced': 'stub-balanced', 'quality': 'stub-quality'}
+        r.hedge, r.hedge_after_ms = True, 10_000
+        return r
+    
+    # 期限切れ: ルールベースを返し、後から届いた結果はキャッシュに入って次回に使われる
+    client = StubLLMClient()
+    r = reranker(client)
+    result = r.rerank({}, {}, candidates, top_k=3, deadline_ms=50)
+    assert result['meta']['fallback_reason'] == 'deadline' and client.calls[0][0] == 'stub-balanced'
+    client.calls[0][1].set_result(answer)
+    cached = r.rerank({}, {}, candidates, top_k=3, deadline_ms=50)
+    print(f"期限後の結果: {cached['meta']}")
+    assert cached['meta']['cache'] == 'hit' and cached['ranked'][0]['id'] == 'D001'
+    
+    # 本命が失敗したらすぐにヘッジし、ヘッジ側の結果に hedged が付く
+    client = StubLLMClient(answers={'stub-balanced': None, 'stub-cheap': answer})
+    result = reranker(client).rerank({}, {}, candidates, top_k=3, deadline_ms=5000)
+    print(f"ヘッジ: {[m for m, _ in client.calls]} {result['meta']['profile']}")
+    assert [m for m, _ in client.calls] == ['stub-balanced', 'stub-cheap']
+    assert result['meta']['profile'] == 'cheap' and result['meta']['hedged']
+    
+    # cheap と balanced が同じモデル・温度ならヘッジしない
+    client = StubLLMClient()
+    reranker(client, cheap='stub-balanced').rerank({}, {}, candidates, top_k=3, deadline_ms=50)
+    assert len(client.calls) == 1
+    
+    # 期限に収まらない見込みの quality は balanced に下げ、quality は試し呼び出しだけ行う
+    client = StubLLMClient(expected={'stub-quality': 9000}, answers={'stub-balanced': answer})
+    result = reranker(client).rerank({}, {}, candidates, top_k=3, model_profile='quality', deadline_ms=5000)
+    print(f"profile 切り替え: {[m for m, _ in client.calls]} {result['meta']['profile']}")
+    assert [m for m, _ in client.calls] == ['stub-quality', 'stub-balanced']
+    assert result['meta']['profile'] == 'balanced' and not result['meta']['hedged']
+    
+    # 見積もりは1回の実績では使わず、古くなったら捨てる
+    llm = LLMClient()
+    llm._record_latency('m', 9000)
+    assert llm.expected_ms('m') is None
+    llm._record_latency('m', 1000)
+    llm._record_latency('m', 1000)
+    assert 1000 < llm.expected_ms('m') < 9000
+    llm.latency_ttl = -1
+    assert llm.expected_ms('m') is None
+    assert llm.should_probe('m') and not llm.should_probe('m')
+    
+    print()
+
+def test_migrations():
+    """SQLite マイグレーションのテスト"""
+    print("=== マイグレーションテスト ===")
+    
+    import sqlite3
+    import tempfile
+    from main import MIGRATIONS
+    from utils.migrations import migrate
+    
+    def broken(conn):
+        raise RuntimeError('broken step')
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        # 新規: 全ステップを適用してバージョン 2、再実行は何もしない
+        conn = sqlite3.connect(os.path.join(tmp, 'fresh.db'))
+        assert migrate(conn, MIGRATIONS) == (0, 2)
+        assert migrate(conn, MIGRATIONS) == (2, 2)
+        (named,) = conn.execute("SELECT COUNT(*) FROM customers WHERE display_name IS NOT NULL").fetchone()
+        print(f"新規: 表示名のある顧客 {named} 件")
+        assert named > 0
+        conn.close()
+        
+        # バージョン管理前の DB（customers に display_name 列なし）を最新にする
+        conn = sqlite3.connect(os.path.join(tmp, 'legacy.db'))
+        conn.execute("CREATE TABLE customers (id TEXT PRIMARY KEY, adults INTEGER, children INTEGER, "
+                     "seniors INTEGER, stroller INTEGER, wheelchair INTEGER)")
+        conn.execute("INSERT INTO customers VALUES ('C001', 2, 0, 0, 0, 0)")
+        conn.commit()
+        assert migrate(conn, MIGRATIONS) == (0, 2)
+        (name,) = conn.execute("SELECT display_name FROM customers WHERE id = 'C001'").fetchone()
+        (count,) = conn.execute("SELECT COUNT(*) FROM customers").fetchone()
+        print(f"旧形式: C001 = {name}")
+        assert name and count == 1
+        conn.close()
+        
+        # 途中のステップが失敗したら全部ロールバックし、user_version も変わらない
+        conn = sqlite3.connect(os.path.join(tmp, 'broken.db'))
+        try:
+            migrate(conn, MIGRATIONS + [broken])
+            assert False, 'migrate should raise'
+        except RuntimeError:
+            pass
+        assert conn.execute("PRAGMA user_version").fetchone() == (0,)
+        assert conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall() == []
+        conn.close()
+    
+    print()
+
+def test_wsgi_bridge():
+    """Flask マウント用 WSGI ブリッジのテスト（切断でストリームを止める）"""
+    print("=== WSGI ブリッジテスト ===")
+    
+    import asyncio
+    import time
+    from flask import Flask, Response, stream_with_context
+    from utils.wsgi_bridge import WSGIBridge
+    
+    state = {'produced': 0, 'closed': False}
+    
+    def factory():
+        app = Flask(__name__)
+        
+        @app.route('/lines')
+        def lines():
+            def generate():
+                try:
+                    for i in range(50):
+                        time.sleep(0.02)
+                        state['produced'] += 1
+                        yield f'{i}\n'
+                finally:
+                    state['closed'] = True
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        return app
+    
+    async def run():
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/lines', 'root_path': '/api',
+                 'query_string': b'', 'http_version': '1.1', 'headers': []}
+        disconnect = asyncio.Event()
+        received = []
+        sent = []
+        
+        async def receive():
+            if not received:
+                received.append(True)
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+        
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 4:
+                disconnect.set()
+        
+        await WSGIBridge(factory)(scope, receive, send)
+        return sent
+    
+    sent = asyncio.run(run())
+    print(f"生成: {state['produced']} 件, close: {state['closed']}")
+    assert sent[0]['status'] == 200 and sent[1]['body'] == b'0\n'
+    assert state['closed'] and state['produced'] < 50
+    
+    print()
+
+def teardown_module(module=None):
+    """バックグラウンドの処理（雨天版の作成・ホテルの事前計算）の終了を待つ"""
+    from services.hotel_service import hotel_service
+    from services.rain_plan_service import rain_plan_service
+    
+    rain_plan_service.shutdown(wait=True)
+    hotel_service.wait_warm()
+
 def main():
     """メインテスト関数"""
     print("旅行プラン作成API テストスイート")
@@ -155,6 +516,31 @@ def main():
     # 4. 旅程作成テスト
     test_itinerary_service(route_result)
     
+    # 5. 地理計算テスト
+    test_geo_utils()
+    
+    # 6. スケジューラテスト
+    test_scheduler()
+    
+    # 7. 複数日旅程テスト
+    test_trip_planner()
+    
+    # 8. 雨天版旅程テスト
+    test_rain_plan()
+    
+    # 9. JSON スキャナテスト
+    test_json_stream()
+    
+    # 10. LLM 期限テスト
+    test_llm_deadline()
+    
+    # 11. マイグレーションテスト
+    test_migrations()
+    
+    # 12. WSGI ブリッジテスト
+    test_wsgi_bridge()
+    
+    teardown_module()
     print("テスト完了")
 
 if __name__ == "__main__":
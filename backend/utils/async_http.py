@@ -0,0 +1,126 @@
+"""
+非同期 HTTP 接続プール
+バックグラウンドスレッドで asyncio のイベントループを1つ動かし、httpx.AsyncClient の接続を使い回す
+同期コード（Flask のリクエスト処理など）からは run / submit、別のイベントループからは wait でコルーチンを実行する
+
+環境変数:
+- HTTP_POOL_MAX_CONNECTIONS: 最大同時接続数（既定: 20）
+- HTTP_POOL_MAX_KEEPALIVE: 保持するアイドル接続数（既定: 10）
+- OUTBOUND_TIMEOUT_SECONDS: request / download / get_json 1回あたりのタイムアウト（既定: 5）
+- OUTBOUND_MAX_CONCURRENCY: request / download / get_json の同時実行数（既定: 8）
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Dict, Optional, Tuple
+
+import httpx
+
+
+class AsyncHttpPool:
+    """イベントループ用スレッドと共有 AsyncClient を遅延作成する接続プール"""
+
+    def __init__(self, max_connections: Optional[int] = None, max_keepalive: Optional[int] = None):
+        self.limits = httpx.Limits(
+            max_connections=int(max_connections or os.getenv('HTTP_POOL_MAX_CONNECTIONS', 20)),
+            max_keepalive_connections=int(max_keepalive or os.getenv('HTTP_POOL_MAX_KEEPALIVE', 10)),
+        )
+        self.outbound_timeout = float(os.getenv('OUTBOUND_TIMEOUT_SECONDS', 5))
+        self._outbound_slots = asyncio.Semaphore(int(os.getenv('OUTBOUND_MAX_CONCURRENCY', 8)))
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """イベントループ（初回にスレッドを起動）"""
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    thread = threading.Thread(target=loop.run_forever, name='async-http', daemon=True)
+                    thread.start()
+                    self._loop = loop
+        return self._loop
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """共有クライアント（イベントループ上のコルーチンからのみ使う）"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self.limits)
+        return self._client
+
+    def submit(self, coro: Awaitable[Any]) -> Future:
+        """コルーチンをイベントループに投入し、concurrent.futures.Future を返す"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+        """コルーチンをイベントループで実行して結果を待つ（タイムアウト時はキャンセル）"""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    async def wait(self, coro: Awaitable[Any]) -> Any:
+        """
+        別のイベントループ（FastAPI など）からコルーチンをこのループで実行して待つ
+        待っている側がキャンセルされたら、こちらのタスクもキャンセルされる
+        """
+        return await asyncio.wrap_future(self.submit(coro))
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """
+        外部 API への1回の呼び出し（どのイベントループからでも await できる）
+        同時実行数の上限とタイムアウト付き。空き待ちも同じタイムアウトの2倍までに制限する
+        """
+        async def call() -> httpx.Response:
+            async with self._outbound_slots:
+                return await self.client.request(method, url, timeout=self.outbound_timeout, **kwargs)
+        return await asyncio.wait_for(self.wait(call()), self.outbound_timeout * 2)
+
+    async def download(self, method: str, url: str, max_bytes: int, **kwargs: Any) -> Tuple[httpx.Response, bytes]:
+        """
+        request と同じ制限付きで本文をストリーミングで読み、(応答, 本文) を返す
+        本文が max_bytes を超えた時点で読むのをやめて ValueError。2xx 以外の応答は本文を読まずに返す
+        """
+        async def call() -> Tuple[httpx.Response, bytes]:
+            async with self._outbound_slots:
+                async with self.client.stream(method, url, timeout=self.outbound_timeout, **kwargs) as resp:
+                    if not resp.is_success:
+                        return resp, b''
+                    length = resp.headers.get('content-length', '')
+                    if length.isdigit() and int(length) > max_bytes:
+                        raise ValueError(f'response too large: {length} bytes')
+                    chunks = []
+                    size = 0
+                    async for chunk in resp.aiter_bytes():
+                        size += len(chunk)
+                        if size > max_bytes:
+                            raise ValueError(f'response too large: over {max_bytes} bytes')
+                        chunks.append(chunk)
+                    return resp, b''.join(chunks)
+        return await asyncio.wait_for(self.wait(call()), self.outbound_timeout * 2)
+
+    async def get_json(self, url: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        """GET して JSON を返す（2xx 以外は httpx.HTTPStatusError）"""
+        resp = await self.request('GET', url, params=params)
+        resp.raise_for_status()
+        return resp.json()
+
+    def close(self) -> None:
+        """接続を閉じてイベントループを止める"""
+        if self._loop is None:
+            return
+        if self._client is not None:
+            self.run(self._client.aclose(), timeout=5)
+            self._client = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+
+# シングルトンインスタンス
+http_pool = AsyncHttpPool()
@@ -0,0 +1,133 @@
+"""
+地理計算ユーティリティ
+NumPy でベクトル化した距離行列・方位・バウンディングボックス・折れ線との距離
+
+座標はすべて OSRM と同じ (longitude, latitude) の順で扱う
+"""
+
+from typing import Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+Point = Tuple[float, float]
+
+
+def _as_array(points: Iterable[Sequence[float]]) -> np.ndarray:
+    """座標列を (N, 2) の float 配列に変換"""
+    arr = np.asarray(list(points) if not isinstance(points, np.ndarray) else points, dtype=float)
+    return arr.reshape(-1, 2)
+
+
+def haversine_km(a: Point, b: Point) -> float:
+    """2点間の大円距離[km]"""
+    return float(distance_matrix_km([a], [b])[0, 0])
+
+
+def distance_matrix_km(points: Iterable[Sequence[float]],
+                       others: Optional[Iterable[Sequence[float]]] = None) -> np.ndarray:
+    """
+    大円距離の行列[km]
+
+    Args:
+        points: N 地点 [(lon, lat), ...]
+        others: M 地点（省略時は points 同士の N×N）
+
+    Returns:
+        (N, M) の距離行列
+    """
+    p = np.radians(_as_array(points))
+    q = p if others is None else np.radians(_as_array(others))
+    lon1, lat1 = p[:, 0:1], p[:, 1:2]
+    lon2, lat2 = q[:, 0], q[:, 1]
+    x = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(x, 0.0, 1.0)))
+
+
+def segment_lengths_km(points: Iterable[Sequence[float]]) -> np.ndarray:
+    """連続する地点間（区間）の距離[km]（長さ N-1 の配列）"""
+    p = np.radians(_as_array(points))
+    lon1, lat1 = p[:-1, 0], p[:-1, 1]
+    lon2, lat2 = p[1:, 0], p[1:, 1]
+    x = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(x, 0.0, 1.0)))
+
+
+def distances_from_km(origin: Point, points: Iterable[Sequence[float]]) -> np.ndarray:
+    """1地点から各地点への距離[km]（長さ M の配列）"""
+    return distance_matrix_km([origin], points)[0]
+
+
+def bearing_deg(origin: Point, points: Iterable[Sequence[float]]) -> np.ndarray:
+    """origin から各地点への初期方位角[度]（北=0、時計回り 0〜360）"""
+    lon1, lat1 = np.radians(origin)
+    q = np.radians(_as_array(points))
+    lon2, lat2 = q[:, 0], q[:, 1]
+    dlon = lon2 - lon1
+    y = np.sin(dlon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return (np.degrees(np.arctan2(y, x)) + 360.0) % 360.0
+
+
+def bounding_box(points: Iterable[Sequence[float]], padding_km: float = 0.0) -> Tuple[float, float, float, float]:
+    """地点群を囲む (min_lon, min_lat, max_lon, max_lat)。padding_km だけ外側に広げる"""
+    arr = _as_array(points)
+    min_lon, min_lat = arr.min(axis=0)
+    max_lon, max_lat = arr.max(axis=0)
+    if padding_km:
+        dlat = np.degrees(padding_km / EARTH_RADIUS_KM)
+        mid_lat = np.radians((min_lat + max_lat) / 2)
+        dlon = dlat / max(np.cos(mid_lat), 1e-6)
+        min_lon, max_lon = min_lon - dlon, max_lon + dlon
+        min_lat, max_lat = min_lat - dlat, max_lat + dlat
+    return (float(min_lon), float(min_lat), float(max_lon), float(max_lat))
+
+
+def within_radius(origin: Point, points: Iterable[Sequence[float]], radius_km: float) -> np.ndarray:
+    """origin から radius_km 以内の地点のインデックス（近い順）"""
+    d = distances_from_km(origin, points)
+    idx = np.nonzero(d <= radius_km)[0]
+    return idx[np.argsort(d[idx], kind='stable')]
+
+
+def point_to_polyline_km(point: Point, polyline: Iterable[Sequence[float]]) -> float:
+    """
+    地点から折れ線（GeoJSON LineString の座標列など）までの最短距離[km]
+
+    地点周辺の正距円筒図法で平面近似し、全線分への距離をまとめて計算する
+    """
+    line = _as_array(polyline)
+    if len(line) == 0:
+        return float('inf')
+    if len(line) == 1:
+        return haversine_km(point, tuple(line[0]))
+
+    lon0, lat0 = point
+    kx = np.radians(1.0) * EARTH_RADIUS_KM * np.cos(np.radians(lat0))
+    ky = np.radians(1.0) * EARTH_RADIUS_KM
+    xy = np.column_stack(((line[:, 0] - lon0) * kx, (line[:, 1] - lat0) * ky))
+
+    a, b = xy[:-1], xy[1:]
+    ab = b - a
+    length2 = np.einsum('ij,ij->i', ab, ab)
+    t = np.where(length2 > 0, np.einsum('ij,ij->i', -a, ab) / np.where(length2 > 0, length2, 1.0), 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    closest = a + ab * t[:, None]
+    return float(np.sqrt(np.einsum('ij,ij->i', closest, closest)).min())
+
+
+def nearest_neighbor_order(matrix: np.ndarray, start: int = 0) -> list:
+    """距離（または時間）行列に対する最近傍法の巡回順（start 固定、戻りなし）"""
+    n = len(matrix)
+    order = [start]
+    visited = np.zeros(n, dtype=bool)
+    visited[start] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, matrix[order[-1]])
+        nxt = int(np.argmin(row))
+        order.append(nxt)
+        visited[nxt] = True
+    return order
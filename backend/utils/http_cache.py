@@ -0,0 +1,172 @@
+"""
+HTTP 条件付きリクエストと圧縮（Flask・FastAPI 共通）
+
+- ETag は本文の SHA-256（バイト列が同じときだけ一致する強い ETag）。圧縮した本文には方式を付けた別の ETag（"…-gzip"）
+- If-None-Match が一致したら 304 で本文を返さない
+- 一定サイズ以上の本文は Accept-Encoding に応じて brotli（brotli パッケージがあれば）か gzip で圧縮
+- 変わらない応答（顧客一覧・カタログなど）は、データのバージョンをキーに
+  シリアライズ済み本文・ETag・圧縮済み本文を保持して使い回す
+
+環境変数:
+- HTTP_COMPRESS_MIN_BYTES: 圧縮する最小サイズ（既定: 1024）
+- HTTP_RESPONSE_CACHE_ENTRIES: 保持するシリアライズ済み応答の数（既定: 256）
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+try:
+    import brotli
+except ImportError:  # 任意依存。無ければ gzip のみ
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.getenv('HTTP_COMPRESS_MIN_BYTES', 1024))
+# 毎回 ETag で再検証させる（一致すれば 304 で本文なし）
+REVALIDATE = 'no-cache'
+
+
+def dumps(payload: Any) -> bytes:
+    """Flask の jsonify と同じく日本語をそのまま出す JSON"""
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def etag_for(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match（カンマ区切り・W/ 付き・* を含む）が ETag に一致するか"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in candidates or f'W/{etag}' in candidates
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """使う圧縮方式（br > gzip、q=0 は不可扱い）"""
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0'):
+            continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def coded_etag(etag: str, encoding: Optional[str]) -> str:
+    """圧縮した本文の ETag（方式ごとにバイト列が違うので別の強い ETag にする）"""
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+
+class PreparedBody:
+    """シリアライズ済み本文と ETag、圧縮結果（方式ごとに初回だけ圧縮）"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = etag_for(body)
+        self._encoded: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def encoded(self, encoding: Optional[str]) -> Optional[bytes]:
+        """圧縮済み本文（圧縮しない場合は None）"""
+        if encoding is None or len(self.body) < COMPRESS_MIN_BYTES:
+            return None
+        with self._lock:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = compress(self.body, encoding)
+            return self._encoded[encoding]
+
+
+def negotiate(prepared: PreparedBody, if_none_match: Optional[str],
+              accept_encoding: Optional[str]) -> Dict[str, Any]:
+    """
+    条件付きリクエストと圧縮の判定
+
+    Returns:
+        {"status": 200 | 304, "body": bytes, "headers": {...}}
+    """
+    encoding = choose_encoding(accept_encoding)
+    encoded = prepared.encoded(encoding)
+    if encoded is None:
+        encoding = None
+    # If-None-Match は今回返す表現（圧縮方式）の ETag と比べる
+    headers = {'ETag': coded_etag(prepared.etag, encoding), 'Cache-Control': REVALIDATE, 'Vary': 'Accept-Encoding'}
+    if etag_matches(if_none_match, headers['ETag']):
+        return {'status': 304, 'body': b'', 'headers': headers}
+    if encoded is not None:
+        headers['Content-Encoding'] = encoding
+        return {'status': 200, 'body': encoded, 'headers': headers}
+    return {'status': 200, 'body': prepared.body, 'headers': headers}
+
+
+class ResponseCache:
+    """キー（データのバージョンを含める）ごとのシリアライズ済み応答の LRU"""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = int(max_entries or os.getenv('HTTP_RESPONSE_CACHE_ENTRIES', 256))
+        self._entries: "OrderedDict[Hashable, PreparedBody]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[PreparedBody]:
+        with self._lock:
+            prepared = self._entries.get(key)
+            if prepared is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prepared
+
+    def put(self, key: Hashable, payload: Any) -> PreparedBody:
+        """payload をシリアライズして登録"""
+        prepared = PreparedBody(dumps(payload))
+        with self._lock:
+            self._entries[key] = prepared
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return prepared
+
+    def get_or_build(self, key: Hashable, build: Callable[[], Any]) -> PreparedBody:
+        """キャッシュ済みの本文、無ければ build() の結果をシリアライズして登録"""
+        return self.get(key) or self.put(key, build())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else None,
+                'brotli': brotli is not None,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# シングルトンインスタンス
+response_cache = ResponseCache()
@@ -0,0 +1,80 @@
+"""
+ストリーミングで届く JSON の逐次スキャナ
+断片を受け取るたびに文字列・エスケープ・括弧の深さを追跡し、
+トップレベルのオブジェクトが閉じた時点で（ストリームの終了を待たずに）全文を返す
+あわせて、トップレベルの指定キーの配列に要素がいくつ完成したかを数える（進捗表示用）
+"""
+
+from typing import Dict, List, Optional, Sequence
+
+
+class JsonObjectScanner:
+    """トップレベルの JSON オブジェクト1つを逐次スキャンする"""
+
+    def __init__(self, track_keys: Sequence[str] = ()):
+        self.track_keys = set(track_keys)
+        # 完成した要素数（track_keys の配列ごと）
+        self.counts: Dict[str, int] = {k: 0 for k in self.track_keys}
+        self._buf: List[str] = []
+        self._stack: List[str] = []
+        self._started = False
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        # トップレベルで次に来る文字列がキーか、直近のキー
+        self._expect_key = False
+        self._key: Optional[str] = None
+        self.document: Optional[str] = None
+
+    @property
+    def complete(self) -> bool:
+        return self.document is not None
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """
+        断片を追加する
+
+        Returns:
+            この断片でトップレベルのオブジェクトが閉じた場合はその JSON 文字列（以降の断片は無視）
+        """
+        if self.document is not None:
+            return None
+        for ch in chunk:
+            if not self._started:
+                # 先頭の空白やコードフェンスなどは読み飛ばす
+                if ch != '{':
+                    continue
+                self._started = True
+            self._buf.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._expect_key and len(self._stack) == 1:
+                        self._key = ''.join(self._buf[self._string_start + 1:-1])
+                        self._expect_key = False
+                continue
+            if ch == '"':
+                self._in_string = True
+                self._string_start = len(self._buf) - 1
+            elif ch in '{[':
+                self._stack.append(ch)
+                if len(self._stack) == 1:
+                    self._expect_key = True
+            elif ch in '}]':
+                if not self._stack:
+                    continue
+                closed = self._stack.pop()
+                depth = len(self._stack)
+                # トップレベル → 配列 → 要素 の要素が閉じた
+                if depth == 2 and self._key in self.track_keys and self._stack[1] == '[':
+                    self.counts[self._key] += 1
+                if depth == 0 and closed == '{':
+                    self.document = ''.join(self._buf)
+                    return self.document
+            elif ch == ',' and len(self._stack) == 1:
+                self._expect_key = True
+        return None
@@ -0,0 +1,86 @@
+"""
+区間（レグ）キャッシュ
+(出発地点, 到着地点, プロファイル) ごとにジオメトリ・距離・所要時間を保持し、
+複数地点ルートを区間の組み合わせで組み立てられるようにする
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+Point = Tuple[float, float]
+LegKey = Tuple[Point, Point, str]
+
+
+def point_key(coord: Point) -> Point:
+    """キャッシュキー用に座標を丸める（約10cm精度）"""
+    return (round(float(coord[0]), 6), round(float(coord[1]), 6))
+
+
+class LegCache:
+    """スレッドセーフな LRU 区間キャッシュ"""
+
+    def __init__(self, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[LegKey, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(a: Point, b: Point, profile: str = 'driving') -> LegKey:
+        return (point_key(a), point_key(b), profile)
+
+    def get(self, a: Point, b: Point, profile: str = 'driving', *, need_geometry: bool = False) -> Optional[Dict]:
+        """
+        区間を取得
+
+        need_geometry=True の場合、距離・時間のみ（table 由来）のエントリはミス扱い
+        """
+        k = self.key(a, b, profile)
+        with self._lock:
+            entry = self._entries.get(k)
+            if entry is None or (need_geometry and entry.get('geometry') is None):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(k)
+            self.hits += 1
+            return entry
+
+    def put(self, a: Point, b: Point, distance_meters: float, duration_seconds: float,
+            geometry: Optional[List[List[float]]] = None, profile: str = 'driving') -> None:
+        """区間を登録（既存エントリのジオメトリは距離・時間のみの更新では消さない）"""
+        k = self.key(a, b, profile)
+        with self._lock:
+            current = self._entries.get(k)
+            if geometry is None and current is not None and current.get('geometry') is not None:
+                self._entries.move_to_end(k)
+                return
+            self._entries[k] = {
+                'geometry': geometry,
+                'distance_meters': float(distance_meters),
+                'duration_seconds': float(duration_seconds),
+            }
+            self._entries.move_to_end(k)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else None,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# シングルトンインスタンス
+leg_cache = LegCache()
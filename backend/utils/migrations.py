@@ -0,0 +1,59 @@
+"""
+SQLite スキーマのマイグレーション
+PRAGMA user_version に適用済みのステップ数を記録し、未適用のステップだけを順に実行する
+
+- スキーマが最新なら user_version を1回読むだけで終わる
+- 未適用のステップはまとめて1トランザクションで実行（途中で失敗したら全部ロールバック）
+- 実行中は一括投入向けの設定（synchronous=OFF、大きめのキャッシュ）にし、終わったら戻す
+"""
+
+import logging
+import sqlite3
+import time
+from typing import Callable, Sequence, Tuple
+
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('migrations')
+
+Migration = Callable[[sqlite3.Connection], None]
+
+
+def migrate(conn: sqlite3.Connection, steps: Sequence[Migration]) -> Tuple[int, int]:
+    """
+    未適用のマイグレーションを実行
+
+    Args:
+        conn: 接続（トランザクション外であること）
+        steps: 順序付きのステップ。i 番目を適用すると user_version が i + 1 になる
+
+    Returns:
+        (実行前のバージョン, 実行後のバージョン)
+    """
+    (current,) = conn.execute("PRAGMA user_version").fetchone()
+    target = len(steps)
+    if current >= target:
+        return current, current
+
+    started = time.perf_counter()
+    (synchronous,) = conn.execute("PRAGMA synchronous").fetchone()
+    (cache_size,) = conn.execute("PRAGMA cache_size").fetchone()
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-65536")
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for version in range(current, target):
+                steps[version](conn)
+            conn.execute(f"PRAGMA user_version={target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute(f"PRAGMA synchronous={synchronous}")
+        conn.execute(f"PRAGMA cache_size={cache_size}")
+    log_event(logger, logging.INFO, 'db.migrated', steps=[s.__name__ for s in steps[current:]],
+              from_version=current, to_version=target,
+              ms=round((time.perf_counter() - started) * 1000, 1))
+    return current, target
@@ -3,11 +3,21 @@ OSRM API クライアント
 Open Source Routing Machine の公開デモサーバーとの通信
 """
 
+import logging
 import os
 import requests
 import time
 from typing import List, Dict, Tuple, Optional
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.geo import distance_matrix_km, segment_lengths_km
+from utils.leg_cache import leg_cache, point_key
+from utils.telemetry import get_logger, log_event, span
+
+logger = get_logger('osrm')
+
+# OSRM 不達時の直線近似で使う仮の平均速度
+FALLBACK_SPEED_KMH = 40.0
+
 
 class OSRMClient:
     """OSRM API クライアント"""
@@ -19,14 +29,14 @@ class OSRMClient:
         if custom_osrm_url:
             # カスタムURLが指定されている場合
             self.base_urls = [custom_osrm_url]
-            print(f"カスタムOSRMサーバーを使用: {custom_osrm_url}")
+            log_event(logger, logging.INFO, 'osrm.config', mode='custom', servers=self.base_urls)
         else:
             # デフォルト設定（安定性優先）
             self.base_urls = [
                 "https://router.project-osrm.org",   # メインOSRMサーバー
                 "https://routing.openstreetmap.de"   # バックアップOSRMサーバー
             ]
-            print("デフォルトOSRMサーバー設定を使用（安定性優先）")
+            log_event(logger, logging.INFO, 'osrm.config', mode='default', servers=self.base_urls)
         
         self.current_url_index = 0
         self.base_url = self.base_urls[self.current_url_index]
@@ -34,6 +44,11 @@ class OSRMClient:
         self.timeout = 6
         self.retry_count = 1
         self.retry_delay = 0.5
+        # 区間キャッシュとスナップ結果のキャッシュ
+        self.leg_cache = leg_cache
+        self._snap_cache: Dict[Tuple[float, float], Tuple[float, float]] = {}
+        # 欠けている区間がこの数以上なら steps 付きの一括リクエストで取得
+        self.bulk_leg_threshold = 3
     
     def nearest(self, lon: float, lat: float) -> Optional[Tuple[float, float]]:
         """最寄りの道路上の座標にスナップ"""
@@ -65,15 +80,15 @@ class OSRMClient:
         if len(coordinates) < 2:
             raise ValueError("最低2つの座標が必要です")
         
-        print(f"🚗 OSRM get_route呼び出し: {len(coordinates)}地点, プロファイル: {profile}, スナップ: {snap}")
-        print(f"🌐 使用サーバー: {self.base_url}")
+        log_event(logger, logging.DEBUG, 'osrm.get_route', points=len(coordinates), profile=profile, snap=snap)
         
         # OSRMのroute API自体がスナップするため、既定ではnearestを省略して低レイテンシ化
         snapped: List[Tuple[float, float]] = []
         if snap:
-            for lon, lat in coordinates:
-                loc = self.nearest(lon, lat)
-                snapped.append(loc if loc else (lon, lat))
+            with span('osrm.snap', points=len(coordinates)):
+                for lon, lat in coordinates:
+                    loc = self.nearest(lon, lat)
+                    snapped.append(loc if loc else (lon, lat))
         else:
             snapped = list(coordinates)
         # 座標を文字列に変換
@@ -87,49 +102,43 @@ class OSRMClient:
             'steps': 'false',
             'alternatives': 'false'
         }
-        print(f"🔗 リクエストPATH: {url_path}")
-        print(f"📋 パラメータ: {params}")
 
         # 複数サーバーを並列に叩き、先着勝ち
         try:
-            data, meta = self._fetch_first(url_path, params)
+            with span('osrm.fetch', points=len(snapped)) as s:
+                data, meta = self._fetch_first(url_path, params)
+                s['server'] = meta.get('osrm_base')
             if data.get('code') == 'Ok':
-                formatted = self._format_route_response(data)
+                with span('osrm.format'):
+                    formatted = self._format_route_response(data)
                 if formatted is not None:
                     formatted['meta'] = meta
                 return formatted
         except Exception as e:
-            print(f"❌ OSRM 並列取得失敗: {e}")
+            log_event(logger, logging.WARNING, 'osrm.fetch_failed', error=str(e), points=len(snapped))
         
         # Fallback: OSRMに到達できない場合は直線ジオメトリを生成
         if allow_fallback:
             try:
-                import math
-                def hav(a: Tuple[float,float], b: Tuple[float,float]) -> float:
-                    (lon1, lat1), (lon2, lat2) = a, b
-                    R=6371.0
-                    dlat=math.radians(lat2-lat1); dlon=math.radians(lon2-lon1)
-                    x=math.sin(dlat/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*math.sin(dlon/2)**2
-                    return 2*R*math.asin(min(1, math.sqrt(x)))
                 legs = []
                 total_km = 0.0
-                for i in range(len(snapped)-1):
-                    km = hav(snapped[i], snapped[i+1])
+                leg_km = segment_lengths_km(snapped)
+                for i, km in enumerate(leg_km.tolist()):
                     total_km += km
                     legs.append({
                         'leg_index': i,
                         'distance_meters': km*1000,
-                        'duration_seconds': (km/40.0)*3600,  # 40km/h 仮
+                        'duration_seconds': (km/FALLBACK_SPEED_KMH)*3600,  # 40km/h 仮
                         'distance_km': round(km, 2),
-                        'duration_minutes': round((km/40.0)*60, 1),
+                        'duration_minutes': round((km/FALLBACK_SPEED_KMH)*60, 1),
                         'steps_count': 0,
                     })
                 return {
                     'geometry': { 'type': 'LineString', 'coordinates': [(lon, lat) for lon,lat in snapped] },
                     'distance_meters': total_km*1000,
-                    'duration_seconds': (total_km/40.0)*3600,
+                    'duration_seconds': (total_km/FALLBACK_SPEED_KMH)*3600,
                     'distance_km': round(total_km, 2),
-                    'duration_minutes': round((total_km/40.0)*60, 1),
+                    'duration_minutes': round((total_km/FALLBACK_SPEED_KMH)*60, 1),
                     'legs': legs,
                     'waypoints': [],
                     'meta': {'osrm_base': None, 'osrm_ms': None}
@@ -145,7 +154,9 @@ class OSRMClient:
             resp = requests.get(base + url_path, params=params, timeout=self.timeout)
             ms = int((time.time() - t0) * 1000)
             return resp, base, ms
-        with ThreadPoolExecutor(max_workers=len(self.base_urls)) as ex:
+        # 先着が得られたら遅いサーバーの完了を待たずに返す
+        ex = ThreadPoolExecutor(max_workers=len(self.base_urls))
+        try:
             futs = [ex.submit(hit, b) for b in self.base_urls]
             for f in as_completed(futs):
                 try:
@@ -158,57 +169,229 @@ class OSRMClient:
                         return data, { 'osrm_base': base, 'osrm_ms': ms }
                 except Exception:
                     continue
+        finally:
+            ex.shutdown(wait=False)
         raise RuntimeError('all OSRM backends failed')
+
+    def get_route_via_legs(self, coordinates: List[Tuple[float, float]],
+                           profile: str = 'driving', *, snap: bool = False, allow_fallback: bool = True) -> Optional[Dict]:
+        """
+        区間キャッシュから複数地点ルートを組み立てる
+        
+        キャッシュにない区間のみ OSRM から取得する。欠けている区間が多い場合は
+        steps 付きの route リクエスト1回で全区間のジオメトリを取得する。
+        
+        Args:
+            coordinates: [(longitude, latitude), ...] の座標リスト
+            profile: ルーティングプロファイル
+            snap: 取得する区間の端点を nearest で道路上にスナップする
+            allow_fallback: 取得できない区間を直線で補う
+            
+        Returns:
+            get_route と同形式のルート情報辞書 or None（エラー時）
+        """
+        if len(coordinates) < 2:
+            raise ValueError("最低2つの座標が必要です")
+        
+        pairs = list(zip(coordinates, coordinates[1:]))
+        legs: List[Optional[Dict]] = [self.leg_cache.get(a, b, profile, need_geometry=True) for a, b in pairs]
+        missing = [i for i, leg in enumerate(legs) if leg is None]
+        meta = {'osrm_base': None, 'osrm_ms': None, 'legs_cached': len(pairs) - len(missing), 'legs_fetched': 0}
+        
+        if missing:
+            with span('osrm.legs', missing=len(missing), total=len(pairs)) as s:
+                fetched, fetch_meta = self._fetch_legs(coordinates, missing, profile, snap)
+                s['server'] = fetch_meta.get('osrm_base')
+            meta.update(fetch_meta)
+            meta['legs_fetched'] = len(fetched)
+            for i, leg in fetched.items():
+                legs[i] = leg
+        
+        unresolved = [i for i, leg in enumerate(legs) if leg is None]
+        if unresolved:
+            if not allow_fallback:
+                return None
+            # 直線で補完（キャッシュには入れない）
+            for i in unresolved:
+                a, b = pairs[i]
+                km = float(segment_lengths_km([a, b])[0])
+                legs[i] = {
+                    'geometry': [[a[0], a[1]], [b[0], b[1]]],
+                    'distance_meters': km * 1000,
+                    'duration_seconds': km / FALLBACK_SPEED_KMH * 3600,
+                }
+            meta['legs_fallback'] = len(unresolved)
+        
+        log_event(logger, logging.DEBUG, 'osrm.legs', **meta)
+        with span('osrm.assemble'):
+            return self._assemble_legs(legs, meta)
+
+    def _snap(self, coord: Tuple[float, float]) -> Tuple[float, float]:
+        """nearest によるスナップ（結果はキャッシュ）"""
+        k = point_key(coord)
+        snapped = self._snap_cache.get(k)
+        if snapped is None:
+            snapped = self.nearest(coord[0], coord[1]) or coord
+            if len(self._snap_cache) > 10000:
+                self._snap_cache.clear()
+            self._snap_cache[k] = snapped
+        return snapped
+
+    def _fetch_legs(self, coordinates: List[Tuple[float, float]], missing: List[int],
+                    profile: str, snap: bool) -> Tuple[Dict[int, Dict], Dict]:
+        """欠けている区間を取得してキャッシュに登録し、{区間番号: 区間} と meta を返す"""
+        params = {
+            'overview': 'false',
+            'geometries': 'geojson',
+            'steps': 'true',
+            'alternatives': 'false'
+        }
+        fetched: Dict[int, Dict] = {}
+        
+        if len(missing) >= self.bulk_leg_threshold:
+            # 全地点を1回で取得し、steps のジオメトリを区間ごとに連結
+            points = [self._snap(c) for c in coordinates] if snap else list(coordinates)
+            coords_str = ";".join([f"{lon},{lat}" for lon, lat in points])
+            try:
+                data, meta = self._fetch_first(f"/route/v1/{profile}/{coords_str}", params)
+                route_legs = (data.get('routes') or [{}])[0].get('legs', [])
+                for i, leg in enumerate(route_legs):
+                    entry = self._leg_entry(leg)
+                    self.leg_cache.put(coordinates[i], coordinates[i + 1], entry['distance_meters'],
+                                       entry['duration_seconds'], entry['geometry'], profile)
+                    if i in missing:
+                        fetched[i] = entry
+                return fetched, meta
+            except Exception as e:
+                log_event(logger, logging.WARNING, 'osrm.legs_bulk_failed', error=str(e), points=len(points))
+                return fetched, {}
+        
+        # 少数の区間は2地点ルートとして並列取得
+        def fetch(i: int) -> Tuple[int, Optional[Dict], Dict]:
+            a, b = coordinates[i], coordinates[i + 1]
+            pa, pb = (self._snap(a), self._snap(b)) if snap else (a, b)
+            try:
+                data, meta = self._fetch_first(f"/route/v1/{profile}/{pa[0]},{pa[1]};{pb[0]},{pb[1]}", params)
+                leg = (data.get('routes') or [{}])[0].get('legs', [None])[0]
+                return i, (self._leg_entry(leg) if leg else None), meta
+            except Exception as e:
+                log_event(logger, logging.WARNING, 'osrm.leg_failed', error=str(e), leg_index=i)
+                return i, None, {}
+        
+        last_meta: Dict = {}
+        with ThreadPoolExecutor(max_workers=min(4, len(missing))) as ex:
+            for i, entry, meta in ex.map(fetch, missing):
+                if entry is None:
+                    continue
+                self.leg_cache.put(coordinates[i], coordinates[i + 1], entry['distance_meters'],
+                                   entry['duration_seconds'], entry['geometry'], profile)
+                fetched[i] = entry
+                last_meta = meta
+        return fetched, last_meta
+
+    @staticmethod
+    def _leg_entry(leg: Dict) -> Dict:
+        """OSRM の leg（steps 付き）から区間エントリを作成"""
+        geometry: List[List[float]] = []
+        for step in leg.get('steps', []):
+            for pt in (step.get('geometry') or {}).get('coordinates', []):
+                if not geometry or geometry[-1] != pt:
+                    geometry.append(pt)
+        return {
+            'geometry': geometry,
+            'distance_meters': float(leg.get('distance', 0)),
+            'duration_seconds': float(leg.get('duration', 0)),
+        }
+
+    @staticmethod
+    def _assemble_legs(legs: List[Dict], meta: Dict) -> Dict:
+        """区間エントリを連結して get_route と同形式のルート情報にする"""
+        coordinates: List[List[float]] = []
+        formatted_legs = []
+        total_m = 0.0
+        total_s = 0.0
+        for i, leg in enumerate(legs):
+            geometry = leg.get('geometry') or []
+            if coordinates and geometry and coordinates[-1] == list(geometry[0]):
+                geometry = geometry[1:]
+            coordinates.extend(list(pt) for pt in geometry)
+            total_m += leg['distance_meters']
+            total_s += leg['duration_seconds']
+            formatted_legs.append({
+                'leg_index': i,
+                'distance_meters': leg['distance_meters'],
+                'duration_seconds': leg['duration_seconds'],
+                'distance_km': round(leg['distance_meters'] / 1000, 2),
+                'duration_minutes': round(leg['duration_seconds'] / 60, 1),
+                'steps_count': 0
+            })
+        return {
+            'geometry': {'type': 'LineString', 'coordinates': coordinates},
+            'distance_meters': total_m,
+            'duration_seconds': total_s,
+            'distance_km': round(total_m / 1000, 2),
+            'duration_minutes': round(total_s / 60, 1),
+            'legs': formatted_legs,
+            'waypoints': [],
+            'meta': meta
+        }
     
-    def get_distance_matrix(self, coordinates: List[Tuple[float, float]]) -> Optional[Dict]:
+    def get_distance_matrix(self, coordinates: List[Tuple[float, float]],
+                            profile: str = 'driving', *, allow_fallback: bool = False) -> Optional[Dict]:
         """
-        複数地点間の距離・時間マトリックスを取得
+        複数地点間の距離・時間マトリックスを取得（1回の table リクエスト）
         
         Args:
             coordinates: [(longitude, latitude), ...] の座標リスト
+            profile: ルーティングプロファイル
+            allow_fallback: OSRM 不達時に直線距離ベースの近似行列を返す
             
         Returns:
-            距離・時間マトリックス or None（エラー時）
+            距離[m]・時間[s]マトリックス or None（エラー時）
         """
         coords_str = ";".join([f"{lon},{lat}" for lon, lat in coordinates])
         
-        url = f"{self.base_url}/table/v1/driving/{coords_str}"
+        url_path = f"/table/v1/{profile}/{coords_str}"
         params = {
             'annotations': 'distance,duration'
         }
         
         try:
-            response = requests.get(url, params=params, timeout=self.timeout)
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            if data.get('code') == 'Ok':
-                return {
-                    'distances': data.get('distances', []),
-                    'durations': data.get('durations', []),
-                    'sources': data.get('sources', []),
-                    'destinations': data.get('destinations', [])
-                }
-            else:
-                print(f"OSRM Table API エラー: {data.get('message', 'Unknown error')}")
-                return None
-                
-        except requests.exceptions.RequestException as e:
-            print(f"OSRM Table API リクエストエラー: {e}")
-            return None
+            with span('osrm.table', points=len(coordinates)) as s:
+                data, meta = self._fetch_first(url_path, params)
+                s['server'] = meta.get('osrm_base')
+            return {
+                'distances': data.get('distances', []),
+                'durations': data.get('durations', []),
+                'sources': data.get('sources', []),
+                'destinations': data.get('destinations', []),
+                'meta': meta
+            }
+        except Exception as e:
+            log_event(logger, logging.WARNING, 'osrm.table_failed', error=str(e), points=len(coordinates))
+        
+        if allow_fallback:
+            return self._fallback_matrix(coordinates)
+        return None
+    
+    def _fallback_matrix(self, coordinates: List[Tuple[float, float]]) -> Dict:
+        """直線距離と仮の平均速度による近似マトリックス"""
+        km = distance_matrix_km(coordinates)
+        return {
+            'distances': (km * 1000).tolist(),
+            'durations': (km / FALLBACK_SPEED_KMH * 3600).tolist(),
+            'sources': [],
+            'destinations': [],
+            'meta': {'osrm_base': None, 'osrm_ms': None}
+        }
     
     def _format_route_response(self, osrm_data: Dict) -> Dict:
         """OSRM レスポンスを統一フォーマットに変換"""
-        print(f"🔧 OSRMレスポンス変換開始: {type(osrm_data)}")
-        print(f"📋 生データ: {osrm_data}")
-        
         if not osrm_data.get('routes'):
-            print("❌ routesフィールドが存在しません")
+            log_event(logger, logging.WARNING, 'osrm.no_routes', code=osrm_data.get('code'))
             return {}
         
         route = osrm_data['routes'][0]  # 最初のルートを使用
-        print(f"📍 ルートデータ: {route}")
         
         formatted = {
             'geometry': route.get('geometry'),
@@ -220,7 +403,9 @@ class OSRMClient:
             'waypoints': osrm_data.get('waypoints', [])
         }
         
-        print(f"✅ 変換完了: {formatted}")
+        log_event(logger, logging.DEBUG, 'osrm.formatted',
+                  distance_km=formatted['distance_km'], duration_minutes=formatted['duration_minutes'],
+                  legs=len(formatted['legs']))
         return formatted
     
     def _format_legs(self, legs: List[Dict]) -> List[Dict]:
@@ -243,38 +428,32 @@ class OSRMClient:
         """次のOSRMサーバーを試行"""
         self.current_url_index = (self.current_url_index + 1) % len(self.base_urls)
         self.base_url = self.base_urls[self.current_url_index]
-        print(f"OSRMサーバーを切り替え: {self.base_url}")
+        log_event(logger, logging.INFO, 'osrm.switch_server', server=self.base_url)
         return True
     
     def test_connection(self) -> bool:
         """OSRM サーバーとの接続テスト"""
-        print(f"OSRM接続テスト開始: {self.base_url}")
-        
         # 各サーバーで接続テスト
         for i, test_url in enumerate(self.base_urls):
             try:
-                print(f"サーバー {i+1} をテスト中: {test_url}")
                 test_coords = "127.7723,26.3105;127.679,26.212"
                 test_url_full = f"{test_url}/route/v1/driving/{test_coords}?overview=simplified&geometries=geojson&steps=false&alternatives=false"
                 
                 response = requests.get(test_url_full, timeout=5)
                 if response.status_code == 200:
-                    print(f"✅ サーバー {test_url} に接続成功")
+                    log_event(logger, logging.INFO, 'osrm.connection_ok', server=test_url)
                     # 成功したサーバーを現在のサーバーに設定
                     self.current_url_index = i
                     self.base_url = test_url
                     return True
                 else:
-                    print(f"❌ サーバー {test_url} のステータス: {response.status_code}")
+                    log_event(logger, logging.WARNING, 'osrm.connection_bad_status', server=test_url, status=response.status_code)
                     
             except Exception as e:
-                print(f"❌ サーバー {test_url} の接続失敗: {e}")
-                if i == 0:  # ローカルサーバーの場合
-                    print("💡 ローカルOSRMサーバーが起動していない可能性があります")
-                    print("   以下のコマンドでローカルOSRMサーバーを起動してください:")
-                    print("   docker run -t -i -p 5000:5000 -v $(pwd):/data osrm/osrm-backend osrm-routed --algorithm mld /data/okinawa.osrm")
+                log_event(logger, logging.WARNING, 'osrm.connection_failed', server=test_url, error=str(e),
+                          hint='docker run -t -i -p 5000:5000 -v $(pwd):/data osrm/osrm-backend osrm-routed --algorithm mld /data/okinawa.osrm')
         
-        print("❌ すべてのOSRMサーバーに接続失敗")
+        log_event(logger, logging.ERROR, 'osrm.connection_all_failed', servers=self.base_urls)
         return False
 
 # シングルトンインスタンス
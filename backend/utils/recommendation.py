@@ -4,6 +4,7 @@
 """
 
 from typing import Dict, List
+from utils.geo import distances_from_km
 
 class RecommendationEngine:
     """推薦エンジン"""
@@ -52,6 +53,9 @@ class RecommendationEngine:
 
         # 天気・季節の適性調整
         score += self._calculate_weather_season_score(customer, destination)
+
+        # 出発地からの距離（origin 指定時のみ）
+        score += self._calculate_distance_score(destination)
         
         return min(score, 1.0)  # 最大1.0に制限
     
@@ -159,6 +163,18 @@ class RecommendationEngine:
         except Exception:
             return 0.0
     
+    def _calculate_distance_score(self, destination: Dict) -> float:
+        """出発地からの直線距離による調整（近場を少し優遇、遠方は減点）"""
+        distance = destination.get('distance_from_origin_km')
+        if distance is None:
+            return 0.0
+        if distance <= 20:
+            return 0.05
+        if distance <= 50:
+            return 0.0
+        # 50km 超は 100km で -0.05 まで線形に減点
+        return -0.05 * (min(distance, 100.0) - 50.0) / 50.0
+
     def _get_age_group(self, age: int) -> str:
         """年齢から年齢層を判定"""
         if age <= 35:
@@ -171,10 +187,20 @@ class RecommendationEngine:
     def sort_destinations_by_score(self, customer: Dict, destinations: List[Dict]) -> List[Dict]:
         """観光地リストを推薦スコア順にソート"""
         scored_destinations = []
+
+        # 出発地 (longitude, latitude) があれば全候補への距離を一括計算
+        distances = None
+        origin = customer.get('origin')
+        if origin and destinations:
+            distances = distances_from_km(
+                origin, [(float(d.get('longitude', 0)), float(d.get('latitude', 0))) for d in destinations]
+            ).tolist()
         
-        for dest in destinations:
-            score = self.calculate_recommendation_score(customer, dest)
+        for i, dest in enumerate(destinations):
             dest_with_score = dest.copy()
+            if distances is not None:
+                dest_with_score['distance_from_origin_km'] = round(distances[i], 2)
+            score = self.calculate_recommendation_score(customer, dest_with_score)
             dest_with_score['recommendation_score'] = round(score, 3)
             scored_destinations.append(dest_with_score)
         
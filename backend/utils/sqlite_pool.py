@@ -0,0 +1,123 @@
+"""
+SQLite 接続プール（FastAPI 用）
+WAL モードの接続を使い回し、クエリは専用スレッドプールで実行してイベントループを止めない
+
+- 接続ごとにプリペアドステートメントをキャッシュ（sqlite3 の cached_statements）
+- 実行スレッド数 = 接続数なので、接続待ちでスレッドが詰まることはない
+- WAL なので読み取り同士・読み取りと書き込みは互いを待たない
+
+環境変数:
+- SQLITE_POOL_SIZE: 接続数（既定: 4）
+- SQLITE_BUSY_TIMEOUT_MS: ロック待ちの上限（既定: 5000）
+- SQLITE_STATEMENT_CACHE: 接続ごとにキャッシュするステートメント数（既定: 128）
+"""
+
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Callable, Iterator, List, Optional, Sequence
+
+
+class SQLitePool:
+    """WAL モード・ステートメントキャッシュ付きの SQLite 接続プール"""
+
+    def __init__(self, path: str, size: Optional[int] = None, busy_timeout_ms: Optional[int] = None,
+                 statement_cache: Optional[int] = None):
+        self.path = path
+        self.size = int(size or os.getenv('SQLITE_POOL_SIZE', 4))
+        self.busy_timeout_ms = int(busy_timeout_ms or os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+        self.statement_cache = int(statement_cache or os.getenv('SQLITE_STATEMENT_CACHE', 128))
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            cached_statements=self.statement_cache,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        接続を1つ借りる（上限まで遅延作成し、使い終わったら返却）
+        ブロック内で例外が出たらロールバック、正常終了ならコミット
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                conn = self._idle.get()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[sqlite3.Row]:
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[sqlite3.Row]:
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='sqlite')
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """同期関数をスレッドプールで実行して結果を待つ（イベントループはブロックしない）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    async def afetchall(self, sql: str, params: Sequence[Any] = ()) -> List[sqlite3.Row]:
+        return await self.run(self.fetchall, sql, params)
+
+    async def afetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[sqlite3.Row]:
+        return await self.run(self.fetchone, sql, params)
+
+    def close(self) -> None:
+        """アイドル中の接続とスレッドプールを閉じる"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
@@ -0,0 +1,183 @@
+"""
+構造化ログと計測スパン
+print() の代わりに使用するレベル付き・サンプリング付きのロガーと、
+リクエスト単位で所要時間を記録する軽量スパンAPIを提供する
+
+環境変数:
+- LOG_LEVEL: ログレベル（既定: INFO）
+- LOG_SAMPLE_RATE: DEBUG/INFO ログの出力率 0.0〜1.0（既定: 1.0）。WARNING 以上は常に出力
+- LOG_FORMAT: json | text（既定: json）
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+_request_id: ContextVar[Optional[str]] = ContextVar('request_id', default=None)
+_spans: ContextVar[Optional[List[Dict]]] = ContextVar('spans', default=None)
+
+_configured = False
+
+
+class SamplingFilter(logging.Filter):
+    """DEBUG/INFO を一定割合だけ通すフィルタ（WARNING 以上は常に通す）"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = max(0.0, min(1.0, rate))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class StructuredFormatter(logging.Formatter):
+    """1行1JSONの構造化フォーマッタ"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        request_id = _request_id.get()
+        if request_id:
+            entry['request_id'] = request_id
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """開発用のテキストフォーマッタ（key=value 形式）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [f"{record.levelname:<7}", record.name, record.getMessage()]
+        request_id = _request_id.get()
+        if request_id:
+            parts.append(f"request_id={request_id}")
+        for key, value in (getattr(record, 'fields', None) or {}).items():
+            parts.append(f"{key}={value}")
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class StdoutHandler(logging.StreamHandler):
+    """出力のたびに sys.stdout を参照する StreamHandler（差し替え後の閉じた stdout に書き込まない）"""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value) -> None:
+        pass
+
+
+def configure_logging() -> None:
+    """ルートロガー 'app' を環境変数に従って一度だけ設定"""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    level = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+    try:
+        rate = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+    except ValueError:
+        rate = 1.0
+
+    handler = StdoutHandler()
+    handler.setFormatter(TextFormatter() if os.getenv('LOG_FORMAT', 'json') == 'text' else StructuredFormatter())
+    handler.addFilter(SamplingFilter(rate))
+
+    root = logging.getLogger('app')
+    root.setLevel(level)
+    root.addHandler(handler)
+    root.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    """'app.<name>' 配下のロガーを取得"""
+    configure_logging()
+    return logging.getLogger(f"app.{name}")
+
+
+def log_event(logger: logging.Logger, level: int, event: str, **fields) -> None:
+    """構造化フィールド付きでログを出力（レベル無効時はフィールド整形も行わない）"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
+
+
+def begin_request(request_id: Optional[str] = None) -> str:
+    """リクエストコンテキストを開始し、リクエストIDを返す"""
+    rid = request_id or uuid.uuid4().hex[:16]
+    _request_id.set(rid)
+    _spans.set([])
+    return rid
+
+
+def end_request() -> List[Dict]:
+    """リクエストコンテキストを終了し、記録されたスパンを返す"""
+    spans = _spans.get() or []
+    _request_id.set(None)
+    _spans.set(None)
+    return spans
+
+
+def current_request_id() -> Optional[str]:
+    """現在のリクエストIDを取得（リクエスト外では None）"""
+    return _request_id.get()
+
+
+def current_spans() -> List[Dict]:
+    """現在のリクエストで記録済みのスパン一覧"""
+    return list(_spans.get() or [])
+
+
+@contextmanager
+def span(name: str, **fields) -> Iterator[Dict]:
+    """
+    所要時間を計測するスパン
+
+    with span('osrm.fetch', points=3) as s:
+        ...
+        s['server'] = base  # 追加フィールドは後から設定可能
+    """
+    record: Dict = {'name': name, **fields}
+    t0 = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['ms'] = round((time.perf_counter() - t0) * 1000, 2)
+        spans = _spans.get()
+        if spans is not None:
+            spans.append(record)
+        log_event(_span_logger, logging.DEBUG, 'span', **record)
+
+
+def server_timing(spans: List[Dict]) -> str:
+    """スパン一覧を Server-Timing ヘッダ値に変換"""
+    return ', '.join(f"{s['name'].replace('.', '-')};dur={s['ms']}" for s in spans)
+
+
+_span_logger = get_logger('span')
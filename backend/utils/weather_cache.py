@@ -0,0 +1,155 @@
+"""
+現在の天気のキャッシュ（FastAPI 用）
+緯度・経度を丸めたバケット単位で保持する（同じホテルの客はほぼ同じ座標を問い合わせるため）
+
+- TTL 内: キャッシュをそのまま返す
+- TTL 超過〜stale 期限内: キャッシュを返しつつ、裏で取り直す（stale-while-revalidate）
+- それより古い / 無い: 取得を待つ。失敗したら古いキャッシュがあればそれを返す
+- 同じバケットの取得は同時に1つだけ（他は同じ取得を待つ）
+- 保持するバケット数に上限を設け、超えたら最も長く使われていないものから捨てる（LRU）
+
+環境変数:
+- WEATHER_CACHE_TTL_SECONDS: 新しいとみなす期間（既定: 600）
+- WEATHER_CACHE_STALE_SECONDS: TTL 後も即答に使う期間（既定: 3600）
+- WEATHER_CACHE_PRECISION: 緯度・経度を丸める小数点以下の桁数（既定: 2 = 約1km）
+- WEATHER_CACHE_MAX_ENTRIES: 保持するバケット数の上限（既定: 1024）
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('weather_cache')
+
+Bucket = Tuple[float, float]
+Fetch = Callable[[float, float], Awaitable[Dict[str, Any]]]
+
+
+class WeatherCache:
+    """ジオバケット単位の stale-while-revalidate キャッシュ"""
+
+    def __init__(self, ttl_seconds: Optional[float] = None, stale_seconds: Optional[float] = None,
+                 precision: Optional[int] = None, max_entries: Optional[int] = None):
+        self.ttl_seconds = float(ttl_seconds if ttl_seconds is not None else os.getenv('WEATHER_CACHE_TTL_SECONDS', 600))
+        self.stale_seconds = float(stale_seconds if stale_seconds is not None else os.getenv('WEATHER_CACHE_STALE_SECONDS', 3600))
+        self.precision = int(precision if precision is not None else os.getenv('WEATHER_CACHE_PRECISION', 2))
+        self.max_entries = int(max_entries if max_entries is not None else os.getenv('WEATHER_CACHE_MAX_ENTRIES', 1024))
+        self._entries: "OrderedDict[Bucket, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._inflight: Dict[Bucket, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.upstream_errors = 0
+        self.served_on_error = 0
+        self.evictions = 0
+
+    def bucket(self, lat: float, lon: float) -> Bucket:
+        return (round(float(lat), self.precision), round(float(lon), self.precision))
+
+    async def get(self, lat: float, lon: float, fetch: Fetch) -> Tuple[Dict[str, Any], str]:
+        """
+        天気を取得
+
+        Args:
+            fetch: バケット中心の (lat, lon) で上流に問い合わせるコルーチン関数
+
+        Returns:
+            (データ, 'hit' | 'stale' | 'miss' | 'fallback')
+        """
+        key = self.bucket(lat, lon)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        age = time.time() - entry[0] if entry else None
+
+        if entry and age < self.ttl_seconds:
+            with self._lock:
+                self.hits += 1
+            return entry[1], 'hit'
+        if entry and age < self.ttl_seconds + self.stale_seconds:
+            with self._lock:
+                self.stale_hits += 1
+            self._refresh(key, fetch)
+            return entry[1], 'stale'
+
+        with self._lock:
+            self.misses += 1
+        try:
+            # shield: 待っている側がキャンセルされても取得は続け、結果はキャッシュに入れる
+            return await asyncio.shield(self._refresh(key, fetch)), 'miss'
+        except Exception:
+            if entry is None:
+                raise
+            with self._lock:
+                self.served_on_error += 1
+            return entry[1], 'fallback'
+
+    def _refresh(self, key: Bucket, fetch: Fetch) -> asyncio.Task:
+        """バケットの取得タスク（実行中なら同じタスクを返す）"""
+        task = self._inflight.get(key)
+        if task is not None:
+            return task
+
+        async def load() -> Dict[str, Any]:
+            data = await fetch(*key)
+            with self._lock:
+                self._entries[key] = (time.time(), data)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+                self.refreshes += 1
+            return data
+
+        task = asyncio.get_running_loop().create_task(load())
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    def _done(self, key: Bucket, task: asyncio.Task) -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            with self._lock:
+                self.upstream_errors += 1
+            log_event(logger, logging.WARNING, 'weather_cache.refresh_failed', bucket=list(key), error=repr(error))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            served = self.hits + self.stale_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'evictions': self.evictions,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'upstream_errors': self.upstream_errors,
+                'served_on_error': self.served_on_error,
+                'hit_rate': round((self.hits + self.stale_hits) / served, 3) if served else None,
+                'ttl_seconds': self.ttl_seconds,
+                'stale_seconds': self.stale_seconds,
+                'precision': self.precision,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.stale_hits = self.misses = 0
+            self.refreshes = self.upstream_errors = self.served_on_error = self.evictions = 0
+
+
+# シングルトンインスタンス
+weather_cache = WeatherCache()
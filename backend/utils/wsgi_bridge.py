@@ -0,0 +1,177 @@
+"""
+Flask（WSGI）アプリを FastAPI（ASGI）にマウントするためのブリッジ
+starlette.middleware.wsgi と同じくリクエストごとに WSGI アプリをスレッドで実行するが、次の点が異なる
+
+- クライアントが切断したら、応答の iterable を次の断片の時点で打ち切る
+  （NDJSON ストリームの生成と、その先の LLM・OSRM 呼び出しも止まる）
+- 正常終了・切断・例外のどの場合も iterable の close() を呼ぶ（WSGI の仕様どおり）
+- アプリはファクトリから load()（または初回のリクエスト）で作成する（import だけでは起動処理を走らせない）
+"""
+
+import asyncio
+import io
+import logging
+import math
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import anyio
+
+from utils.telemetry import get_logger, log_event
+
+logger = get_logger('wsgi')
+
+WSGIApp = Callable[..., Any]
+
+
+def build_environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    """ASGI の scope と本文から WSGI の environ を作る（マウント先のパスは SCRIPT_NAME に入る）"""
+    script_name = scope.get('root_path', '').encode('utf8').decode('latin1')
+    path_info = scope['path'].encode('utf8').decode('latin1')
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = f'HTTP_{name}'.upper().replace('-', '_')
+        value = value.decode('latin1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class WSGIBridge:
+    """WSGI アプリを ASGI アプリとして呼び出す（app.mount に渡す）"""
+
+    def __init__(self, factory: Callable[[], WSGIApp]):
+        self.factory = factory
+        self._app: Optional[WSGIApp] = None
+        self._lock = threading.Lock()
+
+    def load(self) -> WSGIApp:
+        """WSGI アプリ（初回だけファクトリで作成）"""
+        if self._app is None:
+            with self._lock:
+                if self._app is None:
+                    self._app = self.factory()
+        return self._app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        assert scope['type'] == 'http'
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        app = self._app or await anyio.to_thread.run_sync(self.load)
+        await _Responder(app, build_environ(scope, body))(receive, send)
+
+
+class _Responder:
+    """1リクエスト分の WSGI 呼び出し（応答の断片はメモリ内のストリーム経由でイベントループ側が送る）"""
+
+    def __init__(self, app: WSGIApp, environ: Dict[str, Any]):
+        self.app = app
+        self.environ = environ
+        self.disconnected = threading.Event()
+        self.send_stream, self.receive_stream = anyio.create_memory_object_stream(math.inf)
+        self.started = False
+        self.exc_info: Any = None
+
+    async def __call__(self, receive: Callable, send: Callable) -> None:
+        watcher = asyncio.ensure_future(self._watch(receive))
+        sender = asyncio.ensure_future(self._sender(send))
+        try:
+            async with self.send_stream:
+                await anyio.to_thread.run_sync(self._run)
+            await sender
+        finally:
+            # 途中で抜けた場合もスレッド側を止める
+            self.disconnected.set()
+            watcher.cancel()
+            sender.cancel()
+        if self.exc_info is not None:
+            raise self.exc_info[1].with_traceback(self.exc_info[2])
+
+    async def _watch(self, receive: Callable) -> None:
+        """クライアントの切断を待つ"""
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                self.disconnected.set()
+                return
+
+    async def _sender(self, send: Callable) -> None:
+        async with self.receive_stream:
+            async for message in self.receive_stream:
+                if self.disconnected.is_set():
+                    continue
+                try:
+                    await send(message)
+                except Exception:
+                    # 送れない = 切断済み。残りは読み捨て、スレッド側は次の断片で止まる
+                    self.disconnected.set()
+
+    def _send(self, message: Dict[str, Any]) -> None:
+        anyio.from_thread.run_sync(self.send_stream.send_nowait, message)
+
+    def _start_response(self, status: str, response_headers: List[Tuple[str, str]],
+                        exc_info: Any = None) -> Callable[[bytes], None]:
+        self.exc_info = exc_info
+        if not self.started:
+            self.started = True
+            self._send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [
+                    (name.strip().encode('ascii').lower(), value.strip().encode('ascii'))
+                    for name, value in response_headers
+                ],
+            })
+        return self._write
+
+    def _write(self, data: bytes) -> None:
+        if data:
+            self._send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+    def _run(self) -> None:
+        iterable = self.app(self.environ, self._start_response)
+        chunks = 0
+        try:
+            for chunk in iterable:
+                if self.disconnected.is_set():
+                    log_event(logger, logging.INFO, 'wsgi.client_disconnected',
+                              path=self.environ['SCRIPT_NAME'] + self.environ['PATH_INFO'], chunks_sent=chunks)
+                    break
+                if chunk:
+                    self._write(chunk)
+                    chunks += 1
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+        self._send({'type': 'http.response.body', 'body': b''})
@@ -1318,10 +1318,10 @@ export default function HotelRecommendApp() {
 
   const fetchCustomerData = async () => {
     try {
-      // backend(Flask 5001) の顧客APIを参照（モバイル対応: 同一ホストIPに自動バインド）
+      // backend(8000) の顧客APIを参照（モバイル対応: 同一ホストIPに自動バインド）
       const apiBase =
         (process.env.NEXT_PUBLIC_BACKEND_BASE as string) ||
-        (typeof window !== 'undefined' ? `${window.location.protocol}//${window.location.hostname}:5001` : 'http://localhost:5001')
+        (typeof window !== 'undefined' ? `${window.location.protocol}//${window.location.hostname}:8000` : 'http://localhost:8000')
       const res = await fetch(`${apiBase}/api/customers`)
       if (!res.ok) throw new Error('customer api error')
       const data = await res.json()
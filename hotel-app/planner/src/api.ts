@@ -1,7 +1,7 @@
 import { Intent, Piece, CatalogItem, Customer } from './types'
 
 const API_BASE = (import.meta as any).env?.VITE_API_BASE || 'http://localhost:8000'
-const API2_BASE = (import.meta as any).env?.VITE_API2_BASE || 'http://localhost:5001'
+const API2_BASE = (import.meta as any).env?.VITE_API2_BASE || 'http://localhost:8000'
 
 export async function fetchCatalogItems(): Promise<CatalogItem[]> {
   try {
@@ -3,20 +3,12 @@ $ErrorActionPreference = 'Stop'
 Push-Location (Split-Path -Parent $MyInvocation.MyCommand.Path)
 Set-Location ..
 
-Write-Host "Starting backend (Flask 5001), backend (FastAPI 8000), frontend (Vite 5173), hotel-app (Next 3000)" -ForegroundColor Cyan
+Write-Host "Starting backend (FastAPI + Flask /api, 8000), frontend (Vite 5173), hotel-app (Next 3000)" -ForegroundColor Cyan
 
 $backend = Start-Job -ScriptBlock {
   Set-Location "$PWD\backend"
   python -m venv venv
   . venv\Scripts\Activate.ps1
-  python start_server.py
-}
-
-Start-Sleep -Seconds 1
-
-$api = Start-Job -ScriptBlock {
-  Set-Location "$PWD\backend"
-  . venv\Scripts\Activate.ps1
   uvicorn main:app --host 0.0.0.0 --port 8000 --reload
 }
 
@@ -38,7 +30,6 @@ $hotel = Start-Job -ScriptBlock {
 
 Write-Host "Jobs started. Press Ctrl+C to stop. Use Get-Job to see status." -ForegroundColor Green
 Receive-Job -Id $backend.Id -Keep
-Receive-Job -Id $api.Id -Keep
 Receive-Job -Id $frontend.Id -Keep
 Receive-Job -Id $hotel.Id -Keep
 